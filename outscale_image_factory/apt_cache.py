@@ -0,0 +1,497 @@
+"""
+Caching HTTP proxy for the APT and HTTP downloads of fab builds.
+
+Package files (.deb, .udeb and the by-hash index files) never change once
+published: they are stored on disk by the sha256 of their content, and
+served from there to the next builds. Other requests are forwarded as they
+are, CONNECT requests are tunneled.
+
+Concurrent requests for the same package file are coalesced: the first one
+downloads it, the others wait and are served from the cache. The least
+recently used files are evicted when the cache grows over its size budget.
+
+GET /_stats returns the hit, miss and bytes saved counters as JSON.
+"""
+from __future__ import division, absolute_import, print_function, unicode_literals
+
+import BaseHTTPServer
+import SocketServer
+import collections
+import errno
+import hashlib
+import json
+import logging
+import os
+import re
+import select
+import shutil
+import signal
+import socket
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+import urllib2
+import urlparse
+
+
+GIB = 1024 * 1024 * 1024
+LISTEN = '127.0.0.1:8124'
+_CHUNK_SIZE = 64 * 1024
+_INDEX = 'index.json'
+# Package files, never modified once published
+_IMMUTABLE_RE = re.compile(r'(\.u?deb|/by-hash/[^/]+/[0-9a-fA-F]+)$')
+_HOP_HEADERS = set(['connection', 'keep-alive', 'proxy-authenticate',
+                    'proxy-authorization', 'proxy-connection', 'te',
+                    'trailers', 'transfer-encoding', 'upgrade'])
+# Upstream requests never go through a proxy, which may be this one
+_opener = urllib2.build_opener(urllib2.ProxyHandler({}))
+
+
+def is_immutable(url):
+    return _IMMUTABLE_RE.search(urlparse.urlparse(url).path) is not None
+
+
+class _Download(object):
+
+    """
+    Download of a package file in progress, waited for by the concurrent
+    requests of the same URL.
+    """
+
+    def __init__(self):
+        self.done = threading.Event()
+
+
+class Store(object):
+
+    """
+    Content addressed files, at most budget bytes of them, and the index of
+    their URLs.
+
+    The index is saved after each stored file. At startup, it is reconciled
+    with the files on disk: entries without a file are dropped, files
+    without an entry are removed.
+    """
+
+    def __init__(self, path, budget):
+        self.path = os.path.abspath(path)
+        self.budget = budget
+        self.lock = threading.Lock()
+        self.stats = collections.Counter()
+        self._downloads = {}
+        self._index_path = os.path.join(self.path, _INDEX)
+        self.urls = {}
+        self.objects = {}
+        if os.path.exists(self._index_path):
+            with open(self._index_path) as fp:
+                index = json.load(fp)
+            self.urls = index['urls']
+            self.objects = index['objects']
+        tmp_dir = os.path.join(self.path, 'tmp')
+        if os.path.isdir(tmp_dir):
+            # Leftovers of interrupted downloads
+            shutil.rmtree(tmp_dir)
+        os.makedirs(tmp_dir)
+        self._reconcile()
+
+    def _reconcile(self):
+        """
+        Match the index with the object files, after a crash.
+        """
+        found = set()
+        for name in os.listdir(self.path):
+            if len(name) != 2 or not os.path.isdir(os.path.join(self.path,
+                                                                name)):
+                continue
+            for digest in os.listdir(os.path.join(self.path, name)):
+                if digest in self.objects:
+                    found.add(digest)
+                else:
+                    os.unlink(self.object_path(digest))
+                    self.stats['orphans'] += 1
+        for digest in set(self.objects) - found:
+            del self.objects[digest]
+        for url, digest in list(self.urls.items()):
+            if digest not in self.objects:
+                del self.urls[url]
+
+    def object_path(self, digest):
+        return os.path.join(self.path, digest[:2], digest)
+
+    def open(self, url):
+        """
+        Return (fp, download) tuple: the opened cached file of url, else the
+        download of url to wait for, else (None, None) and the caller
+        downloads url, see store() and fail().
+        """
+        with self.lock:
+            digest = self.urls.get(url)
+            if digest is not None:
+                try:
+                    fp = open(self.object_path(digest), 'rb')
+                except IOError as error:
+                    if error.errno != errno.ENOENT:
+                        raise
+                    del self.urls[url]
+                else:
+                    self.objects[digest]['used'] = time.time()
+                    return fp, None
+            download = self._downloads.get(url)
+            if download is None:
+                self._downloads[url] = _Download()
+            return None, download
+
+    def temp_file(self):
+        return tempfile.NamedTemporaryFile(dir=os.path.join(self.path, 'tmp'),
+                                           delete=False)
+
+    def store(self, url, tmp_path, digest, size):
+        """
+        Store the downloaded file of url, wake up the waiting requests.
+        """
+        path = self.object_path(digest)
+        with self.lock:
+            if not os.path.isdir(os.path.dirname(path)):
+                os.makedirs(os.path.dirname(path))
+            os.rename(tmp_path, path)
+            self.urls[url] = digest
+            self.objects[digest] = dict(size=size, used=time.time())
+            self._evict()
+            self._save()
+        self._finish(url)
+
+    def fail(self, url):
+        """
+        Wake up the requests waiting for a failed download of url.
+        """
+        self._finish(url)
+
+    def _finish(self, url):
+        with self.lock:
+            download = self._downloads.pop(url)
+        download.done.set()
+
+    def _evict(self):
+        total = sum(obj['size'] for obj in self.objects.values())
+        if total <= self.budget:
+            return
+        for digest in sorted(self.objects,
+                             key=lambda digest: self.objects[digest]['used']):
+            if total <= self.budget:
+                break
+            # Open files stay readable by the requests serving them
+            os.unlink(self.object_path(digest))
+            total -= self.objects.pop(digest)['size']
+            self.stats['evicted'] += 1
+        for url, digest in list(self.urls.items()):
+            if digest not in self.objects:
+                del self.urls[url]
+
+    def _save(self):
+        tmp = self._index_path + '.tmp'
+        with open(tmp, 'w') as fp:
+            json.dump(dict(urls=self.urls, objects=self.objects), fp)
+        os.rename(tmp, self._index_path)
+
+    def save(self):
+        with self.lock:
+            self._save()
+
+    def count(self, name, value=1):
+        with self.lock:
+            self.stats[name] += value
+
+    def report(self):
+        with self.lock:
+            stats = dict(self.stats)
+            stats.update(files=len(self.objects),
+                         bytes=sum(obj['size']
+                                   for obj in self.objects.values()))
+        requests = stats.get('hits', 0) + stats.get('misses', 0)
+        stats['hit_rate'] = stats.get('hits', 0) / requests if requests else 0
+        return stats
+
+
+class _Handler(BaseHTTPServer.BaseHTTPRequestHandler):
+
+    protocol_version = 'HTTP/1.1'
+
+    def log_message(self, fmt, *args):
+        logging.debug('apt-cache: ' + fmt, *args)
+
+    def _url(self):
+        if self.path.startswith('/'):
+            # apt-cacher style http://proxy/host/path
+            return 'http:/' + self.path
+        return self.path
+
+    def do_GET(self):
+        if self.path == '/_stats':
+            return self._send_bytes(200, json.dumps(
+                self.server.store.report(), sort_keys=True).encode('utf-8'),
+                'application/json')
+        url = self._url()
+        if not is_immutable(url):
+            self.server.store.count('passthrough')
+            return self._forward(url)
+        store = self.server.store
+        waited = False
+        while True:
+            fp, download = store.open(url)
+            if download is None:
+                break
+            # After a failed download, the next request downloads again
+            download.done.wait()
+            waited = True
+        if fp is not None:
+            with fp:
+                size = os.fstat(fp.fileno()).st_size
+                store.count('hits')
+                if waited:
+                    store.count('coalesced')
+                store.count('bytes_saved', size)
+                self._send_file(fp, size)
+            return
+        store.count('misses')
+        self._fetch(url)
+
+    do_HEAD = do_GET
+
+    def _send_bytes(self, code, body, content_type):
+        self.send_response(code)
+        self.send_header('Content-Type', content_type)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        if self.command != 'HEAD':
+            self.wfile.write(body)
+
+    def _send_file(self, fp, size):
+        self.send_response(200)
+        self.send_header('Content-Type', 'application/octet-stream')
+        self.send_header('Content-Length', str(size))
+        self.end_headers()
+        if self.command != 'HEAD':
+            shutil.copyfileobj(fp, self.wfile, _CHUNK_SIZE)
+
+    def _upstream(self, url, headers):
+        request = urllib2.Request(url, headers=headers)
+        request.get_method = lambda: self.command
+        try:
+            return _opener.open(request, timeout=60)
+        except urllib2.HTTPError as error:
+            return error
+
+    def _send_headers(self, response):
+        self.send_response(response.getcode())
+        length = None
+        for name, value in response.info().items():
+            if name.lower() in _HOP_HEADERS:
+                continue
+            if name.lower() == 'content-length':
+                length = value
+            self.send_header(name, value)
+        if length is None:
+            self.send_header('Connection', 'close')
+            self.close_connection = True
+        self.end_headers()
+
+    def _forward(self, url):
+        headers = dict((name, value) for name, value in self.headers.items()
+                       if name.lower() not in _HOP_HEADERS)
+        try:
+            response = self._upstream(url, headers)
+        except (urllib2.URLError, socket.error) as error:
+            return self._send_bytes(502, str(error).encode('utf-8'),
+                                    'text/plain')
+        with _closing(response):
+            self._send_headers(response)
+            if self.command != 'HEAD':
+                shutil.copyfileobj(response, self.wfile, _CHUNK_SIZE)
+
+    def _fetch(self, url):
+        """
+        Download a package file, send it to the client while storing it.
+        """
+        store = self.server.store
+        headers = dict((name, value) for name, value in self.headers.items()
+                       if name.lower() not in _HOP_HEADERS and
+                       not name.lower().startswith(('range', 'if-',
+                                                    'accept-encoding')))
+        tmp = None
+        ok = False
+        try:
+            try:
+                response = self._upstream(url, headers)
+            except (urllib2.URLError, socket.error) as error:
+                return self._send_bytes(502, str(error).encode('utf-8'),
+                                        'text/plain')
+            with _closing(response):
+                self._send_headers(response)
+                if self.command == 'HEAD' or response.getcode() != 200:
+                    shutil.copyfileobj(response, self.wfile, _CHUNK_SIZE)
+                    return
+                tmp = store.temp_file()
+                digest = hashlib.sha256()
+                size = 0
+                client_ok = True
+                for chunk in iter(lambda: response.read(_CHUNK_SIZE), b''):
+                    digest.update(chunk)
+                    size += len(chunk)
+                    tmp.write(chunk)
+                    if client_ok:
+                        try:
+                            self.wfile.write(chunk)
+                        except socket.error:
+                            # Keep downloading for the other clients
+                            client_ok = False
+                            self.close_connection = True
+                tmp.close()
+                length = response.info().get('Content-Length')
+                ok = length is None or int(length) == size
+            if ok:
+                store.store(url, tmp.name, digest.hexdigest(), size)
+                store.count('bytes_downloaded', size)
+        finally:
+            if not ok:
+                store.fail(url)
+                if tmp is not None:
+                    tmp.close()
+                    os.unlink(tmp.name)
+
+    def do_CONNECT(self):
+        host, _, port = self.path.partition(':')
+        try:
+            upstream = socket.create_connection((host, int(port or 443)), 60)
+        except (ValueError, socket.error) as error:
+            return self._send_bytes(502, str(error).encode('utf-8'),
+                                    'text/plain')
+        self.server.store.count('tunnels')
+        self.send_response(200, 'Connection established')
+        self.end_headers()
+        self.close_connection = True
+        sockets = [self.connection, upstream]
+        try:
+            while True:
+                readable, _, _ = select.select(sockets, [], [], 300)
+                if not readable:
+                    break
+                for sock in readable:
+                    data = sock.recv(_CHUNK_SIZE)
+                    if not data:
+                        return
+                    (upstream if sock is self.connection
+                     else self.connection).sendall(data)
+        except socket.error:
+            pass
+        finally:
+            upstream.close()
+
+
+class _closing(object):
+
+    # urllib2 responses are not context managers in Python 2
+
+    def __init__(self, response):
+        self.response = response
+
+    def __enter__(self):
+        return self.response
+
+    def __exit__(self, *exc_info):
+        self.response.close()
+
+
+class AptCacheServer(SocketServer.ThreadingMixIn, BaseHTTPServer.HTTPServer):
+
+    daemon_threads = True
+    allow_reuse_address = True
+
+    def __init__(self, address, store):
+        BaseHTTPServer.HTTPServer.__init__(self, address, _Handler)
+        self.store = store
+
+
+def _address(listen):
+    host, _, port = listen.rpartition(':')
+    return host or '127.0.0.1', int(port)
+
+
+def is_listening(listen):
+    """
+    Return True if something accepts connections at host:port listen.
+    """
+    try:
+        socket.create_connection(_address(listen), 2).close()
+        return True
+    except socket.error:
+        return False
+
+
+def start(listen, cache_dir, budget_gib):
+    """
+    Start an apt-cache service in the background unless one is listening
+    already. It outlives the calling command, serving the next builds, and
+    logs to cache_dir/apt-cache.log.
+
+    Return (ok, error) tuple.
+    """
+    if is_listening(listen):
+        return True, None
+    if not os.path.isdir(cache_dir):
+        os.makedirs(cache_dir)
+    log_path = os.path.join(cache_dir, 'apt-cache.log')
+    logging.info('Starting apt-cache on {}, logging to {}'.format(listen,
+                                                                  log_path))
+    with open(os.devnull, 'r') as devnull, open(log_path, 'a') as log:
+        subprocess.Popen([sys.executable, '-m', 'outscale_image_factory.main',
+                          'apt-cache', '--listen', listen,
+                          '--cache-dir', cache_dir,
+                          '--cache-gib', str(budget_gib)],
+                         stdin=devnull, stdout=log, stderr=subprocess.STDOUT,
+                         close_fds=True, preexec_fn=os.setsid)
+    deadline = time.time() + 10
+    while time.time() < deadline:
+        if is_listening(listen):
+            return True, None
+        time.sleep(0.1)
+    return False, 'apt-cache is not listening on {}, see {}'.format(listen,
+                                                                   log_path)
+
+
+def serve(listen, cache_dir, budget_gib, report_sec=600):
+    """
+    Run the proxy until interrupted or terminated, log the counters every
+    report_sec.
+    """
+    store = Store(cache_dir, budget_gib * GIB)
+    server = AptCacheServer(_address(listen), store)
+    logging.info('apt-cache listening on {}, caching in {}'.format(listen,
+                                                                   cache_dir))
+    stop = threading.Event()
+
+    def reporter():
+        while not stop.wait(report_sec):
+            logging.info('apt-cache: {}'.format(json.dumps(store.report(),
+                                                           sort_keys=True)))
+
+    thread = threading.Thread(target=reporter)
+    thread.daemon = True
+    thread.start()
+
+    def terminate(signum, frame):
+        # shutdown() waits for serve_forever() to return: not from its thread
+        threading.Thread(target=server.shutdown).start()
+
+    signal.signal(signal.SIGTERM, terminate)
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        stop.set()
+        server.server_close()
+        store.save()
+        logging.info('apt-cache: {}'.format(json.dumps(store.report(),
+                                                       sort_keys=True)))
@@ -0,0 +1,190 @@
+#!/usr/bin/env python2
+"""
+Benchmark the factory EC2 pipeline against the local fake EC2 service.
+
+Runs concurrent create-volume -> create-image -> destroy-volume builds, then
+a cleanup of leftover tagged volumes and instances, and reports wall time and
+API call counts for each phase.
+"""
+from __future__ import division, absolute_import, print_function, unicode_literals
+
+import argparse
+import collections
+import json
+import logging
+import os
+import shutil
+import sys
+import tempfile
+import threading
+import time
+
+from outscale_image_factory import cleanup
+from outscale_image_factory import config
+from outscale_image_factory import create_ami
+from outscale_image_factory.fake_ec2 import FakeEC2, DEFAULT_DELAYS
+from outscale_image_factory.helper import positive_int
+
+BENCHMARK_TAG = 'omi-factory:benchmark'
+
+
+def _build(conn, instance_id, index, volume_size, volume_location, tags,
+           timings):
+    """
+    Run one create-volume -> create-image -> destroy-volume cycle.
+    """
+    clock = time.time()
+    volume_id, _, error = create_ami.create_volume(
+        conn, instance_id, volume_size, volume_location, tags)
+    if error is None:
+        _, error = create_ami.detach_volume(conn, volume_id)
+    if error is None:
+        _, error = create_ami.create_image(
+            conn, 'benchmark-{}'.format(index), volume_id, tags=tags)
+    if volume_id is not None:
+        create_ami.destroy_volume(conn, volume_id)
+    timings.append((time.time() - clock, error is None))
+
+
+def bench_builds(fake, conn, builds, jobs, volume_size, volume_location):
+    """
+    Run builds concurrently, at most jobs at a time.
+
+    Return a result dict.
+    """
+    instance_id = fake.add_instance()
+    tags = {BENCHMARK_TAG: 'build'}
+    timings = []
+    semaphore = threading.Semaphore(jobs)
+
+    def run(index):
+        with semaphore:
+            _build(conn, instance_id, index, volume_size, volume_location,
+                   tags, timings)
+
+    calls = collections.Counter(fake.calls)
+    clock = time.time()
+    threads = [threading.Thread(target=run, args=(i,)) for i in range(builds)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    wall = time.time() - clock
+    return _result('builds', wall, fake.calls - calls,
+                   builds=builds,
+                   failed=sum(1 for _, ok in timings if not ok),
+                   mean_build_sec=sum(t for t, _ in timings) / max(1, builds))
+
+
+def bench_cleanup(fake, conn, volumes, instances, volume_size,
+                  volume_location):
+    """
+    Leave tagged volumes (half of them attached) and instances behind, then
+    clean them up.
+
+    Return a result dict.
+    """
+    tags = {BENCHMARK_TAG: 'cleanup'}
+    instance_ids = [fake.add_instance(tags) for _ in range(instances)]
+    owner = fake.add_instance()
+    leftovers = []
+    for _ in range(volumes):
+        volume = conn.create_volume(volume_size, volume_location)
+        conn.create_tags(volume.id, tags)
+        leftovers.append(volume)
+    create_ami._wait_for_all(conn, leftovers, create_ami.AVAILABLE)
+    for volume in leftovers[:volumes // 2]:
+        create_ami._attach(conn, volume, owner)
+
+    calls = collections.Counter(fake.calls)
+    clock = time.time()
+    cleanup.search_and_destroy(conn, tags)
+    wall = time.time() - clock
+    return _result('cleanup', wall, fake.calls - calls,
+                   volumes=volumes, instances=len(instance_ids),
+                   remaining_volumes=len([
+                       vol for vol in conn.get_all_volumes(
+                           filters={'tag:' + BENCHMARK_TAG: 'cleanup'})
+                       if vol.status != 'deleting']))
+
+
+def _result(name, wall, calls, **extra):
+    result = dict(name=name, wall_sec=round(wall, 3),
+                  api_calls=sum(calls.values()), calls=dict(calls))
+    result.update(extra)
+    return result
+
+
+def _print_result(result, fp):
+    fp.write('{name}: {wall_sec:.2f}s, {api_calls} API calls\n'
+             .format(**result))
+    for key in sorted(result):
+        if key not in ('name', 'wall_sec', 'api_calls', 'calls'):
+            fp.write('  {:18} {}\n'.format(key, result[key]))
+    for action, count in sorted(result['calls'].items()):
+        fp.write('  {:18} {}\n'.format(action, count))
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.strip())
+    parser.add_argument('-b', '--builds', type=int, default=10,
+                        help='number of builds (default: %(default)s)')
+    parser.add_argument('-j', '--jobs', type=positive_int, default=5,
+                        help='concurrent builds (default: %(default)s)')
+    parser.add_argument('-c', '--cleanup-volumes', type=int, default=20,
+                        help='leftover volumes to clean up '
+                        '(default: %(default)s)')
+    parser.add_argument('--cleanup-instances', type=int, default=5,
+                        help='leftover instances to clean up '
+                        '(default: %(default)s)')
+    parser.add_argument('-s', '--volume-size', type=int, default=10,
+                        help='volume size in GiB (default: %(default)s)')
+    parser.add_argument('--latency', type=float, default=0.02,
+                        help='seconds added to each API request '
+                        '(default: %(default)s)')
+    parser.add_argument('--delay-scale', type=float, default=1.0,
+                        help='scale factor of the state transition delays')
+    parser.add_argument('--failure-rate', type=float, default=0.0,
+                        help='probability of an API request failing')
+    parser.add_argument('--json', action='store_true',
+                        help='print results as JSON')
+    parser.add_argument('-v', '--verbose', action='store_true')
+    args = parser.parse_args(argv)
+
+    logging.basicConfig(format='%(asctime)s %(levelname)s: %(message)s',
+                        level=logging.INFO if args.verbose else
+                        logging.WARNING)
+
+    work_dir = tempfile.mkdtemp(suffix='-omi-benchmark')
+    dct = config.load()
+    dct['device-lease-file'] = os.path.join(work_dir, 'devices.json')
+    dct['device-names'] = 'xvd'
+
+    delays = dict((k, v * args.delay_scale) for k, v in DEFAULT_DELAYS.items())
+    fake = FakeEC2(delays=delays, latency=args.latency,
+                   failure_rate=args.failure_rate)
+    fake.start()
+    try:
+        conn = fake.connect()
+        results = [
+            bench_builds(fake, conn, args.builds, args.jobs, args.volume_size,
+                         dct['volume-location']),
+            bench_cleanup(fake, conn, args.cleanup_volumes,
+                          args.cleanup_instances, args.volume_size,
+                          dct['volume-location']),
+        ]
+    finally:
+        fake.stop()
+        shutil.rmtree(work_dir)
+
+    if args.json:
+        json.dump(results, sys.stdout, indent=2, sort_keys=True)
+        sys.stdout.write('\n')
+    else:
+        for result in results:
+            _print_result(result, sys.stdout)
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
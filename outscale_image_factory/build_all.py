@@ -0,0 +1,213 @@
+"""
+Parallel builds of TurnKey Linux appliances.
+
+Each appliance is built with the tkl-build command, then installed to a disk
+image with tkl-install-iso if an output directory is given. Both commands
+change the working directory, so each one runs in its own process, logging
+to its own file.
+
+Steps are limited per resource: builds use a CPU slot, installs a disk I/O
+slot and a device slot. The core appliance is built first, the other
+builds depend on it.
+"""
+from __future__ import division, absolute_import, print_function, unicode_literals
+
+import collections
+import logging
+import os
+import subprocess
+import sys
+import threading
+import time
+
+from outscale_image_factory import tracing
+from outscale_image_factory.helper import run_graph
+
+# Resources
+CPU = 'cpu'
+IO = 'io'
+DEVICE = 'device'
+
+CORE = 'core'
+BUILD = 'build'
+INSTALL = 'install'
+
+# Seconds between progress reports
+REPORT_SEC = 60
+
+_GITHUB_API_REPOS = 'https://api.github.com/repos/'
+
+_Job = collections.namedtuple('_Job', 'key app kind cmd deps resources')
+
+
+def clone_url(url):
+    """
+    Return a clonable URL: tklgit lists GitHub API URLs.
+    """
+    if url.startswith(_GITHUB_API_REPOS):
+        return 'https://github.com/{}.git'.format(url[len(_GITHUB_API_REPOS):])
+    return url
+
+
+def _omi_factory(*args):
+    return [sys.executable, '-m', 'outscale_image_factory.main'] + list(args)
+
+
+def plan_jobs(apps, fab_dir, output_dir=None, git=None, build_args=()):
+    """
+    Return the list of jobs building and installing apps, a list of
+    (appliance, repository, branch) tuples as printed by tklgit.
+
+    build_args: extra arguments of the tkl-build commands.
+    """
+    names = set(app for app, _, _ in apps)
+    builds = []
+    installs = []
+    for app, url, branch in apps:
+        cmd = _omi_factory('tkl-build', app, '--fab-dir', fab_dir,
+                           '--repo', clone_url(url), *build_args)
+        if git:
+            cmd += ['--turnkey-apps-git', git]
+        if branch:
+            cmd += ['--branch', branch]
+        deps = []
+        if app != CORE:
+            # Only the core build updates the shared core repository
+            cmd.append('--no-core-update')
+            if CORE in names:
+                deps.append('{}:{}'.format(BUILD, CORE))
+        build = _Job('{}:{}'.format(BUILD, app), app, BUILD, cmd, deps, [CPU])
+        if app == CORE:
+            builds.insert(0, build)
+        else:
+            builds.append(build)
+        if output_dir:
+            cmd = _omi_factory('tkl-install-iso', app, '--fab-dir', fab_dir,
+                               '--output-image',
+                               os.path.join(output_dir, app + '.img'))
+            installs.append(_Job('{}:{}'.format(INSTALL, app), app, INSTALL,
+                                 cmd, [build.key], [IO, DEVICE]))
+    # Ready installs go first, they finish appliances
+    return installs + builds
+
+
+class Progress(object):
+
+    """
+    Count running and finished jobs, report throughput.
+    """
+
+    def __init__(self, jobs):
+        self.total = collections.Counter(job.kind for job in jobs)
+        self.apps = set(job.app for job in jobs)
+        self.last_kind = dict((job.app, job.kind) for job in reversed(jobs))
+        self.running = collections.Counter()
+        self.done = collections.Counter()
+        self.failed = collections.Counter()
+        self.results = {}
+        self.finished_apps = 0
+        self.started = time.time()
+        self._lock = threading.Lock()
+
+    def start(self, job):
+        with self._lock:
+            self.running[job.kind] += 1
+
+    def finish(self, job, ok, duration):
+        with self._lock:
+            self.running[job.kind] -= 1
+            (self.done if ok else self.failed)[job.kind] += 1
+            self.results[job.key] = (ok, duration)
+            if ok and job.kind == self.last_kind[job.app]:
+                self.finished_apps += 1
+
+    def report(self, final=False):
+        """
+        Log the job counts. Once all jobs are run, the jobs left are the
+        ones skipped because a job they depend on failed.
+        """
+        with self._lock:
+            hours = (time.time() - self.started) / 3600
+            for kind in (BUILD, INSTALL):
+                if self.total[kind]:
+                    logging.info(
+                        '{}: {} done, {} failed, {} running, {} {}'.format(
+                            kind, self.done[kind], self.failed[kind],
+                            self.running[kind],
+                            self.total[kind] - self.done[kind] -
+                            self.failed[kind] - self.running[kind],
+                            'skipped' if final else 'queued'))
+            logging.info('{}/{} appliances finished, {:.1f} per hour'.format(
+                self.finished_apps, len(self.apps),
+                self.finished_apps / hours if hours else 0))
+
+    def summary(self, jobs, fp):
+        for app in sorted(self.apps):
+            fields = [app]
+            for kind in (BUILD, INSTALL):
+                key = '{}:{}'.format(kind, app)
+                if key in self.results:
+                    ok, duration = self.results[key]
+                    fields.append('{}={}:{:.0f}s'.format(
+                        kind, 'ok' if ok else 'failed', duration))
+                elif any(job.key == key for job in jobs):
+                    fields.append('{}=skipped'.format(kind))
+            fp.write(' '.join(fields) + '\n')
+
+
+def build_all(apps, fab_dir, log_dir, output_dir, limits, git=None,
+              build_args=()):
+    """
+    Build and install apps, a list of (appliance, repository, branch)
+    tuples, running at most limits[resource] jobs using each resource.
+
+    Return (ok, progress) tuple.
+    """
+    # Paths are given to processes which may change directory
+    log_dir = os.path.abspath(log_dir)
+    if output_dir:
+        output_dir = os.path.abspath(output_dir)
+    jobs = plan_jobs(apps, fab_dir, output_dir, git, build_args)
+    progress = Progress(jobs)
+    for path in (log_dir, output_dir):
+        if path and not os.path.isdir(path):
+            os.makedirs(path)
+
+    def run(job):
+        log_path = os.path.join(log_dir, '{}.{}.log'.format(job.app, job.kind))
+        logging.info('Starting {}, logging to {}'.format(job.key, log_path))
+        progress.start(job)
+        clock = time.time()
+        with tracing.span(job.key, BUILD) as attrs:
+            with open(os.devnull, 'r') as devnull, \
+                    open(log_path, 'w') as log:
+                ret = subprocess.Popen(job.cmd, stdin=devnull, stdout=log,
+                                       stderr=subprocess.STDOUT,
+                                       close_fds=True).wait()
+            attrs['ret'] = ret
+        ok = ret == 0
+        progress.finish(job, ok, time.time() - clock)
+        if ok:
+            logging.info('Finished {}'.format(job.key))
+            return True, None
+        logging.error('{} failed with error code {}, see {}'.format(
+            job.key, ret, log_path))
+        return False, log_path
+
+    stop = threading.Event()
+
+    def reporter():
+        while not stop.wait(REPORT_SEC):
+            progress.report()
+
+    thread = threading.Thread(target=reporter)
+    thread.daemon = True
+    thread.start()
+    try:
+        ok, _, _ = run_graph(jobs, run, sum(limits.values()), keep_going=True,
+                             limits=limits)
+    finally:
+        stop.set()
+    progress.report(final=True)
+    progress.summary(jobs, sys.stdout)
+    return ok, progress
@@ -1,6 +1,10 @@
 #!/usr/bin/env python2
 """
 Cleanup EC2 objects left behind by the factory.
+
+The tagged objects are searched with one describe call per resource type,
+the instances are terminated in batches, and the volumes are detached
+together then deleted concurrently.
 """
 from __future__ import division, absolute_import, print_function, unicode_literals
 
@@ -8,11 +12,13 @@ import json
 import sys
 import optparse
 import logging
+import time
 
 import boto.ec2
 import boto.exception
 
-from outscale_image_factory.create_ami import destroy_volume
+from outscale_image_factory import tracing
+from outscale_image_factory.create_ami import destroy_volumes
 
 
 USAGE = '''
@@ -22,43 +28,107 @@ USAGE = '''
 
 # Defaults
 REGION = 'eu-west-1'
+JOBS = 8
+
+# Instances terminated per TerminateInstances call
+TERMINATE_BATCH = 100
+# States of the instances left to terminate
+_LIVE_STATES = ['pending', 'running', 'stopping', 'stopped']
+
+
+def _tagged(objs, tags):
+    """
+    Return the objects of objs tagged with at least one pair of tags.
+    """
+    return [obj for obj in objs
+            if any(obj.tags.get(key) == value for key, value in tags.items())]
+
+
+def find_tagged(conn, tags):
+    """
+    Return (volumes, instances) tuple of the objects tagged with at least
+    one key/value pair of the tags dict.
+
+    EC2 filters on several tags match objects holding all of them: the
+    objects holding any of the tag keys are listed, one describe call per
+    resource type, and their values are matched here.
+    """
+    filters = {'tag-key': sorted(tags)}
+    volumes = _tagged(conn.get_all_volumes(filters=filters), tags)
+    filters['instance-state-name'] = _LIVE_STATES
+    reservations = conn.get_all_instances(filters=filters)
+    instances = _tagged([i for r in reservations for i in r.instances], tags)
+    return volumes, instances
+
 
+def terminate_instances(conn, instance_ids, batch=TERMINATE_BATCH):
+    """
+    Terminate the instances, batch per call. A failed batch is retried one
+    instance at a time.
 
-def search_and_destroy(conn, key, value, dryrun=False):
+    Return dict of instance ids to errors.
     """
-    Search & destroy all EC2 volumes and instances tagged with key and value.
+    errors = {}
+    for start in range(0, len(instance_ids), batch):
+        ids = instance_ids[start:start + batch]
+        try:
+            conn.terminate_instances(instance_ids=ids)
+            continue
+        except (boto.exception.BotoClientError,
+                boto.exception.BotoServerError) as error:
+            if len(ids) == 1:
+                errors[ids[0]] = error
+                continue
+        for instance_id in ids:
+            try:
+                conn.terminate_instances(instance_ids=[instance_id])
+            except (boto.exception.BotoClientError,
+                    boto.exception.BotoServerError) as error:
+                errors[instance_id] = error
+    for instance_id, error in sorted(errors.items()):
+        logging.error('Error while destroying {}: {}'.format(instance_id,
+                                                             repr(error)))
+    return errors
+
+
+def search_and_destroy(conn, tags, dryrun=False, jobs=JOBS):
     """
-    filters = {'tag:' + key: value}
-    volume_list = []
-    instance_list = []
+    Search & destroy all EC2 volumes and instances tagged with at least one
+    key/value pair of the tags dict.
 
-    logging.info('Searching for volumes and instances matching {}'
-                 .format(repr(filters)))
+    Return a summary dict: the numbers of instances and volumes found, of
+    those removed and of errors, and the duration in seconds.
+    """
+    clock = time.time()
+    summary = dict(instances=0, volumes=0, removed_instances=0,
+                   removed_volumes=0, errors=0)
+    logging.info('Searching for volumes and instances tagged with {}'
+                 .format(repr(tags)))
     try:
-        volume_list = conn.get_all_volumes(filters=filters)
-        reservations = conn.get_all_instances(filters=filters)
-        instance_list = [i for r in reservations for i in r.instances]
+        volume_list, instance_list = find_tagged(conn, tags)
     except (
             boto.exception.BotoClientError,
             boto.exception.BotoServerError) as search_error:
-        logging.error('Error while searching: filters={} error={}'
-                      .format(repr(filters), repr(search_error)))
+        logging.error('Error while searching: tags={} error={}'
+                      .format(repr(tags), repr(search_error)))
+        summary.update(errors=1, seconds=time.time() - clock)
+        return summary
+    summary.update(instances=len(instance_list), volumes=len(volume_list))
 
     logging.info('Terminating instances: {}'.format(repr(instance_list)))
-    for instance in instance_list:
-        if dryrun:
-            continue
-        try:
-            instance.terminate()
-        except Exception as terminate_error:
-            logging.error('Error while destroying {}: {}'
-                          .format(instance.id, repr(terminate_error)))
+    if instance_list and not dryrun:
+        errors = terminate_instances(
+            conn, [instance.id for instance in instance_list])
+        summary['removed_instances'] = len(instance_list) - len(errors)
+        summary['errors'] += len(errors)
 
     logging.info('Destroying volumes: {}'.format(repr(volume_list)))
-    for volume in volume_list:
-        if dryrun:
-            continue
-        destroy_volume(conn, volume.id)
+    if volume_list and not dryrun:
+        _, errors = destroy_volumes(conn, volume_list, jobs)
+        summary['removed_volumes'] = len(volume_list) - len(errors)
+        summary['errors'] += len(errors)
+    summary['seconds'] = time.time() - clock
+    return summary
 
 
 def main():
@@ -69,6 +139,8 @@ def main():
     parser.add_option('-r', '--region', default=REGION)
     parser.add_option('-t', '--tags', metavar='JSON', default=None)
     parser.add_option('-n', '--dryrun', action='store_true', default=False)
+    parser.add_option('-j', '--jobs', type='int', default=JOBS,
+                      help='volumes deleted at the same time [default: %default]')
     parser.add_option(
         '-v',
         '--verbose',
@@ -80,6 +152,9 @@ def main():
     if not opt.tags:
         parser.print_help()
         sys.exit(1)
+    if opt.jobs < 1:
+        parser.error('option -j: {} is not a positive integer'
+                     .format(opt.jobs))
 
     loglevel = boto_loglevel = logging.WARNING
     if opt.verbose > 0:
@@ -91,12 +166,22 @@ def main():
     logging.basicConfig(format='%(levelname)s:%(message)s', level=loglevel)
     logging.getLogger('boto').setLevel(boto_loglevel)
 
-    conn = boto.ec2.connect_to_region(REGION)
+    conn = tracing.trace_connection(boto.ec2.connect_to_region(opt.region))
     tags = json.loads(opt.tags)
     logging.debug(tags)
-    for k in tags:
-        v = tags[k]
-        search_and_destroy(conn, k, v, opt.dryrun)
+    summary = search_and_destroy(conn, tags, opt.dryrun, opt.jobs)
+    if opt.dryrun:
+        print('Found {} instances and {} volumes in {:.1f}s'.format(
+            summary['instances'], summary['volumes'], summary['seconds']))
+    else:
+        print('Removed {} of {} instances and {} of {} volumes in {:.1f}s, '
+              '{} errors'.format(summary['removed_instances'],
+                                 summary['instances'],
+                                 summary['removed_volumes'],
+                                 summary['volumes'], summary['seconds'],
+                                 summary['errors']))
+    if summary['errors']:
+        sys.exit(1)
 
 
 if __name__ == '__main__':
@@ -1,4 +1,5 @@
 import os
+import tempfile
 
 from ConfigParser import SafeConfigParser, NoSectionError
 
@@ -10,7 +11,18 @@ _DEFAULTS = {
     'region': 'eu-west-1',
     'volume-location': 'eu-west-1a',
     'root-dev': '/dev/sda1',
-    'image-arch': 'x86_64'
+    'image-arch': 'x86_64',
+    'volume-pool-size': '0',
+    'partition-headroom': '0.3',
+    'device-names': 'sd',
+    'device-lease-file': os.path.join(tempfile.gettempdir(),
+                                      'omi-factory-devices.json'),
+    'git-mirror-dir': '/var/cache/omi-factory/git',
+    'rootfs-cache-dir': '/var/cache/omi-factory/rootfs',
+    'rootfs-cache-gib': '20',
+    'apt-cache-dir': '/var/cache/omi-factory/apt',
+    'apt-cache-gib': '10',
+    'github-cache-dir': os.path.expanduser('~/.cache/omi-factory/github'),
 }
 
 
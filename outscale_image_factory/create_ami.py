@@ -4,20 +4,32 @@ Create a VM image from a build volume.
 """
 from __future__ import division, absolute_import, print_function, unicode_literals
 
-import time
 import logging
 import json
+import os
+import subprocess
 import sys
+import tempfile
+import time
 import urllib2
+from multiprocessing.pool import ThreadPool
 
 import boto.ec2
 import boto.exception
 
 from outscale_image_factory import config
+from outscale_image_factory import device_lease
+from outscale_image_factory import tracing
+from outscale_image_factory import waiter
+from outscale_image_factory.helper import check_cmd, file_lock
+from outscale_image_factory.install import _wait_for_file, \
+    plan_partition_table, volume_size_gib
+from outscale_image_factory.journal import Journal
 
 
 # Status strings
 AVAILABLE = 'available'
+IN_USE = 'in-use'
 STOPPED = 'stopped'
 RUNNING = 'running'
 
@@ -26,6 +38,26 @@ SNAPSHOT_PENDING = 'pending'
 SNAPSHOT_ERROR = 'error'
 SNAPSHOT_COMPLETED = 'completed'
 
+# Errors attaching a volume to a device name already used on the instance
+DEVICE_IN_USE_ERRORS = ('InvalidParameterValue',)
+
+# Tag holding the appliance name of images, used by incremental builds
+APPLIANCE_TAG = 'omi-factory:appliance'
+# Tag holding the fingerprint of the rootfs of images, see fingerprint.py
+FINGERPRINT_TAG = 'omi-factory:fingerprint'
+
+# Volume pool tags and states
+POOL_TAG = 'omi-factory:pool'
+POOL_STATE_TAG = 'omi-factory:pool-state'
+POOL_READY = 'ready'
+POOL_DIRTY = 'dirty'
+# Errors claiming or deleting a pool volume taken by another buildslave
+POOL_LOST_ERRORS = ('IncorrectState', 'VolumeInUse', 'InvalidVolume.NotFound')
+POOL_REFILL_LOCK = os.path.join(tempfile.gettempdir(),
+                                'omi-factory-pool-refill.lock')
+POOL_REFILL_LOG = os.path.join(tempfile.gettempdir(),
+                               'omi-factory-pool-refill.log')
+
 
 class _OIFError(Exception):
 
@@ -41,6 +73,10 @@ class _TimeoutError(_OIFError):
     pass
 
 
+class _StateError(_OIFError):
+    pass
+
+
 class _FindError(_OIFError):
     pass
 
@@ -49,30 +85,49 @@ class _DeviceAllocationError(_OIFError):
     pass
 
 
-def _wait_for(obj, target_state, poll_sec=1.5, wait_sec=600):
+def _wait_for(obj, target_state, wait_sec=600):
     """
     Wait for object to change state.
 
+    The polling interval depends on the type of the object, see the waiter
+    module.
+
     Raise _TimeoutError on failure.
     """
-    def _state(x):
-        return x.state if hasattr(x, 'state') else x.status
-
-    def _logstate(x):
-        logging.debug('{} state={}'.format(x.id, repr(_state(x))))
-
-    clock = 0
-    logging.info('Waiting for ' + obj.id)
-    _logstate(obj)
-    while _state(obj) != target_state and clock < wait_sec:
-        _logstate(obj)
-        time.sleep(poll_sec)
-        clock += poll_sec
-        obj.update()
-    if _state(obj) != target_state:
+    _wait_for_all(obj.connection, [obj], target_state, wait_sec)
+
+
+def _wait_for_all(conn, objs, target_state, wait_sec=600):
+    """
+    Wait for several objects to change state.
+
+    Objects are polled together by the WaitCoordinator of the connection,
+    with one describe call per resource type and poll tick.
+
+    Raise _TimeoutError on failure.
+    """
+    with tracing.span('wait ' + target_state, 'wait',
+                      ids=[obj.id for obj in objs]):
+        results = waiter.coordinator(conn).wait_all(objs, target_state,
+                                                    wait_sec)
+    for obj, ok in zip(objs, results):
+        if ok:
+            continue
+        state = waiter.state(obj)
+        if state in waiter.ERROR_STATES:
+            raise _StateError('{} entered state {} while waiting for {}'
+                              .format(repr(obj.id), repr(state),
+                                      repr(target_state)))
         raise _TimeoutError('timeout while waiting for ' + repr(obj.id))
 
 
+def _connect(region):
+    """
+    Return a connection to an EC2 region, traced if tracing is enabled.
+    """
+    return tracing.trace_connection(boto.ec2.connect_to_region(region))
+
+
 def _find_volume(conn, volume_id=None, instance_id=None):
     """
     Return list of volume objects.
@@ -91,31 +146,67 @@ def _find_volume(conn, volume_id=None, instance_id=None):
     return volume_list
 
 
-def _allocate_device(conn, instance_id, device_name_blacklist=set(),
-                     prefix='/dev/sd', start='b', stop='z'):
+def _attached_devices(conn, instance_id):
     """
-    Return first free device name on instance.
-
-    Start search at /dev/sdb and end at /dev/sdz by default.
-
-    If all device names are allocated, raise _DeviceAllocationError.
+    Return the EC2 view of the attachments of an instance, as a dict of
+    device names to volume ids.
     """
     try:
         volumes = _find_volume(conn, instance_id=instance_id)
-    except _OIFError as volume_error:
-        logging.warn(repr(volume_error))
+    except _FindError:
         volumes = []
+    return dict((vol.attach_data.device, vol.id) for vol in volumes)
+
+
+def _device_leases(instance_id):
+    dct = config.load()
+    return device_lease.DeviceLeases(
+        dct['device-lease-file'], instance_id,
+        device_lease.NAME_RANGES[dct['device-names']])
+
+
+def _attach(conn, volume, instance_id):
+    """
+    Attach volume to instance, using a device name leased from the local
+    device table.
+
+    If the device name turns out to be in use, reconcile the table with EC2
+    and retry once.
+
+    Return the device name.
+    """
+    leases = _device_leases(instance_id)
 
-    used = set(vol.attach_data.device for vol in volumes)
-    used.update(device_name_blacklist)
-    suffix = ord(start)
-    dev = prefix + chr(suffix)
-    while dev in used and suffix < ord(stop):
-        suffix += 1
-        dev = prefix + chr(suffix)
-    if dev in used:
-        raise _DeviceAllocationError('No free device names')
-    return dev
+    def attached():
+        return _attached_devices(conn, instance_id)
+
+    try:
+        device = leases.allocate(volume.id, attached)
+        logging.info('Attaching volume to ' + repr((instance_id, device)))
+        try:
+            volume.attach(instance_id, device)
+        except boto.exception.EC2ResponseError as error:
+            leases.release(volume.id)
+            if error.error_code not in DEVICE_IN_USE_ERRORS:
+                raise
+            logging.warn('Device {} is already in use, reconciling device '
+                         'leases'.format(device))
+            leases.reconcile(attached())
+            device = leases.allocate(volume.id, attached)
+            logging.info('Attaching volume to ' + repr((instance_id, device)))
+            volume.attach(instance_id, device)
+    except device_lease.DeviceAllocationError as error:
+        raise _DeviceAllocationError(str(error))
+    return device
+
+
+def _release_device(volume):
+    """
+    Release the device leased to a volume, before detaching it.
+    """
+    attach_data = getattr(volume, 'attach_data', None)
+    if attach_data is not None and attach_data.instance_id:
+        _device_leases(attach_data.instance_id).release(volume.id)
 
 
 def _tag(conn, object_id, tags_dict):
@@ -127,16 +218,64 @@ def _tag(conn, object_id, tags_dict):
         conn.create_tags(object_id, tags_dict)
 
 
+def _exists(describe, id_filter, object_id, **filters):
+    """
+    Return True if the object exists and matches filters. Used to check that
+    the outputs recorded in a build journal are still valid.
+    """
+    filters[id_filter] = object_id
+    return bool(describe(filters=filters))
+
+
 def _get_instance_id():
     fp = urllib2.urlopen('http://169.254.169.254/latest/meta-data/instance-id')
     return fp.read()
 
 
+def find_appliance_snapshot(conn, appliance):
+    """
+    Return the root snapshot of the most recent image of an appliance, or
+    None.
+    """
+    images = conn.get_all_images(filters={'tag:' + APPLIANCE_TAG: appliance})
+    snapshot_ids = set()
+    for image in images:
+        bdm = image.block_device_mapping or {}
+        root = bdm.get(image.root_device_name)
+        if root is not None and root.snapshot_id:
+            snapshot_ids.add(root.snapshot_id)
+    if not snapshot_ids:
+        return None
+    snapshots = conn.get_all_snapshots(snapshot_ids=sorted(snapshot_ids))
+    snapshots = [snap for snap in snapshots
+                 if snap.status == SNAPSHOT_COMPLETED]
+    if not snapshots:
+        return None
+    return max(snapshots, key=lambda snap: snap.start_time)
+
+
+def find_fingerprint_image(conn, fingerprint):
+    """
+    Return the id of an available image built from a rootfs with this
+    fingerprint, or None.
+    """
+    images = conn.get_all_images(filters={'tag:' + FINGERPRINT_TAG:
+                                          fingerprint,
+                                          'state': AVAILABLE})
+    if not images:
+        return None
+    return sorted(image.id for image in images)[0]
+
+
 def create_volume(conn, instance_id, volume_size_gib, volume_location,
-                  volume_tags=None):
+                  volume_tags=None, pool_size=0, snapshot_id=None):
     """
     Create a new volume and attach it to a buildslave.
 
+    If snapshot_id is set, the volume is created from that snapshot.
+    Otherwise if pool_size is not zero, try to lease a ready volume from the
+    volume pool first, see lease_pool_volume.
+
     Return on error or when the volume is attached.
 
     Return (volume_id,device,error) tuple.
@@ -147,17 +286,23 @@ def create_volume(conn, instance_id, volume_size_gib, volume_location,
     error = None
 
     try:
-        logging.info('Creating volume')
-        volume = conn.create_volume(volume_size_gib, volume_location)
+        volume = None
+        if pool_size > 0 and snapshot_id is None:
+            volume, device = lease_pool_volume(conn, instance_id,
+                                               volume_size_gib,
+                                               volume_location)
+        if volume is None:
+            logging.info('Creating volume')
+            volume = conn.create_volume(volume_size_gib, volume_location,
+                                        snapshot=snapshot_id)
+            volume_id = volume.id
+            _wait_for(volume, AVAILABLE)
         volume_id = volume.id
-        _wait_for(volume, AVAILABLE)
         _tag(conn, volume_id, volume_tags)
 
-        logging.info('Allocating device name')
-        device = _allocate_device(conn, instance_id)
-
-        logging.info('Attaching volume to ' + repr((instance_id, device)))
-        volume.attach(instance_id, device)
+        if device is None:
+            logging.info('Allocating device name')
+            device = _attach(conn, volume, instance_id)
         _wait_for(volume, AVAILABLE)
 
     except (_OIFError,
@@ -181,25 +326,81 @@ def create_volume(conn, instance_id, volume_size_gib, volume_location,
     return volume_id, device, error
 
 
+def fit_volume_size(path):
+    """
+    Return the size in GiB of the smallest volume holding path, a rootfs
+    directory or a raw disk image.
+    """
+    if os.path.isdir(path):
+        return volume_size_gib(plan_partition_table(path))
+    gib = 1024 * 1024 * 1024
+    return (os.path.getsize(path) + gib - 1) // gib
+
+
 def cmd_create_volume(args):
     tags = json.loads(args.tags)
-    conn = boto.ec2.connect_to_region(args.region)
+    volume_size = args.volume_size
+    if args.fit:
+        volume_size = max(volume_size or 0, fit_volume_size(args.fit))
+        logging.info('Volume size fitting {} is {} GiB'
+                     .format(args.fit, volume_size))
+    if volume_size is None:
+        logging.error('Either VOLUME_SIZE or --fit is required')
+        return False
+    conn = _connect(args.region)
     if args.instance_id:
         instance_id = args.instance_id
     else:
         instance_id = _get_instance_id()
         logging.info('Instance id is {}'.format(instance_id))
+    journal = Journal(args.journal)
+    inputs = dict(instance_id=instance_id, volume_size=volume_size,
+                  volume_location=args.volume_location, tags=tags,
+                  incremental=args.incremental)
+    outputs = journal.get(
+        'create-volume', inputs,
+        valid=lambda out: _exists(conn.get_all_volumes, 'volume-id',
+                                  out['volume_id'],
+                                  **{'attachment.instance-id': instance_id}))
+    if outputs is not None:
+        _print_volume(outputs, args.incremental)
+        return True
+    snapshot = None
+    if args.incremental:
+        snapshot = find_appliance_snapshot(conn, args.incremental)
+        if snapshot is None:
+            logging.info('No previous image of {}, creating a blank volume'
+                         .format(args.incremental))
+        else:
+            logging.info('Creating volume from snapshot {} of {}'
+                         .format(snapshot.id, args.incremental))
+            volume_size = max(volume_size, snapshot.volume_size)
     volume_id, device, error = create_volume(conn,
                                              instance_id,
-                                             args.volume_size,
+                                             volume_size,
                                              args.volume_location,
-                                             tags)
+                                             tags,
+                                             args.pool_size,
+                                             snapshot and snapshot.id)
+    if args.pool_size > 0 and snapshot is None:
+        _spawn_pool_refill(args.region, instance_id, volume_size,
+                           args.volume_location, args.pool_size)
 
     if error is None:
-        sys.stdout.write('VOLUME_ID={}\nDEVICE={}\n' .format(volume_id, device))
+        outputs = dict(volume_id=volume_id, device=device,
+                       incremental=int(bool(snapshot)))
+        journal.record('create-volume', inputs, outputs)
+        _print_volume(outputs, args.incremental)
     return error is None
 
 
+def _print_volume(outputs, incremental):
+    sys.stdout.write('VOLUME_ID={volume_id}\nDEVICE={device}\n'
+                     .format(**outputs))
+    if incremental:
+        sys.stdout.write('INCREMENTAL={incremental}\n'.format(**outputs))
+
+
 def parser_create_volume(parser):
     dct = config.load()
     parser.description = 'Create and attach a new volume'
@@ -207,7 +408,19 @@ def parser_create_volume(parser):
     parser.add_argument('--volume-location', default=dct['volume-location'])
     parser.add_argument('--region', default=dct['region'])
     parser.add_argument('--tags', metavar='JSON', default='{}')
-    parser.add_argument('volume_size', metavar='VOLUME_SIZE',
+    parser.add_argument('--pool-size', type=int,
+                        default=int(dct['volume-pool-size']),
+                        help='Lease volumes from a pool of this size')
+    parser.add_argument('--incremental', metavar='APPLIANCE',
+                        help='Create the volume from the last image of '
+                        'APPLIANCE')
+    parser.add_argument('--journal', metavar='FILE',
+                        help='Record the volume in FILE, reuse it when run '
+                        'again')
+    parser.add_argument('--fit', metavar='PATH',
+                        help='Size the volume for PATH, a rootfs directory '
+                        'or a raw disk image; VOLUME_SIZE is then a minimum')
+    parser.add_argument('volume_size', metavar='VOLUME_SIZE', nargs='?',
                         type=int, help='Volume size in GiB')
 
 
@@ -227,6 +440,7 @@ def detach_volume(conn, volume_id):
         volume = _find_volume(conn, volume_id=volume_id)[0]
         if volume.status != AVAILABLE:
             logging.info('Detaching build volume ' + volume_id)
+            _release_device(volume)
             volume.detach()
             _wait_for(volume, AVAILABLE)
             ok = True
@@ -248,10 +462,14 @@ def detach_volume(conn, volume_id):
 
 
 def create_image(conn, image_name, volume_id, image_arch=None,
-                 image_description=None, tags=None, root_dev=None):
+                 image_description=None, tags=None, root_dev=None,
+                 journal=None):
     """
     Create a new machine image from a build volume.
 
+    journal: Journal used to reuse the snapshot or image created by a
+    previous run.
+
     Return (image_id, error) tuple.
 
 
@@ -264,20 +482,45 @@ def create_image(conn, image_name, volume_id, image_arch=None,
         image_arch = dct['image-arch']
     if root_dev is None:
         root_dev = dct['root-dev']
+    if journal is None:
+        journal = Journal()
 
     image_id = None
     error = None
     snapshot_id = None
 
     try:
-        volume = _find_volume(conn, volume_id=volume_id)[0]
-
-        logging.info('Creating snapshot from volume ' + volume_id)
-        snapshot = volume.create_snapshot('Backing image {} created from volume {}'
-                                          .format(repr(image_name), volume_id))
-        _wait_for(snapshot, SNAPSHOT_COMPLETED)
-        snapshot_id = snapshot.id
-        _tag(conn, snapshot_id, tags)
+        inputs = dict(volume_id=volume_id, image_name=image_name)
+        outputs = journal.get(
+            'create-snapshot', inputs,
+            valid=lambda out: _exists(conn.get_all_snapshots, 'snapshot-id',
+                                      out['snapshot_id'],
+                                      status=SNAPSHOT_COMPLETED))
+        if outputs is not None:
+            snapshot_id = outputs['snapshot_id']
+        else:
+            volume = _find_volume(conn, volume_id=volume_id)[0]
+
+            logging.info('Creating snapshot from volume ' + volume_id)
+            snapshot = volume.create_snapshot(
+                'Backing image {} created from volume {}'
+                .format(repr(image_name), volume_id))
+            _wait_for(snapshot, SNAPSHOT_COMPLETED)
+            snapshot_id = snapshot.id
+            _tag(conn, snapshot_id, tags)
+            journal.record('create-snapshot', inputs,
+                           dict(snapshot_id=snapshot_id))
+
+        inputs = dict(snapshot_id=snapshot_id, image_name=image_name,
+                      image_arch=image_arch,
+                      image_description=image_description, tags=tags,
+                      root_dev=root_dev)
+        outputs = journal.get(
+            'register-image', inputs,
+            valid=lambda out: _exists(conn.get_all_images, 'image-id',
+                                      out['image_id']))
+        if outputs is not None:
+            return outputs['image_id'], None
 
         logging.info(
             'Creating block device map : {} = {}'.format(root_dev, volume_id))
@@ -300,6 +543,7 @@ def create_image(conn, image_name, volume_id, image_arch=None,
             delete_root_volume_on_termination=True)
 
         _tag(conn, image_id, tags)
+        journal.record('register-image', inputs, dict(image_id=image_id))
 
     except (_OIFError,
             boto.exception.BotoClientError,
@@ -315,14 +559,31 @@ def create_image(conn, image_name, volume_id, image_arch=None,
 
 def cmd_create_image(args):
     tags = json.loads(args.tags)
-    conn = boto.ec2.connect_to_region(args.region)
-    ok, _ = detach_volume(conn, args.volume_id)
-    if not ok:
-        return False
-    image_id, error = create_image(conn, args.image_name, args.volume_id,
+    if args.appliance:
+        tags[APPLIANCE_TAG] = args.appliance
+    conn = _connect(args.region)
+    journal = Journal(args.journal)
+    fingerprint = args.fingerprint
+    if fingerprint is None:
+        fingerprint = (journal.outputs('fingerprint') or {}).get('fingerprint')
+    if fingerprint:
+        tags[FINGERPRINT_TAG] = fingerprint
+    volume_id = args.volume_id
+    if volume_id is None:
+        volume_id = (journal.outputs('create-volume') or {}).get('volume_id')
+    inputs = dict(volume_id=volume_id)
+    if journal.get('detach-volume', inputs,
+                   valid=lambda _: _exists(conn.get_all_volumes, 'volume-id',
+                                           volume_id,
+                                           status=AVAILABLE)) is None:
+        ok, _ = detach_volume(conn, volume_id)
+        if not ok:
+            return False
+        journal.record('detach-volume', inputs)
+    image_id, error = create_image(conn, args.image_name, volume_id,
                                    args.image_arch,
                                    args.image_description,
-                                   tags)
+                                   tags, journal=journal)
     return error is None
 
 
@@ -334,6 +595,16 @@ def parser_create_image(parser):
     parser.add_argument('--volume-id', default=None)
     parser.add_argument('--image-description', default=None)
     parser.add_argument('--image-arch', default=dct['image-arch'])
+    parser.add_argument('--appliance',
+                        help='Appliance name, for incremental builds')
+    parser.add_argument('--fingerprint',
+                        help='Rootfs fingerprint printed by tkl-install-iso, '
+                        'to reuse the image for identical builds')
+    parser.add_argument('--journal', metavar='FILE',
+                        help='Record completed steps in FILE, skip them '
+                        'when run again; the volume and fingerprint default '
+                        'to the ones recorded by create-volume and '
+                        'tkl-install-iso')
     parser.add_argument('--region', default=dct['region'])
     parser.add_argument('--tags', metavar='JSON', default='{}')
 
@@ -353,6 +624,7 @@ def destroy_volume(conn, volume_id):
         if volume.status != AVAILABLE:
             logging.info(
                 'Detaching volume {} before destroying'.format(volume_id))
+            _release_device(volume)
             volume.detach()
             _wait_for(volume, AVAILABLE)
 
@@ -372,9 +644,20 @@ def destroy_volume(conn, volume_id):
 
 
 def cmd_destroy_volume(args):
-    conn = boto.ec2.connect_to_region(args.region)
-    ok, _ = destroy_volume(conn, args.volume_id)
-    return ok
+    conn = _connect(args.region)
+    if not args.recycle:
+        ok, _ = destroy_volume(conn, args.volume_id)
+        return ok
+    if args.pool_size <= 0:
+        # Nothing would ever wipe or destroy the recycled volume
+        logging.info('Volume pool disabled, destroying the volume instead')
+        ok, _ = destroy_volume(conn, args.volume_id)
+        return ok
+    volume, error = recycle_volume(conn, args.volume_id)
+    if error is None:
+        _spawn_pool_refill(args.region, None, volume.size, volume.zone,
+                           args.pool_size)
+    return error is None
 
 
 def parser_destroy_volume(parser):
@@ -383,3 +666,302 @@ def parser_destroy_volume(parser):
     parser.description = 'Destroy an existing volume'
     parser.add_argument('volume_id', metavar='VOLUME_ID')
     parser.add_argument('--region', default=dct['region'])
+    parser.add_argument('--recycle', action='store_true',
+                        help='Return the volume to the volume pool')
+    parser.add_argument('--pool-size', type=int,
+                        default=int(dct['volume-pool-size']))
+
+
+def _delete_volume(volume):
+    try:
+        logging.info('Destroying volume ' + repr(volume.id))
+        volume.delete()
+    except (boto.exception.BotoClientError,
+            boto.exception.BotoServerError) as error:
+        return error
+    return None
+
+
+def destroy_volumes(conn, volumes, jobs=1):
+    """
+    Destroy several volumes at once.
+
+    All attached volumes are detached first, then waited for together.
+    The volumes are deleted jobs at a time.
+
+    Return (ok, errors) tuple, errors is a dict of volume ids to errors.
+    """
+    errors = {}
+    detaching = []
+    for volume in volumes:
+        if volume.status == AVAILABLE:
+            continue
+        try:
+            logging.info(
+                'Detaching volume {} before destroying'.format(volume.id))
+            _release_device(volume)
+            volume.detach()
+            detaching.append(volume)
+        except (boto.exception.BotoClientError,
+                boto.exception.BotoServerError) as error:
+            errors[volume.id] = error
+
+    if detaching:
+        try:
+            results = waiter.coordinator(conn).wait_all(detaching, AVAILABLE)
+        except (boto.exception.BotoClientError,
+                boto.exception.BotoServerError) as error:
+            results = [False] * len(detaching)
+            for volume in detaching:
+                errors[volume.id] = error
+        for volume, ok in zip(detaching, results):
+            if volume.id in errors:
+                continue
+            if not ok:
+                errors[volume.id] = _TimeoutError(
+                    'timeout while waiting for ' + repr(volume.id))
+
+    deletable = [volume for volume in volumes if volume.id not in errors]
+    if deletable:
+        pool = ThreadPool(max(1, min(jobs, len(deletable))))
+        try:
+            results = pool.map(_delete_volume, deletable)
+        finally:
+            pool.close()
+            pool.join()
+        for volume, error in zip(deletable, results):
+            if error is not None:
+                errors[volume.id] = error
+
+    for volume_id, error in sorted(errors.items()):
+        logging.error('Could not destroy volume {}: {}'.format(volume_id,
+                                                               error))
+    return not errors, errors
+
+
+def _pool_key(volume_size_gib, volume_location):
+    return '{}:{}'.format(volume_size_gib, volume_location)
+
+
+def _pool_volumes(conn, volume_size_gib, volume_location, pool_state):
+    filters = {
+        'tag:' + POOL_TAG: _pool_key(volume_size_gib, volume_location),
+        'tag:' + POOL_STATE_TAG: pool_state,
+        'status': AVAILABLE,
+    }
+    return conn.get_all_volumes(filters=filters)
+
+
+def _claim_pool_volume(conn, volume, instance_id):
+    """
+    Attach a pool volume to instance_id.
+
+    EC2 attaches a volume to one instance only: this is the claim on the
+    volume, shared by all the buildslaves.
+
+    Return the device name, or None if another buildslave claimed or
+    destroyed the volume first.
+    """
+    try:
+        return _attach(conn, volume, instance_id)
+    except boto.exception.EC2ResponseError as error:
+        if error.error_code not in POOL_LOST_ERRORS:
+            raise
+        logging.info('Volume {} claimed by another buildslave: {}'
+                     .format(volume.id, error.error_code))
+        return None
+
+
+def lease_pool_volume(conn, instance_id, volume_size_gib, volume_location):
+    """
+    Take a ready volume out of the volume pool and attach it to instance_id.
+
+    The ready volumes are claimed in turn until one is attached, see
+    _claim_pool_volume.
+
+    Return (volume, device) tuple, (None, None) if the pool is empty.
+    """
+    key = _pool_key(volume_size_gib, volume_location)
+    for volume in _pool_volumes(conn, volume_size_gib, volume_location,
+                                POOL_READY):
+        device = _claim_pool_volume(conn, volume, instance_id)
+        if device is None:
+            continue
+        conn.delete_tags(volume.id, {POOL_TAG: None, POOL_STATE_TAG: None})
+        logging.info('Volume pool {} hit: {}'.format(key, volume.id))
+        return volume, device
+    logging.info('Volume pool {} miss'.format(key))
+    return None, None
+
+
+def recycle_volume(conn, volume_id):
+    """
+    Return a build volume to the volume pool.
+
+    The volume is detached, stripped of its tags and marked dirty; it is wiped
+    by the next pool refill.
+
+    Return (volume, error) tuple.
+    """
+    volume = None
+    error = None
+
+    try:
+        volume = _find_volume(conn, volume_id=volume_id)[0]
+        if volume.status != AVAILABLE:
+            logging.info(
+                'Detaching volume {} before recycling'.format(volume_id))
+            _release_device(volume)
+            volume.detach()
+            _wait_for(volume, AVAILABLE)
+        if volume.tags:
+            conn.delete_tags(volume_id, dict((k, None) for k in volume.tags))
+        logging.info('Recycling volume ' + repr(volume_id))
+        _tag(conn, volume_id,
+             {POOL_TAG: _pool_key(volume.size, volume.zone),
+              POOL_STATE_TAG: POOL_DIRTY})
+
+    except (_OIFError,
+            boto.exception.BotoClientError,
+            boto.exception.BotoServerError) as error:
+        pass
+
+    if error:
+        logging.error('Could not recycle volume: {}'.format(error))
+
+    return volume, error
+
+
+def _wipe_volume(conn, instance_id, volume):
+    """
+    Attach a volume to the buildslave, zero it and detach it.
+
+    Return True on success, None if another buildslave claimed the volume.
+    """
+    device = _claim_pool_volume(conn, volume, instance_id)
+    if device is None:
+        return None
+    logging.info('Wiping volume {} on {}'.format(volume.id, device))
+    try:
+        _wait_for(volume, IN_USE)
+        ok = _wait_for_file(device)
+        if ok:
+            ok, _ = check_cmd('blkdiscard -z {}'.format(device))
+    finally:
+        _device_leases(instance_id).release(volume.id)
+        volume.detach()
+        _wait_for(volume, AVAILABLE)
+    return ok
+
+
+def refill_pool(conn, instance_id, volume_size_gib, volume_location,
+                pool_size):
+    """
+    Bring the volume pool back to pool_size ready volumes.
+
+    Dirty volumes are wiped, or destroyed if wiping fails. Missing volumes are
+    created, extra volumes are destroyed. Only one refill runs at a time on a
+    buildslave; volumes claimed by other buildslaves meanwhile are skipped.
+
+    Return (ok, error) tuple.
+    """
+    key = _pool_key(volume_size_gib, volume_location)
+    clock = time.time()
+    wiped = created = destroyed = 0
+    error = None
+
+    with file_lock(POOL_REFILL_LOCK, blocking=False) as locked:
+        if not locked:
+            logging.info('Volume pool {} refill already running'.format(key))
+            return True, None
+        try:
+            for volume in _pool_volumes(conn, volume_size_gib,
+                                        volume_location, POOL_DIRTY):
+                wiped_ok = _wipe_volume(conn, instance_id, volume)
+                if wiped_ok:
+                    _tag(conn, volume.id, {POOL_STATE_TAG: POOL_READY})
+                    wiped += 1
+                elif wiped_ok is not None:
+                    destroy_volume(conn, volume.id)
+
+            ready = _pool_volumes(conn, volume_size_gib, volume_location,
+                                  POOL_READY)
+            extra = ready[pool_size:]
+            # A volume leased meanwhile is attached and fails to delete
+            for volume in extra:
+                try:
+                    logging.info('Destroying volume ' + repr(volume.id))
+                    volume.delete()
+                    destroyed += 1
+                except boto.exception.EC2ResponseError as delete_error:
+                    if delete_error.error_code not in POOL_LOST_ERRORS:
+                        raise
+
+            volumes = []
+            for _ in range(pool_size - len(ready)):
+                volume = conn.create_volume(volume_size_gib, volume_location)
+                # Dirty until available, so that leaked volumes get recycled
+                _tag(conn, volume.id,
+                     {POOL_TAG: key, POOL_STATE_TAG: POOL_DIRTY})
+                volumes.append(volume)
+            _wait_for_all(conn, volumes, AVAILABLE)
+            for volume in volumes:
+                _tag(conn, volume.id, {POOL_STATE_TAG: POOL_READY})
+            created = len(volumes)
+
+        except (_OIFError,
+                boto.exception.BotoClientError,
+                boto.exception.BotoServerError) as error:
+            pass
+
+    logging.info('Volume pool {} refilled in {:.1f}s: {} created, {} wiped, '
+                 '{} destroyed'.format(key, time.time() - clock, created,
+                                       wiped, destroyed))
+    if error:
+        logging.error('Could not refill volume pool {}: {}'.format(key,
+                                                                  error))
+    return error is None, error
+
+
+def _spawn_pool_refill(region, instance_id, volume_size_gib, volume_location,
+                       pool_size):
+    """
+    Run the pool-refill command in the background.
+    """
+    if pool_size <= 0:
+        return
+    cmd = [sys.executable, '-m', 'outscale_image_factory.main', 'pool-refill',
+           '--region', region,
+           '--volume-location', volume_location,
+           '--pool-size', str(pool_size)]
+    if instance_id:
+        cmd += ['--instance-id', instance_id]
+    cmd.append(str(volume_size_gib))
+    logging.info('Refilling volume pool in the background, see ' +
+                 POOL_REFILL_LOG)
+    with open(os.devnull, 'r') as devnull, open(POOL_REFILL_LOG, 'a') as log:
+        subprocess.Popen(cmd, stdin=devnull, stdout=log, stderr=log,
+                         close_fds=True, preexec_fn=os.setsid)
+
+
+def cmd_pool_refill(args):
+    conn = _connect(args.region)
+    if args.instance_id:
+        instance_id = args.instance_id
+    else:
+        instance_id = _get_instance_id()
+    ok, _ = refill_pool(conn, instance_id, args.volume_size,
+                        args.volume_location, args.pool_size)
+    return ok
+
+
+def parser_pool_refill(parser):
+    dct = config.load()
+    parser.description = 'Fill the pool of ready build volumes'
+    parser.add_argument('--instance-id')
+    parser.add_argument('--volume-location', default=dct['volume-location'])
+    parser.add_argument('--region', default=dct['region'])
+    parser.add_argument('--pool-size', type=int,
+                        default=int(dct['volume-pool-size']))
+    parser.add_argument('volume_size', metavar='VOLUME_SIZE',
+                        type=int, help='Volume size in GiB')
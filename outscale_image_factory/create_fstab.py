@@ -21,13 +21,22 @@ def create_fstab(fstab_filename, root_device):
                 uuid = line
             elif line.startswith('TYPE'):
                 fstype = line.split('=')[1]
-        with open(fstab_filename, 'w') as fstab:
-            try:
-                fstab.write('# <file system> <mount point> <type> <options> <dump> <pass>\n')
-                fstab.write('{} / {} errors=remount-ro 0 1\n'.format(uuid, fstype))
-            except Exception as error:
-                ok = False
-                logging.error(error)
+        ok = write_fstab(fstab_filename, uuid, fstype)
+    return ok
+
+
+def write_fstab(fstab_filename, root_spec, fstype):
+    """
+    Write fstab with root filesystem root_spec, for example UUID=....
+    """
+    ok = True
+    with open(fstab_filename, 'w') as fstab:
+        try:
+            fstab.write('# <file system> <mount point> <type> <options> <dump> <pass>\n')
+            fstab.write('{} / {} errors=remount-ro 0 1\n'.format(root_spec, fstype))
+        except Exception as error:
+            ok = False
+            logging.error(error)
     return ok
 
 
@@ -0,0 +1,155 @@
+"""
+Local table of the device names leased to build volumes on a buildslave.
+
+The table is a JSON file protected by a file lock, so that concurrent builds
+on the same buildslave never pick the same device name. It is reconciled with
+the EC2 view of the instance attachments when the buildslave has rebooted,
+when all the device names are leased, or when an attachment fails because
+the device name is already in use.
+"""
+from __future__ import division, absolute_import, print_function, unicode_literals
+
+import json
+import logging
+import os
+import string
+import time
+
+from outscale_image_factory.helper import file_lock
+
+
+# Leases of volumes not yet seen attached by EC2 are kept for this long
+# during a reconciliation: they belong to attachments in progress.
+PENDING_LEASE_SEC = 600
+
+
+def _letters(start, stop):
+    return string.ascii_lowercase[string.ascii_lowercase.index(start):
+                                  string.ascii_lowercase.index(stop) + 1]
+
+
+# Device name ranges
+NAME_RANGES = {
+    'sd': ['/dev/sd' + c for c in _letters('b', 'z')],
+    'xvd': ['/dev/xvd' + c for c in _letters('b', 'z')] +
+           ['/dev/xvd' + c + d for c in _letters('b', 'z')
+            for d in _letters('a', 'z')],
+}
+
+
+def _boot_id():
+    try:
+        with open('/proc/sys/kernel/random/boot_id') as fp:
+            return fp.read().strip()
+    except IOError:
+        return None
+
+
+class DeviceAllocationError(Exception):
+    pass
+
+
+class DeviceLeases(object):
+
+    """
+    Device name leases of one instance.
+
+    The JSON file holds, for each instance, the leased devices and the list of
+    free devices, so that an allocation just pops the head of the free list.
+    """
+
+    def __init__(self, path, instance_id, names=NAME_RANGES['sd']):
+        self.path = path
+        self.instance_id = instance_id
+        self.names = list(names)
+
+    def _load(self):
+        try:
+            with open(self.path) as fp:
+                table = json.load(fp)
+        except (IOError, ValueError):
+            table = {}
+        if table.get('boot_id') != _boot_id():
+            # Leases do not survive a reboot
+            table = {'boot_id': _boot_id(), 'instances': {}}
+        return table
+
+    def _save(self, table):
+        tmp = self.path + '.tmp'
+        with open(tmp, 'w') as fp:
+            json.dump(table, fp, sort_keys=True)
+        os.rename(tmp, self.path)
+
+    def _reconcile(self, table, attached):
+        """
+        Rebuild the leases of the instance from attached, a dict mapping the
+        devices attached according to EC2 to volume ids.
+        """
+        old = table['instances'].get(self.instance_id, {}).get('leases', {})
+        now = time.time()
+        leases = dict((dev, {'volume_id': vol, 'time': now})
+                      for dev, vol in attached.items())
+        seen = set(attached.values())
+        for dev, lease in old.items():
+            if dev not in leases and lease['volume_id'] not in seen and \
+                    now - lease['time'] < PENDING_LEASE_SEC:
+                leases[dev] = lease
+        free = [dev for dev in self.names if dev not in leases]
+        table['instances'][self.instance_id] = dict(leases=leases, free=free)
+        logging.info('Reconciled device leases of {}: {} leased, {} free'
+                     .format(self.instance_id, len(leases), len(free)))
+
+    def allocate(self, volume_id, attached):
+        """
+        Lease a free device name to volume_id.
+
+        attached: function returning the EC2 view of the instance attachments
+        as a dict of device names to volume ids. It is only called when the
+        table has no entry for the instance, or no free device name: the
+        leases of the builds killed before releasing them are then dropped.
+
+        Raise DeviceAllocationError if all device names are leased.
+        """
+        with file_lock(self.path + '.lock'):
+            table = self._load()
+            if self.instance_id not in table['instances']:
+                self._reconcile(table, attached())
+            entry = table['instances'][self.instance_id]
+            if not entry['free']:
+                self._reconcile(table, attached())
+                entry = table['instances'][self.instance_id]
+            if not entry['free']:
+                self._save(table)
+                raise DeviceAllocationError('No free device names')
+            dev = entry['free'].pop(0)
+            entry['leases'][dev] = {'volume_id': volume_id,
+                                    'time': time.time()}
+            self._save(table)
+        logging.debug('Leased {} to {}'.format(dev, volume_id))
+        return dev
+
+    def reconcile(self, attached):
+        """
+        Rebuild the leases of the instance from the dict of attached devices.
+        """
+        with file_lock(self.path + '.lock'):
+            table = self._load()
+            self._reconcile(table, attached)
+            self._save(table)
+
+    def release(self, volume_id):
+        """
+        Release the device leased to volume_id, if any.
+        """
+        with file_lock(self.path + '.lock'):
+            table = self._load()
+            entry = table['instances'].get(self.instance_id)
+            if entry is None:
+                return
+            for dev, lease in list(entry['leases'].items()):
+                if lease['volume_id'] == volume_id:
+                    del entry['leases'][dev]
+                    entry['free'].append(dev)
+                    logging.debug('Released {} from {}'.format(dev,
+                                                               volume_id))
+            self._save(table)
@@ -0,0 +1,578 @@
+"""
+Local stand-in for the EC2 API, for tests and benchmarks.
+
+FakeEC2 runs a threaded HTTP server speaking the subset of the EC2 query API
+used by the factory: volumes, attachments, snapshots, images, instances and
+tags. Objects go through the usual state transitions after configurable
+delays, and requests can be slowed down or made to fail at random. Every
+request is counted by action, so that changes to the factory can be measured
+offline.
+
+Usage:
+
+    fake = FakeEC2(delays=dict(create_volume=0.1))
+    fake.start()
+    conn = fake.connect()
+    ...
+    fake.stop()
+"""
+from __future__ import division, absolute_import, print_function, unicode_literals
+
+import BaseHTTPServer
+import SocketServer
+import collections
+import logging
+import random
+import threading
+import time
+import urlparse
+import uuid
+
+from xml.sax.saxutils import escape
+
+import boto.ec2.connection
+from boto.regioninfo import RegionInfo
+
+
+# Seconds before each state transition
+DEFAULT_DELAYS = {
+    'create_volume': 1.0,
+    'attach': 0.5,
+    'detach': 0.5,
+    'delete_volume': 0.5,
+    'snapshot_per_gib': 0.3,
+    'register_image': 1.0,
+    'terminate': 1.0,
+}
+
+_XMLNS = 'http://ec2.amazonaws.com/doc/2014-10-01/'
+
+
+class _APIError(Exception):
+
+    def __init__(self, code, message, status=400):
+        super(_APIError, self).__init__(message)
+        self.code = code
+        self.message = message
+        self.status = status
+
+
+def _now_iso(clock):
+    return time.strftime('%Y-%m-%dT%H:%M:%S.000Z', time.gmtime(clock))
+
+
+def _new_id(prefix):
+    return '{}-{}'.format(prefix, uuid.uuid4().hex[:8])
+
+
+def _x(tag, value):
+    if value is None:
+        return ''
+    if isinstance(value, bool):
+        value = 'true' if value else 'false'
+    return '<{0}>{1}</{0}>'.format(tag, escape('{}'.format(value)))
+
+
+def _tag_set(tags):
+    return '<tagSet>{}</tagSet>'.format(''.join(
+        '<item>{}{}</item>'.format(_x('key', k), _x('value', v))
+        for k, v in sorted(tags.items())))
+
+
+def _indexed(params, prefix):
+    """
+    Return the values of the Prefix.1, Prefix.2... parameters.
+    """
+    values = []
+    i = 1
+    while '{}.{}'.format(prefix, i) in params:
+        values.append(params['{}.{}'.format(prefix, i)])
+        i += 1
+    return values
+
+
+def _filters(params):
+    """
+    Return the Filter.N.Name/Filter.N.Value.M parameters as a dict of lists.
+    """
+    filters = {}
+    i = 1
+    while 'Filter.{}.Name'.format(i) in params:
+        name = params['Filter.{}.Name'.format(i)]
+        filters[name] = _indexed(params, 'Filter.{}.Value'.format(i))
+        i += 1
+    return filters
+
+
+def _match(obj, filters, fields):
+    for name, values in filters.items():
+        if name.startswith('tag:'):
+            actual = [obj['tags'].get(name[4:])]
+        elif name == 'tag-key':
+            actual = list(obj['tags'].keys())
+        elif name == 'tag-value':
+            actual = list(obj['tags'].values())
+        elif name in fields:
+            actual = [fields[name](obj)]
+        else:
+            raise _APIError('InvalidParameterValue',
+                            'The filter {} is invalid'.format(name))
+        if not set('{}'.format(a) for a in actual if a is not None) & \
+                set(values):
+            return False
+    return True
+
+
+def _attachment(field):
+    return lambda vol: vol['attachment'] and vol['attachment'][field]
+
+
+_VOLUME_FIELDS = {
+    'volume-id': lambda vol: vol['id'],
+    'status': lambda vol: vol['status'],
+    'size': lambda vol: vol['size'],
+    'availability-zone': lambda vol: vol['zone'],
+    'snapshot-id': lambda vol: vol['snapshot_id'],
+    'attachment.instance-id': _attachment('instance_id'),
+    'attachment.device': _attachment('device'),
+    'attachment.status': _attachment('status'),
+}
+
+_SNAPSHOT_FIELDS = {
+    'snapshot-id': lambda snap: snap['id'],
+    'status': lambda snap: snap['status'],
+    'volume-id': lambda snap: snap['volume_id'],
+}
+
+_IMAGE_FIELDS = {
+    'image-id': lambda img: img['id'],
+    'state': lambda img: img['state'],
+    'name': lambda img: img['name'],
+}
+
+_INSTANCE_FIELDS = {
+    'instance-id': lambda inst: inst['id'],
+    'instance-state-name': lambda inst: inst['state'],
+}
+
+
+class FakeEC2(object):
+
+    """
+    In-memory EC2 service.
+
+    delays: dict overriding DEFAULT_DELAYS.
+    latency: seconds added to every request.
+    failure_rate: probability of a request failing with a 503 error.
+    error_rate: probability of a new volume or snapshot ending up in the
+    `error` state.
+    """
+
+    def __init__(self, delays=None, latency=0.0, failure_rate=0.0,
+                 error_rate=0.0, seed=None):
+        self.delays = dict(DEFAULT_DELAYS)
+        self.delays.update(delays or {})
+        self.latency = latency
+        self.failure_rate = failure_rate
+        self.error_rate = error_rate
+        self.random = random.Random(seed)
+        self.calls = collections.Counter()
+        self.volumes = {}
+        self.snapshots = {}
+        self.images = {}
+        self.instances = {}
+        self._lock = threading.RLock()
+        self._server = None
+        self._thread = None
+
+    # Server
+
+    def start(self, host='127.0.0.1', port=0):
+        """
+        Start serving in a background thread. Return the port.
+        """
+        fake = self
+
+        class Handler(_Handler):
+            ec2 = fake
+
+        self._server = _Server((host, port), Handler)
+        self._thread = threading.Thread(target=self._server.serve_forever,
+                                        name='fake-ec2')
+        self._thread.daemon = True
+        self._thread.start()
+        return self.port
+
+    def stop(self):
+        if self._server is not None:
+            self._server.shutdown()
+            self._server.server_close()
+            self._server = None
+
+    @property
+    def port(self):
+        return self._server.server_address[1]
+
+    def connect(self, **kwargs):
+        """
+        Return a boto EC2 connection to this service.
+        """
+        region = RegionInfo(name='fake', endpoint=self._server.server_address[0])
+        return boto.ec2.connection.EC2Connection(
+            aws_access_key_id='fake', aws_secret_access_key='fake',
+            region=region, port=self.port, is_secure=False,
+            proxy=None, proxy_port=None, **kwargs)
+
+    # Direct access, bypassing the API
+
+    def add_instance(self, tags=None):
+        """
+        Create a running instance. Return its id.
+        """
+        with self._lock:
+            inst = dict(id=_new_id('i'), state='running', tags=dict(tags or {}),
+                        pending=[], reservation_id=_new_id('r'))
+            self.instances[inst['id']] = inst
+            return inst['id']
+
+    def total_calls(self):
+        return sum(self.calls.values())
+
+    # State machine
+
+    def _schedule(self, obj, delay, **changes):
+        obj['pending'].append((time.time() + delay, changes))
+        obj['pending'].sort(key=lambda event: event[0])
+
+    def _settle(self, table):
+        """
+        Apply the state transitions which are due.
+        """
+        now = time.time()
+        for obj_id in list(table):
+            obj = table[obj_id]
+            while obj['pending'] and obj['pending'][0][0] <= now:
+                changes = obj['pending'].pop(0)[1]
+                if changes.get('deleted'):
+                    del table[obj_id]
+                    break
+                obj.update(changes)
+
+    def _get(self, table, obj_id, code):
+        self._settle(table)
+        if obj_id not in table:
+            raise _APIError(code, 'The id {} does not exist'.format(obj_id))
+        return table[obj_id]
+
+    def _select(self, table, ids, params, fields, code):
+        self._settle(table)
+        for obj_id in ids:
+            if obj_id not in table:
+                raise _APIError(code,
+                                'The id {} does not exist'.format(obj_id))
+        objs = [table[i] for i in ids] if ids else \
+            sorted(table.values(), key=lambda obj: obj['id'])
+        filters = _filters(params)
+        return [obj for obj in objs if _match(obj, filters, fields)]
+
+    def _resource(self, obj_id):
+        for table in (self.volumes, self.snapshots, self.images,
+                      self.instances):
+            self._settle(table)
+            if obj_id in table:
+                return table[obj_id]
+        raise _APIError('InvalidID', 'The id {} does not exist'.format(obj_id))
+
+    def _error_or(self, state):
+        return 'error' if self.random.random() < self.error_rate else state
+
+    # Request dispatch
+
+    def handle(self, params):
+        """
+        Process one API request, return (http_status, xml_body).
+        """
+        action = params.get('Action', '')
+        with self._lock:
+            self.calls[action] += 1
+            fail = self.random.random() < self.failure_rate
+        if self.latency:
+            time.sleep(self.latency)
+        try:
+            if fail:
+                raise _APIError('Unavailable', 'Simulated failure', 503)
+            method = getattr(self, '_api_' + action, None)
+            if method is None:
+                raise _APIError('InvalidAction',
+                                'Unsupported action {}'.format(action))
+            with self._lock:
+                body = method(params)
+            return 200, '<{0}Response xmlns="{1}">{2}{3}</{0}Response>'.format(
+                action, _XMLNS, _x('requestId', uuid.uuid4()), body)
+        except _APIError as error:
+            return error.status, (
+                '<Response><Errors><Error>{}{}</Error></Errors>{}</Response>'
+                .format(_x('Code', error.code), _x('Message', error.message),
+                        _x('RequestID', uuid.uuid4())))
+
+    # Volumes
+
+    def _render_volume(self, vol):
+        att = vol['attachment']
+        attachments = ''
+        if att:
+            attachments = '<item>{}{}{}{}{}</item>'.format(
+                _x('volumeId', vol['id']), _x('instanceId', att['instance_id']),
+                _x('device', att['device']), _x('status', att['status']),
+                _x('attachTime', att['time']))
+        return '<item>{}{}{}{}{}{}<attachmentSet>{}</attachmentSet>{}</item>'\
+            .format(_x('volumeId', vol['id']), _x('size', vol['size']),
+                    _x('snapshotId', vol['snapshot_id'] or ''),
+                    _x('availabilityZone', vol['zone']),
+                    _x('status', vol['status']),
+                    _x('createTime', vol['create_time']),
+                    attachments, _tag_set(vol['tags']))
+
+    def _api_CreateVolume(self, params):
+        snapshot_id = params.get('SnapshotId')
+        size = int(params.get('Size', 0))
+        if snapshot_id:
+            snap = self._get(self.snapshots, snapshot_id,
+                             'InvalidSnapshot.NotFound')
+            size = max(size, snap['volume_size'])
+        vol = dict(id=_new_id('vol'), size=size,
+                   zone=params['AvailabilityZone'], snapshot_id=snapshot_id,
+                   status='creating', attachment=None, tags={},
+                   create_time=_now_iso(time.time()), pending=[])
+        self.volumes[vol['id']] = vol
+        self._schedule(vol, self.delays['create_volume'],
+                       status=self._error_or('available'))
+        return self._render_volume(vol)[len('<item>'):-len('</item>')]
+
+    def _api_DescribeVolumes(self, params):
+        vols = self._select(self.volumes, _indexed(params, 'VolumeId'),
+                            params, _VOLUME_FIELDS, 'InvalidVolume.NotFound')
+        return '<volumeSet>{}</volumeSet>'.format(
+            ''.join(self._render_volume(vol) for vol in vols))
+
+    def _api_AttachVolume(self, params):
+        vol = self._get(self.volumes, params['VolumeId'],
+                        'InvalidVolume.NotFound')
+        instance_id = params['InstanceId']
+        device = params['Device']
+        self._get(self.instances, instance_id, 'InvalidInstanceID.NotFound')
+        if vol['status'] != 'available':
+            raise _APIError('IncorrectState', 'Volume {} is {}'.format(
+                vol['id'], vol['status']))
+        for other in self.volumes.values():
+            att = other['attachment']
+            if att and att['instance_id'] == instance_id and \
+                    att['device'] == device:
+                raise _APIError('InvalidParameterValue',
+                                'Attachment point {} is already in use'
+                                .format(device))
+        vol['status'] = 'in-use'
+        vol['attachment'] = dict(instance_id=instance_id, device=device,
+                                 status='attaching',
+                                 time=_now_iso(time.time()))
+        self._schedule(vol, self.delays['attach'], attachment=dict(
+            vol['attachment'], status='attached'))
+        return _x('return', True)
+
+    def _api_DetachVolume(self, params):
+        vol = self._get(self.volumes, params['VolumeId'],
+                        'InvalidVolume.NotFound')
+        if not vol['attachment']:
+            raise _APIError('IncorrectState', 'Volume {} is not attached'
+                            .format(vol['id']))
+        vol['pending'] = []
+        vol['attachment'] = dict(vol['attachment'], status='detaching')
+        self._schedule(vol, self.delays['detach'], status='available',
+                       attachment=None)
+        return _x('return', True)
+
+    def _api_DeleteVolume(self, params):
+        vol = self._get(self.volumes, params['VolumeId'],
+                        'InvalidVolume.NotFound')
+        if vol['status'] not in ('available', 'error'):
+            raise _APIError('VolumeInUse', 'Volume {} is {}'.format(
+                vol['id'], vol['status']))
+        vol['status'] = 'deleting'
+        self._schedule(vol, self.delays['delete_volume'], deleted=True)
+        return _x('return', True)
+
+    # Snapshots
+
+    def _render_snapshot(self, snap):
+        if snap['status'] == 'pending':
+            elapsed = time.time() - snap['start']
+            progress = int(min(99, 100 * elapsed / max(snap['duration'], 1e-6)))
+        else:
+            progress = 100
+        return '<item>{}{}{}{}{}{}{}{}</item>'.format(
+            _x('snapshotId', snap['id']), _x('volumeId', snap['volume_id']),
+            _x('status', snap['status']),
+            _x('startTime', _now_iso(snap['start'])),
+            _x('progress', '{}%'.format(progress)),
+            _x('volumeSize', snap['volume_size']),
+            _x('description', snap['description']), _tag_set(snap['tags']))
+
+    def _api_CreateSnapshot(self, params):
+        vol = self._get(self.volumes, params['VolumeId'],
+                        'InvalidVolume.NotFound')
+        duration = self.delays['snapshot_per_gib'] * vol['size']
+        snap = dict(id=_new_id('snap'), volume_id=vol['id'],
+                    volume_size=vol['size'], status='pending',
+                    description=params.get('Description', ''),
+                    start=time.time(), duration=duration, tags={}, pending=[])
+        self.snapshots[snap['id']] = snap
+        self._schedule(snap, duration, status=self._error_or('completed'))
+        return self._render_snapshot(snap)[len('<item>'):-len('</item>')]
+
+    def _api_DescribeSnapshots(self, params):
+        snaps = self._select(self.snapshots, _indexed(params, 'SnapshotId'),
+                             params, _SNAPSHOT_FIELDS,
+                             'InvalidSnapshot.NotFound')
+        return '<snapshotSet>{}</snapshotSet>'.format(
+            ''.join(self._render_snapshot(snap) for snap in snaps))
+
+    def _api_DeleteSnapshot(self, params):
+        self._get(self.snapshots, params['SnapshotId'],
+                  'InvalidSnapshot.NotFound')
+        del self.snapshots[params['SnapshotId']]
+        return _x('return', True)
+
+    # Images
+
+    def _render_image(self, img):
+        bdm = ''.join('<item>{}<ebs>{}</ebs></item>'.format(
+            _x('deviceName', dev), _x('snapshotId', snapshot_id))
+            for dev, snapshot_id in sorted(img['bdm'].items()))
+        return '<item>{}{}{}{}{}{}{}<blockDeviceMapping>{}</blockDeviceMapping>'\
+            '{}</item>'.format(
+                _x('imageId', img['id']), _x('imageState', img['state']),
+                _x('name', img['name']), _x('description', img['description']),
+                _x('architecture', img['architecture']),
+                _x('rootDeviceType', 'ebs'),
+                _x('rootDeviceName', img['root_device_name']), bdm,
+                _tag_set(img['tags']))
+
+    def _api_RegisterImage(self, params):
+        bdm = {}
+        i = 1
+        while 'BlockDeviceMapping.{}.DeviceName'.format(i) in params:
+            prefix = 'BlockDeviceMapping.{}.'.format(i)
+            bdm[params[prefix + 'DeviceName']] = params.get(
+                prefix + 'Ebs.SnapshotId')
+            i += 1
+        for snapshot_id in bdm.values():
+            snap = self._get(self.snapshots, snapshot_id,
+                             'InvalidSnapshot.NotFound')
+            if snap['status'] != 'completed':
+                raise _APIError('IncorrectState', 'Snapshot {} is {}'.format(
+                    snapshot_id, snap['status']))
+        img = dict(id=_new_id('ami'), state='pending', name=params.get('Name'),
+                   description=params.get('Description'),
+                   architecture=params.get('Architecture'),
+                   root_device_name=params.get('RootDeviceName'), bdm=bdm,
+                   tags={}, pending=[])
+        self.images[img['id']] = img
+        self._schedule(img, self.delays['register_image'], state='available')
+        return _x('imageId', img['id'])
+
+    def _api_DescribeImages(self, params):
+        imgs = self._select(self.images, _indexed(params, 'ImageId'), params,
+                            _IMAGE_FIELDS, 'InvalidAMIID.NotFound')
+        return '<imagesSet>{}</imagesSet>'.format(
+            ''.join(self._render_image(img) for img in imgs))
+
+    def _api_DeregisterImage(self, params):
+        self._get(self.images, params['ImageId'], 'InvalidAMIID.NotFound')
+        del self.images[params['ImageId']]
+        return _x('return', True)
+
+    # Instances
+
+    def _render_instance(self, inst):
+        return '<item>{}<instanceState>{}{}</instanceState>{}</item>'.format(
+            _x('instanceId', inst['id']),
+            _x('code', {'running': 16, 'shutting-down': 32,
+                        'terminated': 48}.get(inst['state'], 0)),
+            _x('name', inst['state']), _tag_set(inst['tags']))
+
+    def _api_DescribeInstances(self, params):
+        insts = self._select(self.instances, _indexed(params, 'InstanceId'),
+                             params, _INSTANCE_FIELDS,
+                             'InvalidInstanceID.NotFound')
+        return '<reservationSet>{}</reservationSet>'.format(''.join(
+            '<item>{}<instancesSet>{}</instancesSet></item>'.format(
+                _x('reservationId', inst['reservation_id']),
+                self._render_instance(inst))
+            for inst in insts))
+
+    def _api_TerminateInstances(self, params):
+        insts = [self._get(self.instances, instance_id,
+                           'InvalidInstanceID.NotFound')
+                 for instance_id in _indexed(params, 'InstanceId')]
+        for inst in insts:
+            if inst['state'] == 'running':
+                inst['state'] = 'shutting-down'
+                self._schedule(inst, self.delays['terminate'],
+                               state='terminated')
+        return '<instancesSet>{}</instancesSet>'.format(
+            ''.join(self._render_instance(inst) for inst in insts))
+
+    # Tags
+
+    def _api_CreateTags(self, params):
+        objs = [self._resource(i) for i in _indexed(params, 'ResourceId')]
+        i = 1
+        while 'Tag.{}.Key'.format(i) in params:
+            for obj in objs:
+                obj['tags'][params['Tag.{}.Key'.format(i)]] = params.get(
+                    'Tag.{}.Value'.format(i), '')
+            i += 1
+        return _x('return', True)
+
+    def _api_DeleteTags(self, params):
+        objs = [self._resource(i) for i in _indexed(params, 'ResourceId')]
+        i = 1
+        while 'Tag.{}.Key'.format(i) in params:
+            key = params['Tag.{}.Key'.format(i)]
+            value = params.get('Tag.{}.Value'.format(i))
+            for obj in objs:
+                if key in obj['tags'] and value in (None, obj['tags'][key]):
+                    del obj['tags'][key]
+            i += 1
+        return _x('return', True)
+
+
+class _Server(SocketServer.ThreadingMixIn, BaseHTTPServer.HTTPServer):
+    daemon_threads = True
+    allow_reuse_address = True
+
+
+class _Handler(BaseHTTPServer.BaseHTTPRequestHandler):
+
+    ec2 = None
+
+    def _respond(self, query):
+        params = dict((k, v[0]) for k, v in
+                      urlparse.parse_qs(query, keep_blank_values=True).items())
+        status, body = self.ec2.handle(params)
+        body = body.encode('utf-8')
+        self.send_response(status)
+        self.send_header('Content-Type', 'text/xml;charset=UTF-8')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def do_POST(self):
+        length = int(self.headers.get('Content-Length', 0))
+        self._respond(self.rfile.read(length))
+
+    def do_GET(self):
+        self._respond(urlparse.urlparse(self.path).query)
+
+    def log_message(self, fmt, *args):
+        logging.debug('fake-ec2: ' + fmt, *args)
@@ -6,16 +6,31 @@ from __future__ import division, absolute_import, print_function, unicode_litera
 
 import argparse
 import json
+import mmap
+import multiprocessing
 import os
 import re
+import stat
 import sys
 
+from outscale_image_factory import url_check
+from outscale_image_factory.helper import positive_int
+
 DESCRIPTION = """\
 Goes through the `conf.d` and `overlay` dirs of a Turn Key Linux appliance and
 reports all potential references to external packages.
 
 Produces a JSON output, either to stdout or to the file specified with
-`--output`.
+`--output`. With `--jsonl`, one JSON reference per line instead, written as
+they are found.
+
+Binary files are skipped. With `--cache`, the files unchanged since the
+previous scan of the same directory are not read again.
+
+With `--check`, the distinct URLs are checked concurrently instead, and the
+output lists their status with the places they are referenced from. The
+exit status is 1 if any URL is unreachable. `--prefetch` also downloads them
+to a local store.
 """
 
 
@@ -23,28 +38,129 @@ REGEXES = [re.compile(x) for x in [
     '(ftp|git|https?)://[^ ]+'
 ]]
 
+# All the regexes in one pass over the bytes of a file. A match never
+# spans lines.
+COMBINED_REGEX = re.compile(
+    '|'.join('(?:{})'.format(rx.pattern.replace('[^ ]', '[^ \n]'))
+             for rx in REGEXES).encode('utf-8'))
+
+# Files with a NUL byte in their first SNIFF_BYTES are binaries, skipped
+SNIFF_BYTES = 8192
+# Files larger than this are mapped in memory instead of read
+MMAP_BYTES = 1024 * 1024
+# Bytes of a mapped file counted at once, when counting lines
+_COUNT_BYTES = 1024 * 1024
+
+
+def _count_lines(data, start, end):
+    count = 0
+    for pos in range(start, end, _COUNT_BYTES):
+        count += data[pos:min(end, pos + _COUNT_BYTES)].count(b'\n')
+    return count
+
+
+def _find_references_in_data(relative_path, data):
+    line = 1
+    pos = 0
+    for match in COMBINED_REGEX.finditer(data):
+        line += _count_lines(data, pos, match.start())
+        pos = match.start()
+        # Lines are stripped, a match ends before trailing whitespace
+        yield (relative_path, line,
+               match.group(0).rstrip().decode('utf-8', 'replace'))
+
 
 def find_references_in_file(appliance_dir, full_path):
     relative_path = os.path.relpath(full_path, appliance_dir)
 
-    with open(full_path) as fp:
-        for num, line in enumerate(fp.readlines()):
-            for rx in REGEXES:
-                for match in rx.finditer(line.strip()):
-                    yield (relative_path, num + 1, match.group(0))
+    with open(full_path, 'rb') as fp:
+        if b'\0' in fp.read(SNIFF_BYTES):
+            return []
+        size = os.fstat(fp.fileno()).st_size
+        if size > MMAP_BYTES:
+            data = mmap.mmap(fp.fileno(), 0, access=mmap.ACCESS_READ)
+            try:
+                return list(_find_references_in_data(relative_path, data))
+            finally:
+                data.close()
+        fp.seek(0)
+        return list(_find_references_in_data(relative_path, fp.read()))
+
+
+def _scan(args):
+    appliance_dir, full_path = args
+    try:
+        return find_references_in_file(appliance_dir, full_path)
+    except (IOError, OSError) as error:
+        sys.stderr.write('Cannot read {}: {}\n'.format(full_path, error))
+        return []
 
 
-def find_references(appliance_dir):
-    lst = []
-    for name in ('conf.d', 'overlay'):
-        root_path = os.path.join(appliance_dir, name)
+def _walk(appliance_dir, whole_tree):
+    """
+    Yield the (path, signature) of the regular files to scan.
+    """
+    if whole_tree:
+        roots = [appliance_dir]
+    else:
+        roots = [os.path.join(appliance_dir, name)
+                 for name in ('conf.d', 'overlay')]
+    for root_path in roots:
         if not os.path.exists(root_path):
             continue
         for dir_path, dirnames, filenames in os.walk(root_path):
-            for name in filenames:
+            dirnames.sort()
+            for name in sorted(filenames):
                 file_path = os.path.join(dir_path, name)
-                lst.extend(find_references_in_file(appliance_dir, file_path))
-    return lst
+                st = os.lstat(file_path)
+                if stat.S_ISREG(st.st_mode):
+                    yield file_path, [st.st_size, repr(st.st_mtime)]
+
+
+def cache_key(appliance_dir, whole_tree=False):
+    """
+    Return the key of the cached references of a scan: the references
+    depend on the scanned directory, the scanned subdirectories and the
+    regexes.
+    """
+    return json.dumps([os.path.abspath(appliance_dir), whole_tree,
+                       COMBINED_REGEX.pattern.decode('utf-8')])
+
+
+def find_references(appliance_dir, whole_tree=False, cache=None, jobs=None):
+    """
+    Yield the (path, line, reference) tuples of the files of appliance_dir,
+    in the order of the walk.
+
+    Files are scanned by a pool of jobs processes. cache is a dict mapping
+    the relative paths to their [size, mtime, references], updated with the
+    scanned files: unchanged files are not scanned again. A cache only holds
+    the references of one scan, see cache_key.
+    """
+    if cache is None:
+        cache = {}
+    files = []
+    for file_path, signature in _walk(appliance_dir, whole_tree):
+        relative_path = os.path.relpath(file_path, appliance_dir)
+        cached = cache.get(relative_path)
+        files.append((file_path, relative_path, signature,
+                      cached is not None and cached[:2] == signature))
+    for relative_path in set(cache) - set(path for _, path, _, _ in files):
+        del cache[relative_path]
+    todo = [(appliance_dir, file_path)
+            for file_path, _, _, unchanged in files if not unchanged]
+    pool = multiprocessing.Pool(jobs) if todo else None
+    try:
+        scanned = pool.imap(_scan, todo, 16) if todo else iter([])
+        for _, relative_path, signature, unchanged in files:
+            if not unchanged:
+                cache[relative_path] = signature + [next(scanned)]
+            for ref in cache[relative_path][2]:
+                yield tuple(ref)
+    finally:
+        if pool is not None:
+            pool.close()
+            pool.join()
 
 
 def main():
@@ -52,6 +168,29 @@ def main():
 
     parser.add_argument('appliance_dir')
     parser.add_argument('-o', '--output')
+    parser.add_argument('--jsonl', action='store_true',
+                        help='Output one JSON reference per line, as they '
+                        'are found')
+    parser.add_argument('--whole-tree', action='store_true',
+                        help='Scan the whole directory, a rootfs for example')
+    parser.add_argument('--cache', metavar='FILE',
+                        help='Keep the references of each file in FILE, only '
+                        'scan the files changed since')
+    parser.add_argument('-j', '--jobs', type=positive_int,
+                        help='Number of scanning processes (default: number '
+                        'of CPUs)')
+    parser.add_argument('--check', action='store_true',
+                        help='Check that the referenced URLs are reachable')
+    parser.add_argument('--prefetch', metavar='DIR',
+                        help='Check the URLs and download them to the store '
+                        'DIR')
+    parser.add_argument('--check-jobs', type=positive_int,
+                        default=url_check.JOBS,
+                        help='Number of URLs checked at the same time '
+                        '(default: %(default)s)')
+    parser.add_argument('--timeout', type=int, default=url_check.TIMEOUT,
+                        help='Network timeout in seconds when checking URLs '
+                        '(default: %(default)s)')
 
     args = parser.parse_args()
 
@@ -60,10 +199,59 @@ def main():
     else:
         fp = sys.stdout
 
-    urls = find_references(args.appliance_dir)
-    json.dump(urls, fp, indent=2)
+    # One cache file holds the caches of several scans
+    caches = {}
+    if args.cache and os.path.exists(args.cache):
+        with open(args.cache) as cache_fp:
+            caches = json.load(cache_fp).get('scans', {})
+    cache = caches.setdefault(cache_key(args.appliance_dir, args.whole_tree),
+                              {})
+
+    items = find_references(args.appliance_dir, args.whole_tree, cache,
+                            args.jobs)
+    ret = 0
+    # With --jsonl, references are written as they are found, check
+    # results once all the URLs are checked
+    if args.check or args.prefetch:
+        results = list(_check(items, args))
+        failed = [result['url'] for result in results if not result['ok']]
+        sys.stderr.write('{} URLs checked, {} unreachable\n'.format(
+            len(results), len(failed)))
+        for url in failed:
+            sys.stderr.write('Unreachable: {}\n'.format(url))
+        items = iter(results)
+        ret = 1 if failed else 0
+    if args.jsonl:
+        for item in items:
+            fp.write(json.dumps(item, sort_keys=True) + '\n')
+    else:
+        json.dump(list(items), fp, indent=2, sort_keys=True)
+    fp.flush()
+
+    if args.cache:
+        tmp = args.cache + '.tmp'
+        with open(tmp, 'w') as cache_fp:
+            json.dump(dict(scans=caches), cache_fp)
+        os.rename(tmp, args.cache)
+
+    return ret
+
 
-    return 0
+def _check(refs, args):
+    """
+    Yield the check results of the distinct URLs of refs, with the places
+    they are referenced from, sorted by URL.
+    """
+    places = {}
+    for relative_path, line, url in refs:
+        places.setdefault(url_check.clean_url(url), []).append(
+            [relative_path, line])
+    store = url_check.Store(args.prefetch) if args.prefetch else None
+    results = url_check.check_urls(places, args.check_jobs, store,
+                                   args.timeout)
+    for result in sorted(results, key=lambda result: result['url']):
+        result['refs'] = places[result['url']]
+        yield result
 
 
 if __name__ == "__main__":
@@ -0,0 +1,174 @@
+"""
+Content fingerprint of a root filesystem.
+
+The fingerprint is a Merkle hash: the hash of a directory covers the names,
+modes, owners and hashes of its entries, the hash of a file its content, and
+the fingerprint is the hash of the root directory. Two root filesystems with
+the same fingerprint produce the same image.
+
+File contents are hashed in parallel, and their hashes are cached by inode
+and mtime, so that fingerprinting a tree again only reads the files which
+changed. The cache holds one section per tree; the sections of trees which
+no longer exist are dropped. It is shared by concurrent installs: it is
+only read and written under a file lock, and each install merges its own
+section into the cache as found when saving.
+"""
+from __future__ import division, absolute_import, print_function, unicode_literals
+
+import hashlib
+import json
+import logging
+import multiprocessing
+import os
+import stat
+import tempfile
+
+from outscale_image_factory import tracing
+from outscale_image_factory.helper import file_lock
+
+# Files written by the install itself, left out of the fingerprint
+EXCLUDED = (b'etc/fstab',)
+
+DEFAULT_CACHE = os.path.join(tempfile.gettempdir(),
+                             'omi-factory-fingerprints.json')
+
+_READ_SIZE = 1024 * 1024
+
+
+def _hash_file(path):
+    digest = hashlib.sha256()
+    with open(path, 'rb') as fp:
+        while True:
+            data = fp.read(_READ_SIZE)
+            if not data:
+                break
+            digest.update(data)
+    return digest.hexdigest()
+
+
+def _cache_key(st):
+    return '{}:{}'.format(st.st_dev, st.st_ino)
+
+
+def _cache_value(st):
+    return [repr(st.st_mtime), st.st_size]
+
+
+def _read_cache(path):
+    try:
+        with open(path) as fp:
+            return json.load(fp)
+    except (IOError, ValueError):
+        return {}
+
+
+def _load_cache(path):
+    with file_lock(path + '.lock', shared=True):
+        return _read_cache(path)
+
+
+def _save_cache(path, section, entries):
+    """
+    Replace the section of the cache in path with entries, drop the
+    sections of the trees which no longer exist.
+    """
+    with file_lock(path + '.lock'):
+        caches = dict((tree, tree_entries)
+                      for tree, tree_entries in _read_cache(path).items()
+                      if os.path.isdir(tree))
+        caches[section] = entries
+        with tempfile.NamedTemporaryFile(dir=os.path.dirname(path) or '.',
+                                         delete=False) as fp:
+            json.dump(caches, fp)
+        os.rename(fp.name, path)
+
+
+def _scan(root):
+    """
+    Return the list of (dir_path, [(name, stat)]) of a tree, parents first.
+    """
+    tree = []
+    for dir_path, dir_names, file_names in os.walk(root):
+        entries = []
+        for name in dir_names + file_names:
+            path = os.path.join(dir_path, name)
+            if os.path.relpath(path, root) in EXCLUDED:
+                continue
+            entries.append((name, os.lstat(path)))
+        tree.append((dir_path, sorted(entries)))
+    return tree
+
+
+def fingerprint(rootfs, cache_path=DEFAULT_CACHE, jobs=None):
+    """
+    Return the fingerprint of the rootfs directory, a hex string.
+
+    cache_path: file caching the hashes of file contents, None to disable.
+    jobs: number of processes hashing files, defaults to the number of CPUs.
+    """
+    if isinstance(rootfs, unicode):
+        rootfs = rootfs.encode('utf-8')
+    with tracing.span('Fingerprinting ' + rootfs.decode('utf-8', 'ignore'),
+                      'install') as attrs:
+        tree = _scan(rootfs)
+        caches = _load_cache(cache_path) if cache_path else {}
+        section = os.path.abspath(rootfs).decode('utf-8', 'replace')
+        cache = caches.get(section, {})
+        hashes = {}
+        todo = {}
+        for dir_path, entries in tree:
+            for name, st in entries:
+                if not stat.S_ISREG(st.st_mode):
+                    continue
+                key = _cache_key(st)
+                cached = cache.get(key)
+                if cached and cached[:2] == _cache_value(st):
+                    hashes[key] = cached[2]
+                elif key not in todo:
+                    todo[key] = os.path.join(dir_path, name)
+        if todo:
+            pool = multiprocessing.Pool(jobs)
+            try:
+                keys = list(todo)
+                for key, digest in zip(keys, pool.map(
+                        _hash_file, [todo[key] for key in keys], 16)):
+                    hashes[key] = digest
+            finally:
+                pool.close()
+                pool.join()
+        attrs['files'] = len(hashes)
+        attrs['hashed'] = len(todo)
+        logging.info('Fingerprint: {} files, {} hashed'.format(len(hashes),
+                                                               len(todo)))
+
+        # Hash the directories, children first
+        dir_hashes = {}
+        new_cache = {}
+        for dir_path, entries in reversed(tree):
+            digest = hashlib.sha256()
+            for name, st in entries:
+                path = os.path.join(dir_path, name)
+                if stat.S_ISREG(st.st_mode):
+                    key = _cache_key(st)
+                    content = hashes[key]
+                    new_cache[key] = _cache_value(st) + [content]
+                elif stat.S_ISDIR(st.st_mode):
+                    content = dir_hashes.pop(path)
+                elif stat.S_ISLNK(st.st_mode):
+                    content = hashlib.sha256(os.readlink(path)).hexdigest()
+                else:
+                    content = str(st.st_rdev)
+                digest.update(b'\0'.join([
+                    name, '{:o}:{}:{}'.format(st.st_mode, st.st_uid,
+                                              st.st_gid).encode('ascii'),
+                    content.encode('ascii')]) + b'\n')
+            dir_hashes[dir_path] = digest.hexdigest()
+
+        st = os.lstat(rootfs)
+        result = hashlib.sha256('{:o}:{}:{}:{}'.format(
+            st.st_mode, st.st_uid, st.st_gid,
+            dir_hashes[rootfs]).encode('ascii')).hexdigest()
+        attrs['fingerprint'] = result
+    if cache_path:
+        _save_cache(cache_path, section, new_cache)
+    return result
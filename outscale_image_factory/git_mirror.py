@@ -0,0 +1,142 @@
+"""
+Local cache of bare mirrors of the appliance git repositories.
+
+Each upstream repository is mirrored once per buildslave, with git clone
+--mirror. Working copies are cloned from the mirror with --shared: the
+objects are found through the git alternates mechanism, so a clone only
+writes a checkout and the objects are stored once for all fab dirs.
+
+A file lock per mirror serializes the fetches of concurrent builds. Mirrors
+never prune unreachable objects: working copies may still use them.
+"""
+from __future__ import division, absolute_import, print_function, unicode_literals
+
+import collections
+import logging
+import os
+import re
+import shutil
+
+from outscale_image_factory.helper import check_cmd, file_lock, run_graph
+
+
+# Concurrent fetches when refreshing mirrors
+JOBS = 8
+
+_Mirror = collections.namedtuple('_Mirror', 'key deps')
+
+
+def mirror_path(mirror_dir, url):
+    """
+    Return the path of the mirror of url: the host and path of the URL, so
+    that URLs with and without the .git suffix share a mirror.
+    """
+    name = re.sub(r'^[a-z0-9+.-]+://', '', url)
+    name = re.sub(r'^[^@/]*@', '', name).replace(':', '/')
+    name = name.strip('/')
+    if name.endswith('.git'):
+        name = name[:-len('.git')]
+    return os.path.join(mirror_dir, name + '.git')
+
+
+def update_mirror(mirror_dir, url):
+    """
+    Create or fetch the mirror of url. Return (ok, error) tuple.
+    """
+    path = mirror_path(mirror_dir, url)
+    parent = os.path.dirname(path)
+    if not os.path.isdir(parent):
+        try:
+            os.makedirs(parent)
+        except OSError:
+            # Created by a concurrent update
+            if not os.path.isdir(parent):
+                raise
+    with file_lock(path + '.lock'):
+        if os.path.exists(path):
+            logging.info('Fetching mirror {}'.format(path))
+            return check_cmd('git --git-dir {} fetch --prune origin'
+                             .format(path))
+        logging.info('Mirroring {} to {}'.format(url, path))
+        tmp_path = path + '.tmp'
+        if os.path.exists(tmp_path):
+            # Leftovers of an interrupted clone
+            shutil.rmtree(tmp_path)
+        ok, err = check_cmd('git clone --mirror {} {}'.format(url, tmp_path))
+        if ok:
+            ok, err = check_cmd('git --git-dir {} config gc.pruneExpire never'
+                                .format(tmp_path))
+        if ok:
+            # Only complete mirrors are found at path
+            os.rename(tmp_path, path)
+        return ok, err
+
+
+def list_mirrors(mirror_dir):
+    """
+    Return the upstream URLs of the mirrors found in mirror_dir.
+    """
+    urls = []
+    for dirpath, dirnames, _ in os.walk(mirror_dir):
+        for name in list(dirnames):
+            if name.endswith('.git'):
+                dirnames.remove(name)
+                ok, data = check_cmd('git --git-dir {} config remote.origin.url'
+                                     .format(os.path.join(dirpath, name)))
+                if ok:
+                    urls.append(data['stdout'].strip())
+    return sorted(urls)
+
+
+def refresh_mirrors(mirror_dir, urls, jobs=JOBS):
+    """
+    Update the mirrors of urls, at most jobs at a time. A failed fetch does
+    not stop the others.
+
+    Return (ok, failed) tuple, failed being the list of the URLs whose
+    mirror could not be updated.
+    """
+    urls = sorted(set(urls))
+    ok, _, done = run_graph([_Mirror(url, []) for url in urls],
+                            lambda step: update_mirror(mirror_dir, step.key),
+                            jobs, keep_going=True)
+    failed = [url for url in urls if url not in done]
+    for url in failed:
+        logging.error('Failed to update the mirror of {}'.format(url))
+    return ok, failed
+
+
+def clone_or_update(mirror_dir, url, app_dir, branch=None, fetch=True):
+    """
+    Clone url to app_dir through its mirror, or update the existing working
+    copy from the mirror. The origin of the working copy stays url.
+
+    fetch: update the mirror first, else use it as left by refresh_mirrors.
+
+    Return (ok, error) tuple.
+    """
+    path = mirror_path(mirror_dir, url)
+    ok, err = True, None
+    if fetch or not os.path.exists(path):
+        ok, err = update_mirror(mirror_dir, url)
+    if not ok:
+        return ok, err
+    if os.path.exists(app_dir):
+        logging.info('Updating {} from {}'.format(app_dir, path))
+        ok, err = check_cmd('git -C {} fetch {} '
+                            '+refs/heads/*:refs/remotes/origin/*'
+                            .format(app_dir, path))
+        if ok and branch:
+            ok, err = check_cmd('git -C {} checkout {}'.format(app_dir, branch))
+        if ok:
+            ok, err = check_cmd('git -C {} merge @{{u}}'.format(app_dir))
+        return ok, err
+    logging.info('Cloning {} from {}'.format(app_dir, path))
+    cmd = 'git clone --shared'
+    if branch:
+        cmd += ' --branch {}'.format(branch)
+    ok, err = check_cmd('{} {} {}'.format(cmd, path, app_dir))
+    if ok:
+        ok, err = check_cmd('git -C {} remote set-url origin {}'
+                            .format(app_dir, url))
+    return ok, err
@@ -0,0 +1,242 @@
+"""
+Minimal client of the GitHub API, for listings of repositories.
+
+Responses are kept on disk with their ETag and requested again with
+If-None-Match: GitHub answers 304 Not Modified for an unchanged resource,
+which does not count against the rate limit. The requests share the
+kept-alive connections of a url_check.ConnectionPool, and the pages of the
+listings are requested concurrently.
+"""
+from __future__ import division, absolute_import, print_function, unicode_literals
+
+import collections
+import hashlib
+import httplib
+import json
+import logging
+import os
+import re
+import tempfile
+import threading
+import urllib
+import urlparse
+from multiprocessing.pool import ThreadPool
+
+from outscale_image_factory import url_check
+
+
+API_URL = 'https://api.github.com'
+JOBS = 8
+PER_PAGE = 100
+
+_LINK_RE = re.compile(r'<([^>]*)>\s*;\s*rel="(\w+)"')
+
+
+def parse_links(header):
+    """
+    Return the dict of the URLs of a Link header, by relation.
+    """
+    return dict((rel, url) for url, rel in _LINK_RE.findall(header or ''))
+
+
+def _page_number(url):
+    query = urlparse.parse_qs(urlparse.urlsplit(url).query)
+    return int(query.get('page', ['1'])[0])
+
+
+def _page_url(url, page):
+    """
+    Return url with its page parameter set to page.
+    """
+    parts = urlparse.urlsplit(url)
+    query = urlparse.parse_qs(parts.query)
+    query['page'] = [str(page)]
+    return urlparse.urlunsplit(parts._replace(
+        query=urllib.urlencode(sorted(query.items()), doseq=True)))
+
+
+def _following_pages(links):
+    """
+    Return the URLs of the pages after the first one, from the link to the
+    last page given with the first one.
+    """
+    if 'last' not in links:
+        return []
+    return [_page_url(links['last'], page)
+            for page in range(2, _page_number(links['last']) + 1)]
+
+
+class GithubClient(object):
+
+    """
+    GitHub API client caching the responses in cache_dir, if given.
+    """
+
+    def __init__(self, api_url=API_URL, token=None, cache_dir=None,
+                 jobs=JOBS, timeout=url_check.TIMEOUT, per_page=PER_PAGE):
+        self.api_url = api_url.rstrip('/')
+        self.per_page = per_page
+        self.token = token
+        self.cache_dir = cache_dir
+        self.jobs = jobs
+        self.pool = url_check.ConnectionPool(timeout)
+        self.stats = collections.Counter()
+        self.rate_remaining = None
+        self._lock = threading.Lock()
+
+    def close(self):
+        self.pool.close()
+
+    def _cache_path(self, url):
+        # Listings depend on the token: private repositories
+        key = hashlib.sha256(
+            '{}\0{}'.format(url, self.token or '').encode('utf-8')).hexdigest()
+        return os.path.join(self.cache_dir, key[:2], key + '.json')
+
+    def _load(self, url):
+        if self.cache_dir is None:
+            return None
+        try:
+            with open(self._cache_path(url)) as fp:
+                return json.load(fp)
+        except (IOError, ValueError):
+            return None
+
+    def _save(self, url, entry):
+        path = self._cache_path(url)
+        try:
+            if not os.path.isdir(os.path.dirname(path)):
+                os.makedirs(os.path.dirname(path))
+        except OSError:
+            # Created by a concurrent request
+            if not os.path.isdir(os.path.dirname(path)):
+                raise
+        with tempfile.NamedTemporaryFile(dir=os.path.dirname(path),
+                                         delete=False) as fp:
+            json.dump(entry, fp)
+        os.rename(fp.name, path)
+
+    def _count(self, stat, response):
+        remaining = response.getheader('X-RateLimit-Remaining')
+        with self._lock:
+            self.stats[stat] += 1
+            # Concurrent responses: the lowest is the latest
+            if remaining is not None:
+                remaining = int(remaining)
+                self.rate_remaining = remaining \
+                    if self.rate_remaining is None \
+                    else min(remaining, self.rate_remaining)
+
+    def get(self, url):
+        """
+        GET url, a path of the API or a full URL.
+
+        Return (ok, data) tuple, data being a dict of the decoded body and
+        of the links of the response, or the error.
+        """
+        if url.startswith('/'):
+            url = self.api_url + url
+        headers = {'Accept': 'application/vnd.github.v3+json',
+                   'User-Agent': 'omi-factory'}
+        if self.token:
+            headers['Authorization'] = 'token {}'.format(self.token)
+        cached = self._load(url)
+        if cached is not None:
+            headers['If-None-Match'] = cached['etag']
+        try:
+            key, conn, response = self.pool.request('GET', url, headers)
+            try:
+                body = response.read()
+            finally:
+                self.pool.release(key, conn, response)
+        except (IOError, httplib.HTTPException) as error:
+            return False, '{}: {}'.format(url, error)
+        if response.status == 304 and cached is not None:
+            self._count('not_modified', response)
+            return True, cached
+        self._count('fetched', response)
+        try:
+            body = json.loads(body)
+        except ValueError:
+            return False, '{}: {} {}, invalid JSON'.format(
+                url, response.status, response.reason)
+        if response.status != 200:
+            message = body.get('message') if isinstance(body, dict) else None
+            return False, '{}: {} {}{}'.format(
+                url, response.status, response.reason,
+                ', {}'.format(message) if message else '')
+        entry = dict(etag=response.getheader('ETag'), body=body,
+                     links=parse_links(response.getheader('Link')))
+        if self.cache_dir is not None and entry['etag']:
+            try:
+                self._save(url, entry)
+            except (IOError, OSError) as error:
+                logging.warning('Cannot cache {}: {}'.format(url, error))
+        return True, entry
+
+    def _map(self, func, items):
+        if not items:
+            return []
+        threads = ThreadPool(min(self.jobs, len(items)))
+        try:
+            return threads.map(func, items)
+        finally:
+            threads.close()
+            threads.join()
+
+    def get_many(self, urls):
+        """
+        GET the urls concurrently, return the list of the (ok, data) tuples
+        returned by get().
+        """
+        return self._map(self.get, urls)
+
+    def get_listings(self, paths):
+        """
+        Return the list of the (ok, items) tuples of the listings at paths,
+        items being the elements of all the pages, or the error.
+
+        The first pages are requested concurrently, then all the others.
+        A first page not modified keeps its cached links: the page after a
+        full last page is requested too, until a page is not full.
+        """
+        urls = ['{}{}per_page={}'.format(path, '&' if '?' in path else '?',
+                                         self.per_page) for path in paths]
+        firsts = self._map(self.get, urls)
+        results = []
+        others = []
+        for index, (ok, first) in enumerate(firsts):
+            if ok:
+                results.append((ok, list(first['body'])))
+                others.extend((index, url)
+                              for url in _following_pages(first['links']))
+            else:
+                results.append((ok, first))
+        # URL and size of the last page of each listing
+        lasts = [(url, len(first['body']) if ok else 0)
+                 for url, (ok, first) in zip(urls, firsts)]
+        while True:
+            pages = self._map(self.get, [url for _, url in others])
+            for (index, url), (ok, page) in zip(others, pages):
+                if not results[index][0]:
+                    continue
+                if ok:
+                    results[index][1].extend(page['body'])
+                    lasts[index] = (url, len(page['body']))
+                else:
+                    results[index] = (ok, page)
+            others = [(index, _page_url(url, _page_number(url) + 1))
+                      for index, (url, size) in enumerate(lasts)
+                      if results[index][0] and size == self.per_page]
+            if not others:
+                return results
+            lasts = [(url, 0) for url, _ in lasts]
+
+    def report(self):
+        """
+        Return a one line summary of the requests.
+        """
+        return '{} requests, {} not modified, rate limit remaining: {}'.format(
+            self.stats['fetched'] + self.stats['not_modified'],
+            self.stats['not_modified'],
+            'unknown' if self.rate_remaining is None else self.rate_remaining)
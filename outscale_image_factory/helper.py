@@ -4,27 +4,152 @@ Helper functions used by the Outscale factory tools.
 # Python 2/3 compatibility
 from __future__ import division, absolute_import, print_function, unicode_literals
 
+import argparse
+import collections
+import contextlib
+import errno
+import fcntl
 import logging
-import subprocess
 import os
+import Queue
+import re
+import select
+import subprocess
+import threading
+import time
+
+from outscale_image_factory import tracing
 
 
-def _log_output(fp, prefix, lines):
-    line = fp.readline()
-    if not line:
-        return False
-    line = line.decode('utf-8', 'ignore')
-    logging.info(prefix + line.rstrip())
-    lines.append(line)
-    return True
+# Size of the chunks read from the output of commands
+CHUNK_SIZE = 64 * 1024
+# Bytes of output kept in memory and returned as data['stdout']
+TAIL_BYTES = 64 * 1024
+# Seconds between checks of the timeout and cancel event
+_POLL_SEC = 0.5
 
+_LINE_BREAK_RE = re.compile(b'\r\n|\r|\n')
 
-def check_cmd(cmd, data='', dryrun=False):
+
+def check_cmd(cmd, data='', dryrun=False, timeout=None, spool=None,
+              cancel=None, tail_bytes=TAIL_BYTES):
     """Run command, log everything, return a (bool,dict) tuple with command
-    success and debug data."""
+    success and debug data.
+
+    Only the last tail_bytes of the output are kept in data['stdout'], the
+    whole output is appended to the spool file if one is given. The command
+    is killed after timeout seconds, or when the cancel event is set.
+    data['bytes'] and data['lines'] count the whole output. data['usage']
+    is the CPU time and peak RSS of the command, None if unknown."""
+    with tracing.span(cmd, 'cmd') as attrs:
+        ok, data = _check_cmd(cmd, data, dryrun, timeout, spool, cancel,
+                              tail_bytes)
+        attrs['ret'] = data['ret']
+        attrs['bytes'] = data['bytes']
+        attrs['lines'] = data['lines']
+        if data['usage'] is not None:
+            attrs.update(('child_' + key, value)
+                         for key, value in data['usage'].items())
+    return ok, data
+
+
+class _Output(object):
+
+    """
+    Consume the output of a command: log it, keep its tail, spool it.
+    """
+
+    def __init__(self, prefix, spool, tail_bytes):
+        self.prefix = prefix
+        self.spool = spool
+        self.tail_bytes = tail_bytes
+        self.tail = bytearray()
+        self.partial = b''
+        self.bytes = 0
+        self.lines = 0
+        self.truncated = False
+
+    def feed(self, chunk):
+        self.bytes += len(chunk)
+        self.lines += chunk.count(b'\n')
+        if self.spool is not None:
+            self.spool.write(chunk)
+        self.tail += chunk
+        if len(self.tail) > self.tail_bytes:
+            del self.tail[:len(self.tail) - self.tail_bytes]
+            self.truncated = True
+        # Log complete lines, one logging call per chunk. Progress bars
+        # redraw their line after a \r, which breaks lines too.
+        text = self.partial + chunk
+        lines = _LINE_BREAK_RE.split(text)
+        self.partial = lines.pop()
+        if text.endswith(b'\r') and lines:
+            # Maybe the first half of a \r\n
+            self.partial = lines.pop() + b'\r'
+        if len(self.partial) > self.tail_bytes:
+            self.partial = self.partial[-self.tail_bytes:]
+        self._log(lines)
+
+    def close(self):
+        if self.partial:
+            self.lines += 1
+            self._log([self.partial])
+            self.partial = b''
+
+    def _log(self, lines):
+        if lines:
+            logging.info('\n'.join(self.prefix + line.decode('utf-8', 'ignore')
+                                   .rstrip() for line in lines))
+
+    def text(self):
+        return bytes(self.tail).decode('utf-8', 'ignore')
+
+
+def _kill(proc):
+    proc.terminate()
+    deadline = time.time() + 5
+    while proc.poll() is None and time.time() < deadline:
+        time.sleep(0.05)
+    if proc.returncode is None:
+        proc.kill()
+
+
+def _wait(proc):
+    """
+    Reap proc with wait4, which measures this child only.
+
+    Return (returncode, usage) tuple, usage being None if proc was already
+    reaped.
+    """
+    if proc.returncode is not None:
+        return proc.returncode, None
+    while True:
+        try:
+            _, status, rusage = os.wait4(proc.pid, 0)
+            break
+        except OSError as error:
+            if error.errno == errno.ECHILD:
+                return proc.wait(), None
+            if error.errno != errno.EINTR:
+                raise
+    if os.WIFSIGNALED(status):
+        proc.returncode = -os.WTERMSIG(status)
+    else:
+        proc.returncode = os.WEXITSTATUS(status)
+    usage = dict(user_sec=round(rusage.ru_utime, 3),
+                 sys_sec=round(rusage.ru_stime, 3),
+                 maxrss_kib=rusage.ru_maxrss)
+    return proc.returncode, usage
+
+
+def _check_cmd(cmd, data, dryrun, timeout=None, spool=None, cancel=None,
+               tail_bytes=TAIL_BYTES):
     logging.info('Running {}'.format(repr(cmd)))
+    output = _Output('', None, tail_bytes)
+    timed_out = False
+    cancelled = False
+    usage = None
     if dryrun:
-        stdout = b''
         ret = 0
     else:
         proc = subprocess.Popen(cmd.split(' '),
@@ -36,35 +161,157 @@ def check_cmd(cmd, data='', dryrun=False):
         proc.stdin.close()
 
         # Run the command
-        lines = []
         logging.info('pid: {}'.format(proc.pid))
-        prefix = '({}) '.format(proc.pid)
-        while proc.returncode is None:
-            proc.poll()
-            _log_output(proc.stdout, prefix, lines)
-
-        # Read the rest of proc.stdout
-        while _log_output(proc.stdout, prefix, lines):
-            pass
-        proc.stdout.close()
-        stdout = ''.join(lines)
-
-        ret = proc.returncode
+        spool_fp = open(spool, 'ab') if spool else None
+        output = _Output('({}) '.format(proc.pid), spool_fp, tail_bytes)
+        fd = proc.stdout.fileno()
+        poller = select.poll()
+        poller.register(fd, select.POLLIN | select.POLLHUP)
+        deadline = None if timeout is None else time.time() + timeout
+        try:
+            while True:
+                if cancel is not None and cancel.is_set():
+                    logging.error('Command {} cancelled'.format(repr(cmd)))
+                    cancelled = True
+                    _kill(proc)
+                    break
+                wait_sec = _POLL_SEC
+                if deadline is not None:
+                    wait_sec = min(wait_sec, deadline - time.time())
+                    if wait_sec <= 0:
+                        logging.error('Command {} timed out after {}s'
+                                      .format(repr(cmd), timeout))
+                        timed_out = True
+                        _kill(proc)
+                        break
+                if not poller.poll(wait_sec * 1000):
+                    continue
+                chunk = os.read(fd, CHUNK_SIZE)
+                if not chunk:
+                    break
+                output.feed(chunk)
+        finally:
+            output.close()
+            proc.stdout.close()
+            if spool_fp is not None:
+                spool_fp.close()
+        ret, usage = _wait(proc)
 
     data = dict(
         cmd=cmd,
         pwd=os.getcwd(),
         stdin=data,
-        stdout=stdout,
+        stdout=output.text(),
+        truncated=output.truncated,
+        bytes=output.bytes,
+        lines=output.lines,
+        spool=spool,
+        timed_out=timed_out,
+        cancelled=cancelled,
         ret=ret,
+        usage=usage,
     )
-    ok = (ret == 0)
+    ok = (ret == 0 and not timed_out and not cancelled)
     if not ok:
         logging.error('Command {} failed with error code {}'
                       .format(repr(cmd), ret))
     return ok, data
 
 
+def positive_int(value):
+    """argparse type of the options counting jobs or slots, which must be
+    at least 1."""
+    try:
+        number = int(value)
+    except ValueError:
+        raise argparse.ArgumentTypeError(
+            'invalid int value: {!r}'.format(value))
+    if number < 1:
+        raise argparse.ArgumentTypeError(
+            '{} is not a positive integer'.format(number))
+    return number
+
+
+def run_graph(steps, run, jobs=1, keep_going=False, limits=None):
+    """Run a dependency graph of steps, at most jobs of them at a time.
+
+    steps: objects with a key and deps, the keys of the steps which must
+    complete first. Keys missing from steps are ignored in deps. Steps may
+    also have resources, a list of names of resources they use.
+    run: function running a step, returning an (ok, error) tuple.
+    keep_going: keep starting steps after a failure, skipping only the steps
+    depending on a failed one.
+    limits: dict of the number of steps which may use a resource at the same
+    time. Steps are started in list order when their dependencies are
+    complete and their resources available.
+
+    Return (ok, error, done) tuple, done being the keys of the completed
+    steps in completion order. Raise ValueError if jobs or a limit is not
+    positive: no step would ever start."""
+    if jobs < 1 or any(limit < 1 for limit in (limits or {}).values()):
+        raise ValueError('jobs and limits must be positive: {}, {}'
+                         .format(jobs, limits))
+    keys = set(step.key for step in steps)
+    pending = list(steps)
+    running = set()
+    done = []
+    failed = set()
+    results = Queue.Queue()
+    limits = limits or {}
+    used = collections.Counter()
+    ok = True
+    err = None
+
+    def available(step):
+        return all(used[name] < limits[name]
+                   for name in getattr(step, 'resources', ()) if name in limits)
+
+    def worker(step):
+        try:
+            result = run(step)
+        except Exception as exc:
+            logging.exception('Step {} failed'.format(step.key))
+            result = (False, exc)
+        results.put((step, result))
+
+    while True:
+        for step in list(pending):
+            if len(running) >= jobs or not (ok or keep_going):
+                break
+            deps = [dep for dep in step.deps if dep in keys]
+            if any(dep in failed for dep in deps):
+                pending.remove(step)
+                failed.add(step.key)
+            elif all(dep in done for dep in deps) and available(step):
+                pending.remove(step)
+                running.add(step.key)
+                used.update(getattr(step, 'resources', ()))
+                thread = threading.Thread(target=worker, args=(step,))
+                thread.daemon = True
+                thread.start()
+        if not running:
+            break
+        try:
+            # A timeout keeps the main thread responsive to signals
+            step, (step_ok, step_err) = results.get(True, _POLL_SEC)
+        except Queue.Empty:
+            continue
+        running.remove(step.key)
+        used.subtract(getattr(step, 'resources', ()))
+        if step_ok:
+            done.append(step.key)
+        else:
+            failed.add(step.key)
+            if ok:
+                ok, err = False, step_err
+    if ok and pending:
+        ok = False
+        err = 'Unsatisfiable dependencies: {}'.format(
+            ', '.join(step.key for step in pending))
+        logging.error(err)
+    return ok, err, done
+
+
 def cd(path):
     """Chdir wrapper: log, catch exceptions.
     """
@@ -81,6 +328,32 @@ def cd(path):
     return ok, err
 
 
+@contextlib.contextmanager
+def file_lock(path, blocking=True, shared=False):
+    """Hold an exclusive lock on a file, for mutual exclusion between
+    processes.
+
+    Yield True if the lock is held. In non-blocking mode, yield False if the
+    lock is already held by someone else. A shared lock only excludes the
+    exclusive ones.
+    """
+    with open(path, 'a') as fp:
+        flags = fcntl.LOCK_SH if shared else fcntl.LOCK_EX
+        if not blocking:
+            flags |= fcntl.LOCK_NB
+        try:
+            fcntl.flock(fp.fileno(), flags)
+        except IOError as error:
+            if error.errno not in (errno.EAGAIN, errno.EACCES):
+                raise
+            yield False
+            return
+        try:
+            yield True
+        finally:
+            fcntl.flock(fp.fileno(), fcntl.LOCK_UN)
+
+
 if __name__ == "__main__":
     # Basic testing
     logging.basicConfig(level=logging.INFO)
@@ -1,11 +1,22 @@
 from __future__ import division, absolute_import, print_function, unicode_literals
 
+import collections
+import errno
+import json
 import os
+import shutil
 import logging
 import tempfile
+import threading
 import time
+import uuid
 
-from outscale_image_factory.helper import check_cmd
+from outscale_image_factory import config
+from outscale_image_factory import tracing
+from outscale_image_factory.create_fstab import write_fstab
+from outscale_image_factory.helper import check_cmd, positive_int, \
+    run_graph
+from outscale_image_factory.journal import Journal, tree_signature
 
 # Partitions should be aligned on a multiple of 2048 sectors
 # This is a 10G partition
@@ -13,6 +24,100 @@ PARTITION_TABLE = [
     (2048, 20969391, 83),
 ]
 
+SECTOR_SIZE = 512
+# Partitions start and end on multiples of this number of sectors
+ALIGN_SECTORS = 2048
+
+# ext4 layout assumed by the partition planner: mke2fs defaults for
+# filesystems of a few GiB
+FS_BLOCK_SIZE = 4096
+FS_BYTES_PER_INODE = 16384
+FS_INODE_SIZE = 256
+FS_RESERVED_RATIO = 0.05
+FS_JOURNAL_BYTES = 128 * 1024 * 1024
+MIN_PARTITION_BYTES = 512 * 1024 * 1024
+
+# Default number of install steps run concurrently
+JOBS = 4
+
+# Install engines: copy the rootfs file by file to the mounted partition, or
+# build a filesystem image from it and write the image to the partition
+ENGINE_RSYNC = 'rsync'
+ENGINE_IMAGE = 'image'
+ENGINES = (ENGINE_RSYNC, ENGINE_IMAGE)
+
+# Size of the writes of the image engine
+WRITE_BLOCK_SIZE = 4 * 1024 * 1024
+
+# lseek() whence values, missing from the os module of Python 2
+SEEK_DATA = getattr(os, 'SEEK_DATA', 3)
+SEEK_HOLE = getattr(os, 'SEEK_HOLE', 4)
+
+# An install script step, run once the steps listed in deps are complete.
+# cmd is a command line, or a function returning an (ok, error) tuple.
+# Journaled steps are recorded in the build journal and skipped when
+# resuming, the other ones always run. The undo command of a completed step
+# is run on cleanup, after the undo commands of the steps depending on it.
+_Step = collections.namedtuple('_Step',
+                               'key msg cmd data deps undo journaled')
+_Step.__new__.__defaults__ = ('', (), None, True)
+
+
+def _round_up(value, multiple):
+    return (value + multiple - 1) // multiple * multiple
+
+
+def scan_rootfs(rootfs):
+    """
+    Return the (bytes, inodes) used by a root filesystem: the sizes of its
+    files rounded up to filesystem blocks, and its number of inodes. Hard
+    links are counted once.
+    """
+    total = 0
+    inodes = 0
+    seen = set()
+    for dir_path, dir_names, file_names in os.walk(rootfs):
+        for name in dir_names + file_names:
+            st = os.lstat(os.path.join(dir_path, name))
+            if st.st_nlink > 1:
+                if (st.st_dev, st.st_ino) in seen:
+                    continue
+                seen.add((st.st_dev, st.st_ino))
+            inodes += 1
+            total += _round_up(st.st_size, FS_BLOCK_SIZE)
+    return total, inodes
+
+
+def plan_partition_table(rootfs, headroom=None):
+    """
+    Return the smallest partition table holding rootfs with headroom, a
+    fraction of its size and inode count left free. headroom defaults to the
+    partition-headroom configuration value.
+
+    The image grows its root partition to the volume size on first boot.
+    """
+    if headroom is None:
+        headroom = float(config.load()['partition-headroom'])
+    total, inodes = scan_rootfs(rootfs)
+    size = max(total * (1 + headroom),
+               inodes * (1 + headroom) * FS_BYTES_PER_INODE)
+    # Room for the inode tables, the reserved blocks and the journal
+    size = size / (1 - FS_INODE_SIZE / FS_BYTES_PER_INODE - FS_RESERVED_RATIO)
+    size = max(int(size) + FS_JOURNAL_BYTES, MIN_PARTITION_BYTES)
+    sectors = _round_up(size // SECTOR_SIZE + 1, ALIGN_SECTORS)
+    logging.info('Rootfs {} uses {} MiB and {} inodes, planning a {} MiB '
+                 'partition'.format(rootfs, total // (1024 * 1024), inodes,
+                                    sectors * SECTOR_SIZE // (1024 * 1024)))
+    return [(ALIGN_SECTORS, sectors, 83)]
+
+
+def volume_size_gib(table):
+    """
+    Return the size in GiB of the smallest volume holding a partition table.
+    """
+    gib = 1024 * 1024 * 1024
+    return _round_up(_disk_size(table), gib) // gib
+
 
 def _wait_for_file(name, timeout_sec=60, poll_sec=1.5):
     """
@@ -42,15 +147,298 @@ def _sfdisk_part_table(dev, spec):
     return '\n'.join(lines) + '\n'
 
 
-def install_rootfs(dev, rootfs, dryrun=False, partno=1):
+def _has_filesystem(part, fstype='ext4'):
+    """
+    Return True if partition part holds a filesystem of type fstype.
+    """
+    if not _wait_for_file(part, timeout_sec=10):
+        return False
+    ok, data = check_cmd('blkid -o value -s TYPE {}'.format(part))
+    return ok and data['stdout'].strip() == fstype
+
+
+def build_fs_image(rootfs, path, size):
+    """
+    Build an ext4 filesystem image of size bytes from the rootfs directory,
+    in a sparse file. The fstab is written to the image with the UUID of the
+    new filesystem, the rootfs is left untouched.
+
+    The image is built next to path then renamed, so that an existing path
+    always holds a complete image.
+
+    Return (ok, error) tuple.
+    """
+    fs_uuid = str(uuid.uuid4())
+    tmp_path = path + '.tmp'
+    logging.info('Building filesystem image {} from {}'.format(path, rootfs))
+    with open(tmp_path, 'wb') as fp:
+        fp.truncate(size)
+    # Size in KiB, the default block size unit of mkfs
+    ok, err = check_cmd('mkfs.ext4 -q -F -U {} -d {} {} {}'.format(
+        fs_uuid, rootfs, tmp_path, size // 1024))
+    if ok:
+        ok, err = check_cmd('tune2fs -c -0 -i 0 {}'.format(tmp_path))
+    if ok:
+        ok, err = _write_image_fstab(tmp_path, fs_uuid)
+    if ok:
+        os.rename(tmp_path, path)
+    elif os.path.exists(tmp_path):
+        os.unlink(tmp_path)
+    return ok, err
+
+
+def ensure_fs_image(rootfs, path, size):
+    """
+    Build the filesystem image path with build_fs_image(), unless it was
+    already built from the same rootfs and size. These are recorded in the
+    path.sig file next to the image.
+
+    Return (ok, error) tuple.
+    """
+    signature = dict(rootfs=tree_signature(rootfs), size=size)
+    sig_path = path + '.sig'
+    if os.path.exists(path) and os.path.exists(sig_path):
+        with open(sig_path) as fp:
+            if json.load(fp) == signature:
+                logging.info('Reusing filesystem image {}'.format(path))
+                return True, None
+        logging.info('Filesystem image {} was built from another rootfs'
+                     .format(path))
+    ok, err = build_fs_image(rootfs, path, size)
+    if ok:
+        tmp_path = sig_path + '.tmp'
+        with open(tmp_path, 'w') as fp:
+            json.dump(signature, fp)
+        os.rename(tmp_path, sig_path)
+    return ok, err
+
+
+def _write_image_fstab(path, fs_uuid):
+    """
+    Replace /etc/fstab in the filesystem image path with debugfs.
+    """
+    work_dir = tempfile.mkdtemp('-outscale-fstab')
+    try:
+        fstab = os.path.join(work_dir, 'fstab')
+        if not write_fstab(fstab, 'UUID=' + fs_uuid, 'ext4'):
+            return False, 'Cannot write fstab'
+        script = os.path.join(work_dir, 'script')
+        with open(script, 'w') as fp:
+            fp.write('rm /etc/fstab\nwrite {} /etc/fstab\n'.format(fstab))
+        return check_cmd('debugfs -w -f {} {}'.format(script, path))
+    finally:
+        shutil.rmtree(work_dir)
+
+
+def _data_extents(fd, size):
+    """
+    Return the list of (start, end) data extents of a file, holes excluded.
+    Return the whole file if the filesystem cannot report holes.
+    """
+    extents = []
+    pos = 0
+    while pos < size:
+        try:
+            start = os.lseek(fd, pos, SEEK_DATA)
+        except OSError as error:
+            if error.errno == errno.ENXIO:
+                # No data after pos
+                break
+            if error.errno == errno.EINVAL and pos == 0:
+                return [(0, size)]
+            raise
+        pos = min(os.lseek(fd, start, SEEK_HOLE), size)
+        extents.append((start, pos))
+    return extents
+
+
+def write_sparse(src, dst, block_size=WRITE_BLOCK_SIZE):
+    """
+    Copy the data of file src to the same offsets of dst with large
+    sequential writes, skipping the holes of src.
+
+    The content of dst is left untouched in the holes, which is fine for
+    fresh or wiped volumes, and for filesystem images whose holes are unused
+    blocks.
+
+    Return (ok, error) tuple.
+    """
+    logging.info('Writing {} to {}'.format(src, dst))
+    written = 0
+    with tracing.span('Writing image', 'install') as attrs:
+        try:
+            src_fd = os.open(src, os.O_RDONLY)
+            try:
+                dst_fd = os.open(dst, os.O_WRONLY)
+                try:
+                    size = os.fstat(src_fd).st_size
+                    for start, end in _data_extents(src_fd, size):
+                        os.lseek(src_fd, start, os.SEEK_SET)
+                        os.lseek(dst_fd, start, os.SEEK_SET)
+                        pos = start
+                        while pos < end:
+                            chunk = os.read(src_fd, min(block_size, end - pos))
+                            if not chunk:
+                                break
+                            view = memoryview(chunk)
+                            while view:
+                                view = view[os.write(dst_fd, view):]
+                            pos += len(chunk)
+                            written += len(chunk)
+                    os.fsync(dst_fd)
+                finally:
+                    os.close(dst_fd)
+            finally:
+                os.close(src_fd)
+        except (IOError, OSError) as error:
+            logging.error('Cannot write {} to {}: {}'.format(src, dst, error))
+            return False, error
+        attrs['bytes'] = written
+    logging.info('Wrote {} MiB of data'.format(written // (1024 * 1024)))
+    return True, None
+
+
+def _ancestors(steps, key):
+    """
+    Return the keys of the steps key depends on, directly or not.
+    """
+    result = set()
+    todo = list(steps[key].deps)
+    while todo:
+        dep = todo.pop()
+        if dep in steps and dep not in result:
+            result.add(dep)
+            todo.extend(steps[dep].deps)
+    return result
+
+
+def _undo_steps(script, done):
+    """
+    Return the cleanup steps undoing the completed steps of a script.
+    """
+    steps = dict((step.key, step) for step in script)
+    undo = [steps[key] for key in done if steps[key].undo]
+    return [_Step(step.key, '', step.undo,
+                  deps=[other.key for other in undo
+                        if step.key in _ancestors(steps, other.key)])
+            for step in undo]
+
+
+def _partition_path(dev, partno):
+    """
+    Return the path of partition partno of block device dev.
+    """
+    # /dev/loop0p1 and /dev/nvme0n1p1, but /dev/sdb1
+    if dev[-1].isdigit():
+        return '{}p{}'.format(dev, partno)
+    return '{}{}'.format(dev, partno)
+
+
+def _disk_size(table):
+    """
+    Return the size in bytes of a disk holding a partition table, rounded up
+    to the MiB.
+    """
+    end = max(start + size for start, size, _ in table) * SECTOR_SIZE
+    mib = 1024 * 1024
+    return (end + mib - 1) // mib * mib
+
+
+def _device_size(path):
+    """
+    Return the size in bytes of a block device or file.
+    """
+    fd = os.open(path, os.O_RDONLY)
+    try:
+        return os.lseek(fd, 0, os.SEEK_END)
+    finally:
+        os.close(fd)
+
+
+def attach_disk_image(path, dryrun=False, table=PARTITION_TABLE):
+    """
+    Create the sparse raw disk image path if it does not exist, sized for the
+    partition table, and attach it to a loop device which exposes its
+    partitions.
+
+    Return (device, error) tuple, device being None on error.
+    """
+    if not dryrun and not os.path.exists(path):
+        logging.info('Creating disk image {}'.format(path))
+        with open(path, 'wb') as fp:
+            fp.truncate(_disk_size(table))
+    ok, data = check_cmd('losetup --find --show --partscan {}'.format(path),
+                         dryrun=dryrun)
+    if not ok:
+        return None, data
+    dev = data['stdout'].strip() or '/dev/loop0'
+    logging.info('Attached {} to {}'.format(path, dev))
+    return dev, None
+
+
+def detach_disk_image(dev, dryrun=False):
+    """
+    Detach a loop device.
+
+    Return (ok, error) tuple.
+    """
+    logging.info('Detaching {}'.format(dev))
+    return check_cmd('losetup --detach {}'.format(dev), dryrun=dryrun)
+
+
+def install_rootfs(dev, rootfs, dryrun=False, partno=1, incremental=False,
+                   journal=None, jobs=JOBS, engine=ENGINE_RSYNC,
+                   fs_image=None, output_image=None, fit=False):
     """
     Copy rootfs to block device, install grub.
 
-    dev: block device path
+    dev: block device path, ignored if output_image is set.
     rootfs: directory containing root filesystem.
+    incremental: if the device already holds a root filesystem, for example
+    because the volume was created from the snapshot of a previous image,
+    only copy the differences.
+    journal: Journal used to skip the steps completed by a previous run.
+    jobs: maximum number of steps run concurrently.
+    engine: ENGINE_RSYNC to copy the rootfs file by file, or ENGINE_IMAGE to
+    build a filesystem image and write it to the partition.
+    fs_image: with ENGINE_IMAGE, path of the filesystem image to build and
+    keep. An existing image built from the same rootfs and partition size
+    is reused, which saves building it again for another device, see
+    ensure_fs_image(). By default a temporary image is used.
+    output_image: install to this raw disk image file instead of a device,
+    through a loop device. The file is created if it does not exist.
+    fit: use the smallest partition holding rootfs, see
+    plan_partition_table(), instead of PARTITION_TABLE.
 
     Return (ok, error) tuple.
     """
+    if journal is None:
+        journal = Journal()
+    table = PARTITION_TABLE
+    if fit and not incremental:
+        table = plan_partition_table(rootfs)
+    if output_image is None:
+        return _install_rootfs(dev, rootfs, dryrun, partno, incremental,
+                               journal, jobs, engine, fs_image, dev, table)
+    output_image = os.path.abspath(output_image)
+    dev, err = attach_disk_image(output_image, dryrun, table)
+    if dev is None:
+        return False, err
+    try:
+        return _install_rootfs(dev, rootfs, dryrun, partno, incremental,
+                               journal, jobs, engine, fs_image, output_image,
+                               table)
+    finally:
+        detach_disk_image(dev, dryrun)
+
+
+def _install_rootfs(dev, rootfs, dryrun, partno, incremental, journal, jobs,
+                    engine, fs_image, target, table):
+    """
+    Install rootfs to block device dev, see install_rootfs(). target is the
+    device or disk image the journaled steps are recorded for, table the
+    partition table.
+    """
     logging.info('Installing {} on {}'.format(rootfs, dev))
     logging.debug('Waiting for ' + dev)
     if not _wait_for_file(dev):
@@ -59,68 +447,212 @@ def install_rootfs(dev, rootfs, dryrun=False, partno=1):
     # Use the real device path, some commands choke on symlinks
     dev = os.path.realpath(dev)
     rootfs = rootfs.rstrip('/')
-    part = dev + str(partno)
-    parttable = _sfdisk_part_table(dev, PARTITION_TABLE)
+    part = _partition_path(dev, partno)
+    parttable = _sfdisk_part_table(dev, table)
+    if not (dryrun or incremental) and _device_size(dev) < _disk_size(table):
+        return False, '{} is too small for a {} MiB disk'.format(
+            dev, _disk_size(table) // (1024 * 1024))
+
+    if incremental and not dryrun and not _has_filesystem(part):
+        logging.info('No filesystem on {}, doing a full install'.format(part))
+        incremental = False
+    if incremental and engine == ENGINE_IMAGE:
+        logging.info('Incremental install, using the rsync engine')
+        engine = ENGINE_RSYNC
 
     mnt = tempfile.mkdtemp('-outscale-mnt')
+    tmp_image = None
+    if engine == ENGINE_IMAGE and fs_image is None:
+        fd, tmp_image = tempfile.mkstemp('-outscale-fs.img')
+        os.close(fd)
+        os.unlink(tmp_image)
+        fs_image = tmp_image
 
-    script = [
-        ['Partitionning {}'.format(dev),
-         'sfdisk --force {}'.format(dev),
-         parttable],
-        ['Creating FS on {}'.format(part),
-         'mkfs.ext4 {}'.format(part)],
-        ['Tuning FS',
-         'tune2fs -c -0 -i 0 {}'.format(part)],
-        ['Mounting FS {} on {}'.format(part, mnt),
-         'mount -t ext4 {} {}'.format(part, mnt)],
-        ['Creating fstab',
-         'python -m outscale_image_factory.create_fstab {}/etc/fstab {}'
-         .format(rootfs, part)],
-        ['Copying rootfs {} to {}'.format(rootfs, mnt),
-         'rsync -a {}/ {}'.format(rootfs, mnt)],
-        ['Installing grub',
-         'mount --bind /dev {}/dev'.format(mnt)],
-        ['',
-         'mount --bind /proc {}/proc'.format(mnt)],
-        ['',
-         'mount --bind /sys {}/sys'.format(mnt)],
-        ['',
-         'chroot {} grub-install {}'.format(mnt, dev)],
-        ['',
-         'chroot {} update-grub'.format(mnt)],
-        ['Syncing',
-         'sync'],
+    if engine == ENGINE_IMAGE:
+        part_size = table[partno - 1][1] * SECTOR_SIZE
+        script = [
+            _Step('partition', 'Partitionning {}'.format(dev),
+                  'sfdisk --force {}'.format(dev),
+                  parttable),
+            _Step('fs-image', 'Building filesystem image',
+                  lambda: ensure_fs_image(rootfs, fs_image, part_size),
+                  journaled=False),
+            _Step('write', 'Writing filesystem image to {}'.format(part),
+                  lambda: write_sparse(fs_image, part) if
+                  _wait_for_file(part) else
+                  (False, 'Timeout while waiting for ' + part),
+                  deps=['partition', 'fs-image']),
+        ]
+    elif incremental:
+        script = [
+            _Step('fsck', 'Checking FS on {}'.format(part),
+                  'e2fsck -p {}'.format(part)),
+        ]
+        rsync_opts = '-a --delete'
+    else:
+        script = [
+            _Step('partition', 'Partitionning {}'.format(dev),
+                  'sfdisk --force {}'.format(dev),
+                  parttable),
+            _Step('mkfs', 'Creating FS on {}'.format(part),
+                  'mkfs.ext4 {}'.format(part),
+                  deps=['partition']),
+            _Step('tune2fs', 'Tuning FS',
+                  'tune2fs -c -0 -i 0 {}'.format(part),
+                  deps=['mkfs']),
+        ]
+        rsync_opts = '-a'
+    # The fstab needs the UUID of the new filesystem, it is written to the
+    # target after the copy: the rootfs may be shared by other installs. The
+    # bind mounts must come after the copy, or rsync would write through them.
+    binds = ['bind-dev', 'bind-proc', 'bind-sys']
+    script += [
+        _Step('mount', 'Mounting FS {} on {}'.format(part, mnt),
+              'mount -t ext4 {} {}'.format(part, mnt),
+              deps=['mkfs', 'fsck', 'write'], undo='umount {}'.format(part),
+              journaled=False),
     ]
+    if engine == ENGINE_RSYNC:
+        script += [
+            _Step('rsync', 'Copying rootfs {} to {}'.format(rootfs, mnt),
+                  'rsync {} {}/ {}'.format(rsync_opts, rootfs, mnt),
+                  deps=['mount']),
+            _Step('fstab', 'Creating fstab',
+                  'python -m outscale_image_factory.create_fstab {}/etc/fstab {}'
+                  .format(mnt, part),
+                  deps=['rsync']),
+        ]
+    script += [
+        _Step('bind-dev', 'Installing grub',
+              'mount --bind /dev {}/dev'.format(mnt),
+              deps=['mount', 'fstab'], undo='umount {}/dev'.format(mnt),
+              journaled=False),
+        _Step('bind-proc', '',
+              'mount --bind /proc {}/proc'.format(mnt),
+              deps=['mount', 'fstab'], undo='umount {}/proc'.format(mnt),
+              journaled=False),
+        _Step('bind-sys', '',
+              'mount --bind /sys {}/sys'.format(mnt),
+              deps=['mount', 'fstab'], undo='umount {}/sys'.format(mnt),
+              journaled=False),
+        _Step('grub-install', '',
+              'chroot {} grub-install {}'.format(mnt, dev),
+              deps=binds),
+        _Step('update-grub', '',
+              'chroot {} update-grub'.format(mnt),
+              deps=['grub-install']),
+        _Step('sync', 'Syncing',
+              'sync',
+              deps=['update-grub', 'tune2fs'], journaled=False),
+    ]
+
+    # The device path may be reused by another volume: tie the journaled
+    # steps to the volume recorded by create-volume, if any.
+    volume_id = (journal.outputs('create-volume') or {}).get('volume_id')
+    inputs = dict(dev=target, rootfs=rootfs, volume_id=volume_id,
+                  incremental=incremental, engine=engine, table=table)
+    journal_lock = threading.Lock()
+    # Completed steps, kept up to date in case run_graph is interrupted
+    done = []
+
+    def run(step):
+        name = 'install-rootfs:' + step.key
+        if step.journaled:
+            with journal_lock:
+                if journal.get(name, inputs) is not None:
+                    return True, None
+        if step.msg:
+            logging.info(step.msg)
+        if callable(step.cmd):
+            with tracing.span(step.msg, 'install'):
+                ok, err = (True, None) if dryrun else step.cmd()
+        else:
+            with tracing.span(step.msg or step.cmd, 'install'):
+                ok, err = check_cmd(step.cmd, step.data, dryrun)
+        if ok and step.journaled and not dryrun:
+            with journal_lock:
+                journal.record(name, inputs)
+        if ok:
+            done.append(step.key)
+        return ok, err
 
-    ok = True
     try:
-        while script and ok:
-            lst = script.pop(0)
-            msg, cmd = lst[:2]
-            data = ''
-            if len(lst) == 3:
-                data = lst[2]
-            if msg:
-                logging.info(msg)
-            ok, err = check_cmd(cmd, data, dryrun)
+        ok, err, _ = run_graph(script, run, jobs)
     finally:
         logging.info('Unmounting')
-        check_cmd('umount {}/dev'.format(mnt), dryrun=dryrun)
-        check_cmd('umount {}/proc'.format(mnt), dryrun=dryrun)
-        check_cmd('umount {}/sys'.format(mnt), dryrun=dryrun)
-        check_cmd('umount {}'.format(part), dryrun=dryrun)
+        with tracing.span('Unmounting', 'install'):
+            run_graph(_undo_steps(script, done),
+                      lambda step: check_cmd(step.cmd, dryrun=dryrun),
+                      jobs, keep_going=True)
         logging.info('Removing {}'.format(mnt))
         os.rmdir(mnt)
+        if tmp_image is not None:
+            for path in (tmp_image, tmp_image + '.sig'):
+                if os.path.exists(path):
+                    os.unlink(path)
     return ok, err
 
 
 def cmd_install_rootfs(args):
-    ok, _ = install_rootfs(args.device, args.rootfs)
+    ok, _ = install_rootfs(args.device, args.rootfs,
+                           incremental=args.incremental,
+                           journal=Journal(args.journal),
+                           jobs=args.jobs,
+                           engine=args.engine,
+                           fs_image=args.fs_image,
+                           output_image=args.output_image,
+                           fit=args.fit)
     return ok
 
 
 def parser_install_rootfs(parser):
     parser.description = 'Install a system from a rootfs to a device'
     parser.add_argument('rootfs')
-    parser.add_argument('-d', '--device')
+    add_target_arguments(parser)
+    parser.add_argument('-i', '--incremental', action='store_true',
+                        help='Only copy the differences if the device '
+                        'already holds a root filesystem')
+    parser.add_argument('-j', '--journal', metavar='FILE',
+                        help='Record completed steps in FILE, skip them '
+                        'when run again')
+    parser.add_argument('--jobs', type=positive_int, default=JOBS,
+                        help='Maximum number of install steps run '
+                        'concurrently (default: %(default)s)')
+    add_engine_arguments(parser)
+
+
+def add_target_arguments(parser):
+    group = parser.add_mutually_exclusive_group()
+    group.add_argument('-d', '--device')
+    group.add_argument('--output-image', metavar='FILE',
+                       help='Install to a raw disk image file instead of a '
+                       'device, through a loop device')
+
+
+def add_engine_arguments(parser):
+    parser.add_argument('--engine', choices=ENGINES, default=ENGINE_RSYNC,
+                        help='Copy the rootfs file by file, or write a '
+                        'filesystem image built from it (default: '
+                        '%(default)s)')
+    parser.add_argument('--fs-image', metavar='FILE',
+                        help='With the image engine, keep the filesystem '
+                        'image in FILE, or reuse it if it was built from '
+                        'the same rootfs')
+    parser.add_argument('--fit', action='store_true',
+                        help='Use the smallest partition holding the rootfs, '
+                        'grown to the volume size on first boot')
+
+
+def cmd_write_image(args):
+    dev = os.path.realpath(args.device)
+    if not _wait_for_file(dev):
+        logging.error('Timeout while waiting for ' + dev)
+        return False
+    ok, _ = write_sparse(args.image, dev)
+    return ok
+
+
+def parser_write_image(parser):
+    parser.description = 'Write a raw disk image to a device'
+    parser.add_argument('image', metavar='IMAGE')
+    parser.add_argument('-d', '--device', required=True)
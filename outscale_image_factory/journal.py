@@ -0,0 +1,123 @@
+"""
+On-disk journal of completed build steps.
+
+Each step is recorded with a digest of its inputs and its outputs (volume id,
+snapshot id, ...). When a build is re-run with the same journal, steps which
+completed with the same inputs, and whose outputs are still valid, are
+skipped. Re-running a step drops the records of all the steps completed after
+it, since they may depend on it.
+
+All the omi-factory commands of a build can share one journal file.
+"""
+from __future__ import division, absolute_import, print_function, unicode_literals
+
+import hashlib
+import json
+import logging
+import os
+import time
+
+
+def _digest(inputs):
+    return hashlib.sha1(json.dumps(inputs, sort_keys=True).encode('utf-8'))\
+        .hexdigest()
+
+
+def file_signature(path):
+    """
+    Return a cheap signature of a file or directory: path, size and mtime.
+    """
+    st = os.stat(path)
+    return [os.path.abspath(path), st.st_size, int(st.st_mtime)]
+
+
+def tree_signature(path):
+    """
+    Return a digest of the paths, sizes and mtimes of the files in a tree.
+    """
+    entries = []
+    for dir_path, dir_names, file_names in os.walk(path):
+        dir_names.sort()
+        for name in sorted(file_names):
+            full_path = os.path.join(dir_path, name)
+            st = os.lstat(full_path)
+            entries.append([os.path.relpath(full_path, path), st.st_size,
+                            int(st.st_mtime)])
+    return _digest(entries)
+
+
+class Journal(object):
+
+    """
+    Step journal stored in a JSON file. With path None, nothing is recorded
+    and no step is ever skipped.
+    """
+
+    def __init__(self, path=None):
+        self.path = path
+        self.steps = []
+        if path and os.path.exists(path):
+            with open(path) as fp:
+                self.steps = json.load(fp)['steps']
+
+    def _index(self, name):
+        for i, step in enumerate(self.steps):
+            if step['name'] == name:
+                return i
+        return None
+
+    def outputs(self, name):
+        """
+        Return the recorded outputs of a step, whatever its inputs, or None.
+        """
+        i = self._index(name)
+        return None if i is None else self.steps[i]['outputs']
+
+    def get(self, name, inputs, valid=None):
+        """
+        Return the outputs of a step completed with the same inputs, or None.
+
+        valid: optional function taking the outputs and returning False if
+        they are stale (for example a volume which no longer exists).
+        """
+        i = self._index(name)
+        if i is None or self.steps[i]['inputs'] != _digest(inputs):
+            return None
+        outputs = self.steps[i]['outputs']
+        if valid is not None and not valid(outputs):
+            logging.info('Journal: outputs of step {} are stale'.format(name))
+            return None
+        logging.info('Journal: skipping completed step {}'.format(name))
+        return outputs
+
+    def record(self, name, inputs, outputs=None):
+        """
+        Record the completion of a step, forget the steps completed after it.
+        """
+        if self.path is None:
+            return
+        i = self._index(name)
+        if i is not None:
+            del self.steps[i:]
+        self.steps.append(dict(name=name, inputs=_digest(inputs),
+                               outputs=outputs or {}, time=time.time()))
+        tmp = self.path + '.tmp'
+        with open(tmp, 'w') as fp:
+            json.dump(dict(steps=self.steps), fp, indent=1, sort_keys=True)
+        os.rename(tmp, self.path)
+
+    def run(self, name, inputs, func, valid=None):
+        """
+        Run func unless the step already completed with the same inputs.
+
+        func returns an (ok, outputs) tuple; outputs are recorded on success.
+
+        Return (ok, outputs) tuple.
+        """
+        outputs = self.get(name, inputs, valid)
+        if outputs is not None:
+            return True, outputs
+        ok, outputs = func()
+        if ok:
+            self.record(name, inputs, outputs)
+        return ok, outputs
@@ -17,6 +17,7 @@ except ImportError:
     HAS_BOTO = False
 
 from outscale_image_factory import tkl_commands
+from outscale_image_factory import tracing
 from outscale_image_factory import install
 if HAS_BOTO:
     from outscale_image_factory import create_ami
@@ -80,6 +81,10 @@ def main(argv=None):
         '--verbose',
         action='store_true',
         help='Turn on debug output')
+    parser.add_argument(
+        '--trace',
+        metavar='FILE',
+        help='Write a JSON timeline of commands, API calls and waits to FILE')
 
     if len(argv) < 1:
         argv.append('--help')
@@ -93,7 +98,15 @@ def main(argv=None):
     logging.getLogger('boto').setLevel(boto_loglevel)
 
     # Run command
-    ok = args.func(args)
+    if args.trace:
+        tracing.enable()
+    try:
+        with tracing.span(args.commands, 'command'):
+            ok = args.func(args)
+    finally:
+        if args.trace:
+            logging.info('Writing trace to {}'.format(args.trace))
+            tracing.write(args.trace)
     return 0 if ok else 1
 
 
@@ -0,0 +1,197 @@
+"""
+Apply tklpatch(1) patches to a root filesystem in a single pass.
+
+tklpatch-apply copies the overlay of a patch and runs its conf script in a
+chroot, once per patch. Here the overlays of all the patches are merged into
+one copy plan, the last patch writing a path wins, and the files are copied
+by a pool of threads. The debs and conf scripts of the patches then run in
+order, in a single tklpatch-chroot session: like tklpatch-apply, the debs
+of a patch are installed before its conf script runs.
+
+Unlike tklpatch-apply, all the overlays are copied before the first conf
+script runs. Directories already in the rootfs keep their mode and owner.
+"""
+from __future__ import division, absolute_import, print_function, unicode_literals
+
+import collections
+import glob
+import logging
+import os
+import shutil
+import stat
+import time
+from multiprocessing.pool import ThreadPool
+
+from outscale_image_factory import tracing
+from outscale_image_factory.helper import check_cmd
+
+
+JOBS = 8
+# Directory of the conf scripts in the rootfs, while they run
+CONF_DIR = 'tmp/omi-factory-patches'
+
+_RUNNER = '''#!/bin/sh
+# Install the debs and run the conf scripts of the patches, record their
+# durations
+set -e
+cd /{conf_dir}
+for patch in {patches}; do
+    start=$(date +%s.%N)
+    if [ -d $patch.debs ]; then
+        dpkg -i $patch.debs/*.deb
+    fi
+    if [ -f $patch ]; then
+        ./$patch
+    fi
+    echo "$patch $start $(date +%s.%N)" >>times
+done
+'''
+
+
+def plan_overlays(patch_paths):
+    """
+    Return the copy plan of the overlays of patch_paths, a list of
+    (relative path, source path, patch) tuples. Parent directories come
+    before their content, the last patch providing a path wins.
+    """
+    plan = collections.OrderedDict()
+    for patch_path in patch_paths:
+        patch = os.path.basename(patch_path)
+        overlay = os.path.join(patch_path, 'overlay')
+        for dir_path, dir_names, file_names in os.walk(overlay):
+            dir_names.sort()
+            for name in dir_names + sorted(file_names):
+                src = os.path.join(dir_path, name)
+                rel = os.path.relpath(src, overlay)
+                # A path already planned keeps its place
+                plan[rel] = (rel, src, patch)
+    return list(plan.values())
+
+
+def _copy_attributes(src, dst, st):
+    os.lchown(dst, st.st_uid, st.st_gid)
+    if not stat.S_ISLNK(st.st_mode):
+        # After chown, which clears the setuid bits
+        os.chmod(dst, stat.S_IMODE(st.st_mode))
+        os.utime(dst, (st.st_atime, st.st_mtime))
+
+
+def _copy_file(src, dst):
+    """
+    Replace dst with a copy of the file or symlink src.
+    """
+    st = os.lstat(src)
+    tmp = dst + '.omi-factory-tmp'
+    if stat.S_ISLNK(st.st_mode):
+        os.symlink(os.readlink(src), tmp)
+    else:
+        shutil.copyfile(src, tmp)
+    _copy_attributes(src, tmp, st)
+    os.rename(tmp, dst)
+
+
+def copy_overlays(rootfs, plan, jobs=JOBS):
+    """
+    Copy the files of the plan to rootfs, jobs at a time.
+
+    Return a Counter of the paths copied from each patch.
+    """
+    counts = collections.Counter()
+    files = []
+    # Directories are created first, in order
+    for rel, src, patch in plan:
+        dst = os.path.join(rootfs, rel)
+        counts[patch] += 1
+        if os.path.isdir(src) and not os.path.islink(src):
+            if not os.path.isdir(dst):
+                os.mkdir(dst)
+                _copy_attributes(src, dst, os.lstat(src))
+        else:
+            files.append((src, dst))
+    pool = ThreadPool(jobs)
+    try:
+        pool.map(lambda args: _copy_file(*args), files)
+    finally:
+        pool.close()
+        pool.join()
+    return counts
+
+
+def apply_patches(rootfs, patch_paths, jobs=JOBS):
+    """
+    Apply the patches of patch_paths to rootfs: copy the merged overlays,
+    run the conf scripts in one chroot session.
+
+    Return (ok, data) tuple, data being a dict of the number of paths
+    copied, of debs installed and of the duration of the debs and conf
+    script of each patch, or the error.
+    """
+    for patch_path in patch_paths:
+        if not os.path.isdir(patch_path):
+            return False, '{} is not a patch directory'.format(patch_path)
+    with tracing.span('Copying overlays', 'install'):
+        clock = time.time()
+        plan = plan_overlays(patch_paths)
+        try:
+            counts = copy_overlays(rootfs, plan, jobs)
+        except (IOError, OSError) as error:
+            logging.error('Cannot copy overlays: {}'.format(error))
+            return False, repr(error)
+        logging.info('Copied {} overlay paths in {:.1f}s'.format(
+            len(plan), time.time() - clock))
+    data = dict((os.path.basename(patch_path),
+                 dict(paths=counts[os.path.basename(patch_path)]))
+                for patch_path in patch_paths)
+    confs = [patch_path for patch_path in patch_paths
+             if os.path.isfile(os.path.join(patch_path, 'conf')) or
+             glob.glob(os.path.join(patch_path, 'debs', '*.deb'))]
+    if confs:
+        with tracing.span('Installing debs and running conf scripts',
+                          'install'):
+            ok, err = _run_confs(rootfs, confs, data)
+        if not ok:
+            return ok, err
+    for patch, timings in sorted(data.items()):
+        logging.info('Patch {}: {} paths, {} debs, conf {}'.format(
+            patch, timings['paths'], timings.get('debs', 0),
+            '{:.1f}s'.format(timings['conf_sec']) if 'conf_sec' in timings
+            else 'none'))
+    return True, data
+
+
+def _run_confs(rootfs, confs, data):
+    conf_dir = os.path.join(rootfs, CONF_DIR)
+    if os.path.exists(conf_dir):
+        shutil.rmtree(conf_dir)
+    os.makedirs(conf_dir)
+    try:
+        patches = []
+        for patch_path in confs:
+            patch = os.path.basename(patch_path)
+            debs = glob.glob(os.path.join(patch_path, 'debs', '*.deb'))
+            if debs:
+                os.mkdir(os.path.join(conf_dir, patch + '.debs'))
+                for deb in debs:
+                    shutil.copy(deb, os.path.join(conf_dir, patch + '.debs'))
+                data[patch]['debs'] = len(debs)
+            if os.path.isfile(os.path.join(patch_path, 'conf')):
+                shutil.copy(os.path.join(patch_path, 'conf'),
+                            os.path.join(conf_dir, patch))
+                os.chmod(os.path.join(conf_dir, patch), 0o755)
+            patches.append(patch)
+        runner = os.path.join(conf_dir, 'run')
+        with open(runner, 'w') as fp:
+            fp.write(_RUNNER.format(conf_dir=CONF_DIR,
+                                    patches=' '.join(patches)))
+        os.chmod(runner, 0o755)
+        ok, err = check_cmd('tklpatch-chroot {} /{}/run'.format(rootfs,
+                                                               CONF_DIR))
+        times_path = os.path.join(conf_dir, 'times')
+        if os.path.exists(times_path):
+            with open(times_path) as fp:
+                for line in fp:
+                    patch, start, end = line.split()
+                    data[patch]['conf_sec'] = float(end) - float(start)
+        return ok, err
+    finally:
+        shutil.rmtree(conf_dir)
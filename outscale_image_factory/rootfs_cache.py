@@ -0,0 +1,188 @@
+"""
+Cache of the root filesystems extracted from ISO files and patched.
+
+An entry is keyed by the content hashes of the ISO file and of each patch
+directory, in order. Entries are never modified once added, so concurrent
+installs copy them as they are: each install holds a shared lock on the
+entry it uses. The least recently used entries are evicted when the cache
+grows over its size budget, unless they are in use.
+
+The index of the cache is a JSON file protected by a file lock. It also
+records the hashes of the ISO files by inode, size and mtime, so an ISO is
+only hashed once.
+"""
+from __future__ import division, absolute_import, print_function, unicode_literals
+
+import contextlib
+import errno
+import hashlib
+import json
+import logging
+import os
+import shutil
+import time
+
+from outscale_image_factory.helper import check_cmd, file_lock
+from outscale_image_factory.install import scan_rootfs
+
+
+GIB = 1024 * 1024 * 1024
+_CHUNK_SIZE = 1024 * 1024
+_INDEX = 'index.json'
+
+
+def file_hash(path):
+    """
+    Return the sha256 hex digest of the content of a file.
+    """
+    digest = hashlib.sha256()
+    with open(path, 'rb') as fp:
+        for chunk in iter(lambda: fp.read(_CHUNK_SIZE), b''):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+def tree_hash(path):
+    """
+    Return the sha256 hex digest of a tree: the paths, modes, symlink
+    targets and file contents.
+    """
+    digest = hashlib.sha256()
+    for dir_path, dir_names, file_names in os.walk(path):
+        dir_names.sort()
+        for name in sorted(dir_names + file_names):
+            full_path = os.path.join(dir_path, name)
+            st = os.lstat(full_path)
+            if os.path.islink(full_path):
+                content = os.readlink(full_path)
+            elif os.path.isfile(full_path):
+                content = file_hash(full_path)
+            else:
+                content = ''
+            digest.update(json.dumps([os.path.relpath(full_path, path),
+                                      st.st_mode, content]).encode('utf-8'))
+    return digest.hexdigest()
+
+
+class RootfsCache(object):
+
+    """
+    Cache directory holding at most budget bytes of root filesystems.
+    """
+
+    def __init__(self, path, budget):
+        self.path = os.path.abspath(path)
+        self.budget = budget
+        if not os.path.isdir(self.path):
+            os.makedirs(self.path)
+
+    def entry_path(self, key):
+        """
+        Return the path of the rootfs of key.
+        """
+        return os.path.join(self.path, key)
+
+    @contextlib.contextmanager
+    def _index(self):
+        """
+        Yield the index, saved back on exit, holding the cache lock.
+        """
+        index_path = os.path.join(self.path, _INDEX)
+        with file_lock(index_path + '.lock'):
+            index = dict(isos={}, entries={})
+            if os.path.exists(index_path):
+                with open(index_path) as fp:
+                    index = json.load(fp)
+            yield index
+            tmp = index_path + '.tmp'
+            with open(tmp, 'w') as fp:
+                json.dump(index, fp, indent=1, sort_keys=True)
+            os.rename(tmp, index_path)
+
+    def _iso_hash(self, iso):
+        iso = os.path.abspath(iso)
+        st = os.stat(iso)
+        signature = [st.st_dev, st.st_ino, st.st_size, repr(st.st_mtime)]
+        with self._index() as index:
+            cached = index['isos'].get(iso)
+            if cached is not None and cached[:-1] == signature:
+                return cached[-1]
+        logging.info('Hashing {}'.format(iso))
+        iso_hash = file_hash(iso)
+        with self._index() as index:
+            index['isos'][iso] = signature + [iso_hash]
+        return iso_hash
+
+    def key(self, iso, patch_paths):
+        """
+        Return the key of the rootfs extracted from iso and patched with the
+        patch directories of patch_paths, in order.
+        """
+        inputs = [self._iso_hash(iso)] + \
+            [[os.path.basename(path), tree_hash(path)] for path in patch_paths]
+        return hashlib.sha256(json.dumps(inputs).encode('utf-8')).hexdigest()
+
+    @contextlib.contextmanager
+    def use(self, key):
+        """
+        Hold a shared lock on the entry of key, so that it is not evicted.
+        Yield the path of the entry, or None if it is not cached yet.
+        """
+        with file_lock(self.entry_path(key) + '.lock', shared=True):
+            path = None
+            with self._index() as index:
+                entry = index['entries'].get(key)
+                if entry is not None and \
+                        os.path.isdir(self.entry_path(key)):
+                    entry['used'] = time.time()
+                    path = self.entry_path(key)
+            if path is not None:
+                logging.info('Using cached rootfs {}'.format(path))
+            yield path
+
+    def add(self, key, rootfs):
+        """
+        Move the rootfs directory to the entry of key, evict the least
+        recently used entries over the budget.
+
+        Return (ok, error) tuple.
+        """
+        path = self.entry_path(key)
+        with self._index() as index:
+            if key in index['entries'] and os.path.isdir(path):
+                # Added by a concurrent install
+                shutil.rmtree(rootfs.encode('utf-8'))
+                return True, None
+            if os.path.exists(path):
+                # Leftovers of an interrupted copy
+                shutil.rmtree(path.encode('utf-8'))
+            logging.info('Adding {} to the rootfs cache'.format(rootfs))
+            try:
+                os.rename(rootfs, path)
+            except OSError as error:
+                if error.errno != errno.EXDEV:
+                    raise
+                ok, data = check_cmd('cp -a {} {}'.format(rootfs, path))
+                if not ok:
+                    return False, data
+                shutil.rmtree(rootfs.encode('utf-8'))
+            size, _ = scan_rootfs(path.encode('utf-8'))
+            index['entries'][key] = dict(size=size, used=time.time())
+            self._evict(index)
+        return True, None
+
+    def _evict(self, index):
+        entries = index['entries']
+        total = sum(entry['size'] for entry in entries.values())
+        for key in sorted(entries, key=lambda key: entries[key]['used']):
+            if total <= self.budget:
+                break
+            with file_lock(self.entry_path(key) + '.lock',
+                           blocking=False) as locked:
+                if not locked:
+                    # In use
+                    continue
+                logging.info('Evicting {} from the rootfs cache'.format(key))
+                if os.path.isdir(self.entry_path(key)):
+                    shutil.rmtree(self.entry_path(key).encode('utf-8'))
+                total -= entries.pop(key)['size']
@@ -1 +1,17 @@
 from .test_create_ami import TestCreateAmi
+from .test_waiter import TestWaiter
+from .test_device_lease import TestDeviceLease
+from .test_journal import TestJournal
+from .test_helper import TestCheckCmd
+from .test_helper import TestRunGraph
+from .test_install import TestImageEngine
+from .test_fingerprint import TestFingerprint
+from .test_git_mirror import TestGitMirror
+from .test_rootfs_cache import TestRootfsCache
+from .test_patch_engine import TestPatchEngine
+from .test_apt_cache import TestAptCache
+from .test_find_package_references import TestFindPackageReferences
+from .test_url_check import TestUrlCheck
+from .test_tklgit import TestTklgit
+from .test_cleanup import TestCleanup
+from .test_tkl_commands import TestTklCommands
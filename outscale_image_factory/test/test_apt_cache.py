@@ -0,0 +1,122 @@
+"""
+Unit tests for apt_cache.
+"""
+import BaseHTTPServer
+import SocketServer
+import collections
+import hashlib
+import os
+import shutil
+import tempfile
+import threading
+import time
+import unittest
+import urllib2
+from outscale_image_factory import apt_cache
+
+
+class _Upstream(SocketServer.ThreadingMixIn, BaseHTTPServer.HTTPServer):
+
+    daemon_threads = True
+
+
+class _UpstreamHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+
+    def log_message(self, *args):
+        pass
+
+    def do_GET(self):
+        self.server.requests[self.path] += 1
+        if self.path.endswith('missing.deb'):
+            self.send_error(404)
+            return
+        # Slow enough for concurrent requests to be coalesced
+        time.sleep(0.2)
+        body = ('content of ' + self.path).encode('utf-8')
+        self.send_response(200)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+
+def _serve(server):
+    thread = threading.Thread(target=server.serve_forever)
+    thread.daemon = True
+    thread.start()
+
+
+class TestAptCache(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp()
+        self.upstream = _Upstream(('127.0.0.1', 0), _UpstreamHandler)
+        self.upstream.requests = collections.Counter()
+        _serve(self.upstream)
+        self.store = apt_cache.Store(self.tmp_dir, 1024 * 1024)
+        self.proxy = apt_cache.AptCacheServer(('127.0.0.1', 0), self.store)
+        _serve(self.proxy)
+        self.opener = urllib2.build_opener(urllib2.ProxyHandler(
+            {'http': 'http://127.0.0.1:{}'.format(self.proxy.server_port)}))
+
+    def tearDown(self):
+        self.proxy.shutdown()
+        self.upstream.shutdown()
+        self.proxy.server_close()
+        self.upstream.server_close()
+        shutil.rmtree(self.tmp_dir)
+
+    def _get(self, path):
+        url = 'http://127.0.0.1:{}{}'.format(self.upstream.server_port, path)
+        try:
+            return self.opener.open(url).read()
+        except urllib2.HTTPError as error:
+            return error.code
+
+    def test_cache(self):
+        results = []
+        threads = [threading.Thread(
+            target=lambda: results.append(self._get('/pool/a.deb')))
+            for _ in range(4)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        self.assertEqual(results, [b'content of /pool/a.deb'] * 4)
+        self.assertEqual(self._get('/pool/a.deb'), b'content of /pool/a.deb')
+        # Downloaded once, the other requests are hits
+        self.assertEqual(self.upstream.requests['/pool/a.deb'], 1)
+        # Index files are forwarded, errors are not cached
+        self._get('/dists/Release')
+        self._get('/dists/Release')
+        self.assertEqual(self.upstream.requests['/dists/Release'], 2)
+        self.assertEqual(self._get('/pool/missing.deb'), 404)
+        self.assertEqual(self._get('/pool/missing.deb'), 404)
+        self.assertEqual(self.upstream.requests['/pool/missing.deb'], 2)
+        stats = self.store.report()
+        self.assertEqual(stats['hits'], 4)
+        self.assertEqual(stats['misses'], 3)
+        self.assertEqual(stats['bytes_saved'], 4 * len('content of /pool/a.deb'))
+        self.assertEqual(stats['passthrough'], 2)
+
+    def test_index(self):
+        for url in ('http://a/a.deb', 'http://a/b.deb'):
+            tmp = self.store.temp_file()
+            tmp.write(url)
+            tmp.close()
+            self.assertEqual(self.store.open(url), (None, None))
+            self.store.store(url, tmp.name, hashlib.sha256(url).hexdigest(),
+                             len(url))
+        # Saved with each file, as the service may be killed
+        store = apt_cache.Store(self.tmp_dir, 1024 * 1024)
+        self.assertEqual(sorted(store.urls), sorted(self.store.urls))
+        # Files and index out of sync after a crash
+        digest = self.store.urls[sorted(self.store.urls)[0]]
+        os.unlink(store.object_path(digest))
+        orphan = store.object_path('ff' + '0' * 62)
+        os.makedirs(os.path.dirname(orphan))
+        open(orphan, 'w').close()
+        store = apt_cache.Store(self.tmp_dir, 1024 * 1024)
+        self.assertEqual(len(store.urls), 1)
+        self.assertNotIn(digest, store.objects)
+        self.assertFalse(os.path.exists(orphan))
+        self.assertEqual(store.stats['orphans'], 1)
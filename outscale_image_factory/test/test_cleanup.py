@@ -0,0 +1,109 @@
+"""
+Unit tests for cleanup.
+"""
+import os
+import shutil
+import tempfile
+import unittest
+from outscale_image_factory import cleanup
+from outscale_image_factory import config
+from outscale_image_factory import create_ami
+from outscale_image_factory.fake_ec2 import FakeEC2
+from outscale_image_factory.test.test_create_ami import DELAYS, \
+    VOLUME_LOCATION
+
+
+class TestCleanup(unittest.TestCase):
+
+    def setUp(self):
+        self.fake = FakeEC2(delays=DELAYS)
+        self.fake.start()
+        self.connection = self.fake.connect()
+        self.tmp_dir = tempfile.mkdtemp()
+        self.config = config.load()
+        self.saved_config = dict(self.config)
+        self.config['device-lease-file'] = os.path.join(self.tmp_dir,
+                                                        'devices.json')
+
+    def tearDown(self):
+        self.fake.stop()
+        self.config.clear()
+        self.config.update(self.saved_config)
+        shutil.rmtree(self.tmp_dir)
+
+    def _volume(self, tags):
+        volume = self.connection.create_volume(1, VOLUME_LOCATION)
+        if tags:
+            self.connection.create_tags(volume.id, tags)
+        return volume
+
+    def _live(self):
+        volumes = [volume.id for volume in self.connection.get_all_volumes()
+                   if volume.status != 'deleting']
+        instances = [instance.id for instance
+                     in self.connection.get_only_instances()
+                     if instance.state == 'running']
+        return sorted(volumes), sorted(instances)
+
+    def test_search_and_destroy(self):
+        tags = {'build': 'nightly', 'owner': 'factory'}
+        instances = [self.fake.add_instance({'build': 'nightly'}),
+                     self.fake.add_instance({'owner': 'factory'})]
+        kept_instance = self.fake.add_instance({'build': 'release'})
+        volumes = [self._volume({'build': 'nightly'}) for _ in range(5)] + \
+            [self._volume({'owner': 'factory'})]
+        kept_volumes = [self._volume({'build': 'release'}), self._volume({})]
+        create_ami._wait_for_all(self.connection, volumes + kept_volumes,
+                                 create_ami.AVAILABLE)
+        for volume in volumes[:2]:
+            create_ami._attach(self.connection, volume, instances[0])
+
+        summary = cleanup.search_and_destroy(self.connection, tags,
+                                             dryrun=True)
+        self.assertEqual((summary['instances'], summary['volumes'],
+                          summary['removed_instances'],
+                          summary['removed_volumes']), (2, 6, 0, 0))
+        self.assertEqual(len(self._live()[0]), 8)
+
+        calls = self.fake.calls.copy()
+        summary = cleanup.search_and_destroy(self.connection, tags, jobs=4)
+        calls = self.fake.calls - calls
+        self.assertEqual((summary['instances'], summary['volumes'],
+                          summary['removed_instances'],
+                          summary['removed_volumes'], summary['errors']),
+                         (2, 6, 2, 6, 0))
+        self.assertEqual(self._live(),
+                         (sorted(volume.id for volume in kept_volumes),
+                          [kept_instance]))
+        self.assertEqual(calls['TerminateInstances'], 1)
+        self.assertEqual(calls['DescribeInstances'], 1)
+        self.assertEqual(calls['DeleteVolume'], 6)
+
+    def test_failed_removals(self):
+        tags = {'build': 'nightly'}
+        instance_id = self.fake.add_instance(tags)
+        volumes = [self._volume(tags) for _ in range(3)]
+        create_ami._wait_for_all(self.connection, volumes,
+                                 create_ami.AVAILABLE)
+        saved = cleanup.terminate_instances, cleanup.destroy_volumes
+        cleanup.terminate_instances = \
+            lambda conn, instance_ids: {instance_id: 'error'}
+        cleanup.destroy_volumes = lambda conn, volumes, jobs: (
+            False, {volumes[0].id: 'error'})
+        try:
+            summary = cleanup.search_and_destroy(self.connection, tags)
+        finally:
+            cleanup.terminate_instances, cleanup.destroy_volumes = saved
+        # Only the removals which succeeded are counted
+        self.assertEqual((summary['instances'], summary['volumes'],
+                          summary['removed_instances'],
+                          summary['removed_volumes'], summary['errors']),
+                         (1, 3, 0, 2, 2))
+
+    def test_terminate_errors(self):
+        instance_id = self.fake.add_instance()
+        errors = cleanup.terminate_instances(
+            self.connection, [instance_id, 'i-missing'])
+        self.assertEqual(list(errors), ['i-missing'])
+        self.assertEqual(self.fake.instances[instance_id]['state'],
+                         'shutting-down')
@@ -1,12 +1,30 @@
 """
 Unit tests for create_ami.
 """
+import StringIO
+import argparse
+import os
+import shutil
+import sys
+import tempfile
+import threading
 import unittest
-import boto
+import boto.ec2
+import boto.exception
+from outscale_image_factory import config
 from outscale_image_factory import create_ami
+from outscale_image_factory import device_lease
+from outscale_image_factory import fake_ec2
+from outscale_image_factory.fake_ec2 import FakeEC2
 
 DUMMY_INSTANCE_ID = 'DUMMY_INSTANCE_ID'
 
+VOLUME_LOCATION = 'eu-west-1a'
+
+DELAYS = dict(create_volume=0.05, attach=0.05, detach=0.05,
+              delete_volume=0.05, snapshot_per_gib=0.01, register_image=0.05,
+              terminate=0.05)
+
 DEVICE_NAMES = set([
     '/dev/sdb',
     '/dev/sdc',
@@ -41,37 +59,267 @@ assert len(DEVICE_NAMES) == 25
 class TestCreateAmi(unittest.TestCase):
 
     def setUp(self):
-        self.connection = boto.ec2.connect_to_region(create_ami.REGION)
+        self.fake = FakeEC2(delays=DELAYS)
+        self.fake.start()
+        self.connection = self.fake.connect()
+        self.tmp_dir = tempfile.mkdtemp()
+        self.config = config.load()
+        self.saved_config = dict(self.config)
+        self.config['device-lease-file'] = os.path.join(self.tmp_dir,
+                                                        'devices.json')
+        self.saved_refill_lock = create_ami.POOL_REFILL_LOCK
+        create_ami.POOL_REFILL_LOCK = os.path.join(self.tmp_dir,
+                                                   'refill.lock')
+
+    def tearDown(self):
+        create_ami.POOL_REFILL_LOCK = self.saved_refill_lock
+        self.fake.stop()
+        self.config.clear()
+        self.config.update(self.saved_config)
+        shutil.rmtree(self.tmp_dir)
 
     def test_allocate_device(self,
                              device_set=DEVICE_NAMES,
                              maxdev=len(DEVICE_NAMES),
                              instance_id=DUMMY_INSTANCE_ID):
         """
-        Check that the generated sequence of devices is valid.
+        Check that the leased sequence of devices is valid.
         """
-        i = 0
+        leases = create_ami._device_leases(instance_id)
         allocated = set()
-        while i < maxdev:
-            dev = create_ami._allocate_device(
-                self.connection,
-                instance_id,
-                device_name_blacklist=allocated)
-            allocated.add(dev)
-            i += 1
+        for i in range(maxdev):
+            allocated.add(leases.allocate(
+                'vol-{}'.format(i),
+                lambda: create_ami._attached_devices(self.connection,
+                                                     instance_id)))
         self.assertEqual(allocated, device_set)
 
     def test_allocate_device_failure(self):
         """
-        Check that the function raises an exception when all devices are allocated.
+        Check that the leases raise an exception when all devices are allocated.
+        """
+        self.assertRaises(device_lease.DeviceAllocationError,
+                          self.test_allocate_device,
+                          maxdev=len(DEVICE_NAMES) + 1)
+
+    def test_build_cycle(self):
+        """
+        Check the create-volume -> create-image -> destroy-volume cycle.
+        """
+        conn = self.connection
+        instance_id = self.fake.add_instance()
+        tags = {'build': 'test', create_ami.APPLIANCE_TAG: 'core',
+                create_ami.FINGERPRINT_TAG: 'f1'}
+        volume_id, device, error = create_ami.create_volume(
+            conn, instance_id, 1, VOLUME_LOCATION, tags)
+        self.assertIsNone(error)
+        self.assertIn(device, DEVICE_NAMES)
+        ok, error = create_ami.detach_volume(conn, volume_id)
+        self.assertTrue(ok)
+        image_id, error = create_ami.create_image(conn, 'test', volume_id,
+                                                  tags=tags)
+        self.assertIsNone(error)
+        snapshot = create_ami.find_appliance_snapshot(conn, 'core')
+        self.assertEqual(snapshot.volume_id, volume_id)
+        create_ami._wait_for(conn.get_image(image_id), create_ami.AVAILABLE)
+        self.assertEqual(create_ami.find_fingerprint_image(conn, 'f1'),
+                         image_id)
+        self.assertIsNone(create_ami.find_fingerprint_image(conn, 'f2'))
+        ok, error = create_ami.destroy_volume(conn, volume_id)
+        self.assertTrue(ok)
+
+    def test_device_conflict(self):
+        """
+        Check that a device attached behind the lease table's back is
+        skipped.
+        """
+        conn = self.connection
+        instance_id = self.fake.add_instance()
+        first, device, error = create_ami.create_volume(
+            conn, instance_id, 1, VOLUME_LOCATION)
+        self.assertEqual(device, '/dev/sdb')
+        # Forget the leases, as after a reboot of the buildslave
+        os.remove(self.config['device-lease-file'])
+        create_ami._device_leases(instance_id).reconcile({})
+        second, device, error = create_ami.create_volume(
+            conn, instance_id, 1, VOLUME_LOCATION)
+        self.assertIsNone(error)
+        self.assertEqual(device, '/dev/sdc')
+
+    def test_device_conflict_error(self):
+        """
+        Check that the conflict is recognized by its error code, whatever
+        the wording of the message, and that other errors are raised.
+        """
+        conn = self.connection
+        instance_id = self.fake.add_instance()
+        volumes = [conn.create_volume(1, VOLUME_LOCATION) for _ in range(2)]
+        create_ami._wait_for_all(conn, volumes, create_ami.AVAILABLE)
+        attach = self.fake._api_AttachVolume
+        errors = []
+
+        def fail_once(params):
+            if errors:
+                raise errors.pop()
+            return attach(params)
+        self.fake._api_AttachVolume = fail_once
+        # A conflict is retried after reconciling the leases
+        errors.append(fake_ec2._APIError('InvalidParameterValue',
+                                         'Invalid value for the device name'))
+        self.assertEqual(create_ami._attach(conn, volumes[0], instance_id),
+                         '/dev/sdb')
+        self.assertEqual(self.fake.calls['AttachVolume'], 2)
+        # Any other error is raised and releases the lease
+        errors.append(fake_ec2._APIError('IncorrectState', 'Busy on /dev/sdc'))
+        self.assertRaises(boto.exception.EC2ResponseError, create_ami._attach,
+                          conn, volumes[1], instance_id)
+        self.assertEqual(self.fake.calls['AttachVolume'], 3)
+        # The released name goes back to the end of the free names
+        self.assertEqual(create_ami._attach(conn, volumes[1], instance_id),
+                         '/dev/sdd')
+
+    def _pool(self, state):
+        return sorted(volume.id for volume in create_ami._pool_volumes(
+            self.connection, 1, VOLUME_LOCATION, state))
+
+    def test_pool_lease(self):
+        """
+        Check that buildslaves racing for the pool lease each volume once.
+        """
+        conn = self.connection
+        slaves = [self.fake.add_instance() for _ in range(2)]
+        ok, error = create_ami.refill_pool(conn, slaves[0], 1,
+                                           VOLUME_LOCATION, 3)
+        self.assertTrue(ok, error)
+        self.assertEqual(len(self._pool(create_ami.POOL_READY)), 3)
+        results = []
+
+        def lease(instance_id):
+            results.append(create_ami.lease_pool_volume(
+                self.fake.connect(), instance_id, 1, VOLUME_LOCATION))
+
+        threads = [threading.Thread(target=lease, args=(slaves[i % 2],))
+                   for i in range(6)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        leased = [volume.id for volume, _ in results if volume is not None]
+        self.assertEqual(len(leased), 3)
+        self.assertEqual(len(set(leased)), 3)
+        self.assertEqual(self._pool(create_ami.POOL_READY), [])
+        for volume_id in leased:
+            volume = self.fake.volumes[volume_id]
+            self.assertEqual(volume['status'], 'in-use')
+            self.assertNotIn(create_ami.POOL_TAG, volume['tags'])
+
+    def test_pool_recycle(self):
+        """
+        Check the create-volume -> recycle -> refill cycle.
+        """
+        conn = self.connection
+        instance_id = self.fake.add_instance()
+        saved = create_ami.check_cmd, create_ami._wait_for_file
+        wiped = []
+        create_ami.check_cmd = lambda cmd: (wiped.append(cmd), (True, ''))[1]
+        create_ami._wait_for_file = lambda name: True
+        try:
+            ok, error = create_ami.refill_pool(conn, instance_id, 1,
+                                               VOLUME_LOCATION, 1)
+            self.assertTrue(ok, error)
+            volume_id, _, error = create_ami.create_volume(
+                conn, instance_id, 1, VOLUME_LOCATION, {'build': 'test'},
+                pool_size=1)
+            self.assertIsNone(error)
+            self.assertEqual(self._pool(create_ami.POOL_READY), [])
+            volume, error = create_ami.recycle_volume(conn, volume_id)
+            self.assertIsNone(error)
+            self.assertEqual(self._pool(create_ami.POOL_DIRTY), [volume_id])
+            self.assertNotIn('build', self.fake.volumes[volume_id]['tags'])
+            # Wiped and back in the pool, one extra volume created
+            ok, error = create_ami.refill_pool(conn, instance_id, 1,
+                                               VOLUME_LOCATION, 2)
+            self.assertTrue(ok, error)
+            self.assertEqual(len(wiped), 1)
+            self.assertIn('blkdiscard', wiped[0])
+            ready = self._pool(create_ami.POOL_READY)
+            self.assertEqual(len(ready), 2)
+            self.assertIn(volume_id, ready)
+            # Shrunk
+            ok, error = create_ami.refill_pool(conn, instance_id, 1,
+                                               VOLUME_LOCATION, 0)
+            self.assertTrue(ok, error)
+            self.assertEqual(self._pool(create_ami.POOL_READY), [])
+        finally:
+            create_ami.check_cmd, create_ami._wait_for_file = saved
+
+    def test_recycle_without_pool(self):
+        """
+        Check that a volume recycled without a pool is destroyed.
+        """
+        conn = self.connection
+        instance_id = self.fake.add_instance()
+        volume_id, _, error = create_ami.create_volume(
+            conn, instance_id, 1, VOLUME_LOCATION)
+        self.assertIsNone(error)
+        parser = argparse.ArgumentParser()
+        create_ami.parser_destroy_volume(parser)
+        args = parser.parse_args(['--recycle', '--pool-size', '0',
+                                  volume_id])
+        saved = boto.ec2.connect_to_region
+        boto.ec2.connect_to_region = lambda region: conn
+        try:
+            self.assertTrue(create_ami.cmd_destroy_volume(args))
+        finally:
+            boto.ec2.connect_to_region = saved
+        self.assertEqual(self._pool(create_ami.POOL_DIRTY), [])
+        self.assertEqual(self.fake.calls['DeleteVolume'], 1)
+
+
+    def _create_volume(self, argv):
         """
-        exception = None
+        Run the create-volume command, return its shell variables.
+        """
+        parser = argparse.ArgumentParser()
+        create_ami.parser_create_volume(parser)
+        args = parser.parse_args(argv)
+        saved = boto.ec2.connect_to_region, sys.stdout
+        boto.ec2.connect_to_region = lambda region: self.connection
+        sys.stdout = StringIO.StringIO()
         try:
-            self.test_allocate_device(maxdev=len(DEVICE_NAMES) + 1)
-        except create_ami._OIFError as exception:
-            pass
-        self.assertIsNotNone(exception)
-        self.assertTrue(isinstance(exception, Exception))
+            self.assertTrue(create_ami.cmd_create_volume(args))
+            output = sys.stdout.getvalue()
+        finally:
+            boto.ec2.connect_to_region, sys.stdout = saved
+        return dict(line.split('=', 1) for line in output.splitlines())
+
+    def test_incremental(self):
+        """
+        Check that an incremental volume is created from the snapshot of the
+        previous image of the appliance, a blank volume without one.
+        """
+        conn = self.connection
+        instance_id = self.fake.add_instance()
+        argv = ['--instance-id', instance_id, '--incremental', 'core', '1']
+        self.assertIsNone(create_ami.find_appliance_snapshot(conn, 'core'))
+        outputs = self._create_volume(argv)
+        self.assertEqual(outputs['INCREMENTAL'], '0')
+        volume_id = outputs['VOLUME_ID']
+        self.assertIsNone(self.fake.volumes[volume_id]['snapshot_id'])
+
+        ok, error = create_ami.detach_volume(conn, volume_id)
+        self.assertTrue(ok)
+        _, error = create_ami.create_image(
+            conn, 'core-1', volume_id, tags={create_ami.APPLIANCE_TAG: 'core'})
+        self.assertIsNone(error)
+        snapshot = create_ami.find_appliance_snapshot(conn, 'core')
+        self.assertEqual(snapshot.volume_id, volume_id)
+        self.assertIsNone(create_ami.find_appliance_snapshot(conn, 'lamp'))
+
+        outputs = self._create_volume(argv)
+        self.assertEqual(outputs['INCREMENTAL'], '1')
+        self.assertEqual(self.fake.volumes[outputs['VOLUME_ID']]['snapshot_id'],
+                         snapshot.id)
 
 
 if __name__ == '__main__':
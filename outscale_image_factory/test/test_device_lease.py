@@ -0,0 +1,84 @@
+"""
+Unit tests for device_lease.
+"""
+import os
+import shutil
+import tempfile
+import unittest
+from outscale_image_factory import device_lease
+
+INSTANCE_ID = 'i-00000001'
+
+
+class TestDeviceLease(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp()
+        self.path = os.path.join(self.tmp_dir, 'devices.json')
+        self.attached = {}
+        self.attached_calls = 0
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp_dir)
+
+    def _attached(self):
+        self.attached_calls += 1
+        return dict(self.attached)
+
+    def test_name_ranges(self):
+        self.assertEqual(len(device_lease.NAME_RANGES['sd']), 25)
+        self.assertEqual(len(set(device_lease.NAME_RANGES['xvd'])),
+                         25 + 25 * 26)
+
+    def test_allocate_all(self):
+        self.attached = {'/dev/sdb': 'vol-other'}
+        leases = device_lease.DeviceLeases(self.path, INSTANCE_ID)
+        devices = set()
+        for i in range(24):
+            devices.add(leases.allocate('vol-{}'.format(i), self._attached))
+        self.assertEqual(len(devices), 24)
+        self.assertNotIn('/dev/sdb', devices)
+        # EC2 is only queried when the table is created, or when there is
+        # no free device name left
+        self.assertEqual(self.attached_calls, 1)
+        self.assertRaises(device_lease.DeviceAllocationError,
+                          leases.allocate, 'vol-x', self._attached)
+        self.assertEqual(self.attached_calls, 2)
+
+    def test_leaked_leases(self):
+        leases = device_lease.DeviceLeases(self.path, INSTANCE_ID)
+        for i in range(25):
+            leases.allocate('vol-{}'.format(i), self._attached)
+        # The builds were killed before releasing their devices, only one
+        # volume is still attached
+        self.attached = {'/dev/sdb': 'vol-0'}
+        saved = device_lease.PENDING_LEASE_SEC
+        device_lease.PENDING_LEASE_SEC = 0
+        try:
+            dev = leases.allocate('vol-x', self._attached)
+        finally:
+            device_lease.PENDING_LEASE_SEC = saved
+        self.assertNotEqual(dev, '/dev/sdb')
+
+    def test_release(self):
+        leases = device_lease.DeviceLeases(self.path, INSTANCE_ID)
+        first = leases.allocate('vol-1', self._attached)
+        leases.release('vol-1')
+        # A second process sees the released device
+        other = device_lease.DeviceLeases(self.path, INSTANCE_ID)
+        devices = set(other.allocate('vol-{}'.format(i), self._attached)
+                      for i in range(2, 27))
+        self.assertIn(first, devices)
+
+    def test_reconcile(self):
+        leases = device_lease.DeviceLeases(self.path, INSTANCE_ID)
+        dev = leases.allocate('vol-1', self._attached)
+        # Someone else attached a volume on the next device behind our back
+        self.attached = {dev: 'vol-1', '/dev/sdc': 'vol-other'}
+        leases.reconcile(self._attached())
+        self.assertNotEqual(leases.allocate('vol-2', self._attached),
+                            '/dev/sdc')
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,56 @@
+"""
+Unit tests for find_package_references.
+"""
+import os
+import shutil
+import tempfile
+import unittest
+from outscale_image_factory import find_package_references
+
+
+class TestFindPackageReferences(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp()
+        self._write('conf.d/main', 'apt-get update\n'
+                    'wget http://example.com/a.tar.gz -O a\n'
+                    '  git clone git://example.com/repo.git  \r\n')
+        self._write('overlay/usr/bin/tool', b'\x7fELF\0http://binary.example.com')
+        self._write('overlay/etc/big', 'x' * (2 * 1024 * 1024) +
+                    '\nsee https://example.com/big\n')
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp_dir)
+
+    def _write(self, name, content):
+        path = os.path.join(self.tmp_dir, name)
+        if not os.path.isdir(os.path.dirname(path)):
+            os.makedirs(os.path.dirname(path))
+        with open(path, 'wb') as fp:
+            fp.write(content)
+
+    def test_find_references(self):
+        cache = {}
+        refs = list(find_package_references.find_references(
+            self.tmp_dir, cache=cache, jobs=2))
+        expected = [('conf.d/main', 2, 'http://example.com/a.tar.gz'),
+                    ('conf.d/main', 3, 'git://example.com/repo.git'),
+                    ('overlay/etc/big', 2, 'https://example.com/big')]
+        self.assertEqual(refs, expected)
+        self.assertEqual(sorted(cache), ['conf.d/main', 'overlay/etc/big',
+                                         'overlay/usr/bin/tool'])
+        # Unchanged files are not scanned again
+        cache['conf.d/main'][2] = [['conf.d/main', 1, 'cached']]
+        os.unlink(os.path.join(self.tmp_dir, 'overlay/etc/big'))
+        refs = list(find_package_references.find_references(
+            self.tmp_dir, cache=cache, jobs=2))
+        self.assertEqual(refs, [('conf.d/main', 1, 'cached')])
+        self.assertNotIn('overlay/etc/big', cache)
+        # Scans of other directories or subdirectories use other caches
+        key = find_package_references.cache_key(self.tmp_dir)
+        self.assertEqual(key, find_package_references.cache_key(
+            os.path.join(self.tmp_dir, 'conf.d', '..')))
+        self.assertNotEqual(key, find_package_references.cache_key(
+            self.tmp_dir, whole_tree=True))
+        self.assertNotEqual(key, find_package_references.cache_key(
+            os.path.join(self.tmp_dir, 'overlay')))
@@ -0,0 +1,80 @@
+"""
+Unit tests for fingerprint.
+"""
+import json
+import os
+import shutil
+import tempfile
+import threading
+import unittest
+from outscale_image_factory.fingerprint import fingerprint
+
+
+class TestFingerprint(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp()
+        self.cache = os.path.join(self.tmp_dir, 'cache.json')
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp_dir)
+
+    def _tree(self, name):
+        root = os.path.join(self.tmp_dir, name)
+        os.makedirs(os.path.join(root, 'etc'))
+        os.makedirs(os.path.join(root, 'usr/bin'))
+        with open(os.path.join(root, 'usr/bin/tool'), 'w') as fp:
+            fp.write('#!/bin/sh\n')
+        os.chmod(os.path.join(root, 'usr/bin/tool'), 0o755)
+        os.symlink('usr/bin', os.path.join(root, 'bin'))
+        return root
+
+    def test_fingerprint(self):
+        first = fingerprint(self._tree('a'), None, jobs=2)
+        second = self._tree('b')
+        # The fstab is written by the install, and ignored
+        with open(os.path.join(second, 'etc/fstab'), 'w') as fp:
+            fp.write('UUID=1234 / ext4\n')
+        self.assertEqual(fingerprint(second, None, jobs=2), first)
+        os.chmod(os.path.join(second, 'usr/bin/tool'), 0o644)
+        self.assertNotEqual(fingerprint(second, None, jobs=2), first)
+        os.chmod(os.path.join(second, 'usr/bin/tool'), 0o755)
+        with open(os.path.join(second, 'usr/bin/tool'), 'a') as fp:
+            fp.write('exit 0\n')
+        self.assertNotEqual(fingerprint(second, None, jobs=2), first)
+
+    def test_cache(self):
+        root = self._tree('a')
+        first = fingerprint(root, self.cache, jobs=2)
+        with open(self.cache) as fp:
+            cache = json.load(fp)
+        self.assertEqual(list(cache), [os.path.abspath(root)])
+        # A cached hash is trusted as long as the inode and mtime match
+        entries = cache[os.path.abspath(root)]
+        for entry in entries.values():
+            entry[2] = 'forged'
+        with open(self.cache, 'w') as fp:
+            json.dump(cache, fp)
+        self.assertNotEqual(fingerprint(root, self.cache, jobs=2), first)
+        os.utime(os.path.join(root, 'usr/bin/tool'), (0, 0))
+        fingerprint(root, self.cache, jobs=2)
+        os.utime(os.path.join(root, 'usr/bin/tool'), None)
+        self.assertEqual(fingerprint(root, self.cache, jobs=2), first)
+
+    def test_concurrent_cache(self):
+        # Concurrent fingerprints of different trees keep all the sections
+        roots = [self._tree(name) for name in 'abcdef']
+        threads = [threading.Thread(target=fingerprint,
+                                    args=(root, self.cache, 1))
+                   for root in roots]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        with open(self.cache) as fp:
+            self.assertEqual(sorted(json.load(fp)),
+                             sorted(os.path.abspath(root) for root in roots))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,66 @@
+"""
+Unit tests for git_mirror.
+"""
+import os
+import shutil
+import subprocess
+import tempfile
+import unittest
+from outscale_image_factory import git_mirror
+
+
+class TestGitMirror(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp()
+        self.mirror_dir = os.path.join(self.tmp_dir, 'mirrors')
+        self.upstream = os.path.join(self.tmp_dir, 'upstream', 'app')
+        self._git('init', '-q', self.upstream)
+        self._commit('first')
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp_dir)
+
+    def _git(self, *args):
+        return subprocess.check_output(
+            ('git', '-c', 'user.name=test', '-c', 'user.email=test@test') +
+            args).decode('utf-8').strip()
+
+    def _commit(self, message):
+        with open(os.path.join(self.upstream, 'README'), 'a') as fp:
+            fp.write(message + '\n')
+        self._git('-C', self.upstream, 'add', 'README')
+        self._git('-C', self.upstream, 'commit', '-q', '-m', message)
+
+    def test_mirror_path(self):
+        for url in ('https://github.com/turnkeylinux-apps/core',
+                    'https://github.com/turnkeylinux-apps/core.git',
+                    'git@github.com:turnkeylinux-apps/core.git'):
+            self.assertEqual(git_mirror.mirror_path('/m', url),
+                             '/m/github.com/turnkeylinux-apps/core.git')
+
+    def test_clone_and_update(self):
+        app_dir = os.path.join(self.tmp_dir, 'products', 'app')
+        ok, _ = git_mirror.clone_or_update(self.mirror_dir, self.upstream,
+                                           app_dir)
+        self.assertTrue(ok)
+        # The objects are shared with the mirror
+        with open(os.path.join(app_dir, '.git', 'objects', 'info',
+                               'alternates')) as fp:
+            self.assertEqual(os.path.dirname(fp.read().strip()),
+                             git_mirror.mirror_path(self.mirror_dir,
+                                                    self.upstream))
+        self.assertEqual(self._git('-C', app_dir, 'remote', 'get-url',
+                                   'origin'), self.upstream)
+        self._commit('second')
+        ok, failed = git_mirror.refresh_mirrors(
+            self.mirror_dir, [self.upstream, self.upstream + '-missing'])
+        self.assertFalse(ok)
+        self.assertEqual(failed, [self.upstream + '-missing'])
+        self.assertEqual(git_mirror.list_mirrors(self.mirror_dir),
+                         [self.upstream])
+        ok, _ = git_mirror.clone_or_update(self.mirror_dir, self.upstream,
+                                           app_dir, fetch=False)
+        self.assertTrue(ok)
+        self.assertEqual(self._git('-C', app_dir, 'log', '-1', '--format=%s'),
+                         'second')
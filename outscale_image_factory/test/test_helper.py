@@ -0,0 +1,161 @@
+"""
+Unit tests for helper.check_cmd.
+"""
+import argparse
+import os
+import shutil
+import tempfile
+import threading
+import time
+import unittest
+from collections import namedtuple
+from outscale_image_factory import tracing
+from outscale_image_factory.helper import _Output, check_cmd, \
+    positive_int, run_graph
+
+Step = namedtuple('Step', 'key deps')
+ResourceStep = namedtuple('ResourceStep', 'key deps resources')
+
+
+class TestCheckCmd(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp_dir)
+
+    def test_output(self):
+        ok, data = check_cmd('tr a-z A-Z', 'some content')
+        self.assertTrue(ok)
+        self.assertEqual(data['stdout'], 'SOME CONTENT')
+        self.assertEqual((data['bytes'], data['lines']), (12, 1))
+        ok, data = check_cmd('ls /does-not-exist')
+        self.assertFalse(ok)
+        self.assertNotEqual(data['ret'], 0)
+
+    def test_tail_and_spool(self):
+        spool = os.path.join(self.tmp_dir, 'output.log')
+        ok, data = check_cmd('seq 100000', spool=spool, tail_bytes=1000)
+        self.assertTrue(ok)
+        self.assertEqual(data['lines'], 100000)
+        self.assertTrue(data['truncated'])
+        self.assertEqual(len(data['stdout']), 1000)
+        self.assertTrue(data['stdout'].endswith('99999\n100000\n'))
+        self.assertEqual(os.path.getsize(spool), data['bytes'])
+
+    def test_timeout_and_cancel(self):
+        clock = time.time()
+        ok, data = check_cmd('sleep 30', timeout=0.2)
+        self.assertFalse(ok)
+        self.assertTrue(data['timed_out'])
+        cancel = threading.Event()
+        threading.Timer(0.2, cancel.set).start()
+        ok, data = check_cmd('sleep 30', cancel=cancel)
+        self.assertFalse(ok)
+        self.assertTrue(data['cancelled'])
+        self.assertLess(time.time() - clock, 10)
+
+    def test_partial_lines(self):
+        logged = []
+        output = _Output('', None, 100)
+        output._log = logged.extend
+        output.feed(b'10%\r20%\r')
+        output.feed(b'\n30%\r\n' + b'.' * 1000)
+        self.assertEqual(logged, [b'10%', b'20%', b'30%'])
+        # An endless line is cut to its tail
+        self.assertEqual(output.partial, b'.' * 100)
+        output.feed(b'.' * 1000)
+        self.assertEqual(len(output.partial), 100)
+        output.close()
+        self.assertEqual(logged[3:], [b'.' * 100])
+
+    def test_usage(self):
+        tracing.enable()
+        try:
+            ok, data = check_cmd('seq 1000000')
+            ok, idle = check_cmd('sleep 0.1')
+            events = tracing._tracer.events
+        finally:
+            tracing._tracer = None
+        self.assertGreater(data['usage']['maxrss_kib'], 0)
+        self.assertGreaterEqual(data['usage']['user_sec'],
+                                idle['usage']['user_sec'])
+        # Measured for each command, not since the previous one
+        self.assertEqual(events[1]['args']['child_maxrss_kib'],
+                         idle['usage']['maxrss_kib'])
+        self.assertLess(events[1]['args']['child_user_sec'], 0.1)
+
+
+class TestRunGraph(unittest.TestCase):
+
+    def test_order(self):
+        steps = [Step('c', ['a', 'b']), Step('a', []), Step('b', ['a']),
+                 Step('d', ['a', 'missing'])]
+        lock = threading.Lock()
+        running = []
+        peak = []
+
+        def run(step):
+            with lock:
+                running.append(step.key)
+                peak.append(len(running))
+            time.sleep(0.05)
+            with lock:
+                running.remove(step.key)
+            return True, None
+
+        ok, err, done = run_graph(steps, run, jobs=2)
+        self.assertTrue(ok)
+        self.assertEqual(done[0], 'a')
+        self.assertEqual(done[-1], 'c')
+        self.assertEqual(sorted(done), ['a', 'b', 'c', 'd'])
+        # b and d run concurrently
+        self.assertEqual(max(peak), 2)
+
+    def test_limits(self):
+        steps = [ResourceStep(str(i), [], ['cpu', 'disk'] if i % 2 else ['cpu'])
+                 for i in range(8)]
+        lock = threading.Lock()
+        running = []
+        peak = {'cpu': 0, 'disk': 0}
+
+        def run(step):
+            with lock:
+                running.append(step)
+                for name in peak:
+                    peak[name] = max(peak[name], len(
+                        [other for other in running
+                         if name in other.resources]))
+            time.sleep(0.05)
+            with lock:
+                running.remove(step)
+            return True, None
+
+        ok, err, done = run_graph(steps, run, jobs=8,
+                                  limits={'cpu': 3, 'disk': 1})
+        self.assertTrue(ok)
+        self.assertEqual(len(done), 8)
+        self.assertEqual(peak, {'cpu': 3, 'disk': 1})
+
+    def test_failure(self):
+        steps = [Step('a', []), Step('b', ['a']), Step('c', [])]
+        run = lambda step: (step.key != 'a', step.key)
+        ok, err, done = run_graph(steps, run)
+        self.assertEqual((ok, err, done), (False, 'a', []))
+        ok, err, done = run_graph(steps, run, keep_going=True)
+        self.assertEqual((ok, err, done), (False, 'a', ['c']))
+
+    def test_positive(self):
+        steps = [Step('a', [])]
+        run = lambda step: (True, None)
+        self.assertRaises(ValueError, run_graph, steps, run, jobs=0)
+        self.assertRaises(ValueError, run_graph, steps, run,
+                          limits={'cpu': -1})
+        self.assertEqual(positive_int('3'), 3)
+        for value in ('0', '-2', 'x'):
+            self.assertRaises(argparse.ArgumentTypeError, positive_int, value)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,113 @@
+"""
+Unit tests for the image engine and disk images of install.
+"""
+import os
+import shutil
+import subprocess
+import tempfile
+import unittest
+from outscale_image_factory import install
+from outscale_image_factory.helper import check_cmd
+
+MIB = 1024 * 1024
+
+
+class TestImageEngine(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp_dir)
+
+    def _path(self, name):
+        return os.path.join(self.tmp_dir, name)
+
+    def test_disk_layout(self):
+        self.assertEqual(install._partition_path('/dev/sdb', 1), '/dev/sdb1')
+        self.assertEqual(install._partition_path('/dev/loop3', 1),
+                         '/dev/loop3p1')
+        self.assertEqual(install._disk_size([(2048, 4095, 83)]), 3 * MIB)
+        self.assertEqual(install._disk_size(install.PARTITION_TABLE),
+                         10 * 1024 * MIB)
+
+    def test_plan_partition_table(self):
+        rootfs = self._path('rootfs')
+        os.makedirs(rootfs)
+        for i in range(10):
+            with open(os.path.join(rootfs, str(i)), 'wb') as fp:
+                fp.truncate(100 * MIB)
+        table = install.plan_partition_table(rootfs, headroom=0.5)
+        start, sectors, _ = table[0]
+        self.assertEqual(start % install.ALIGN_SECTORS, 0)
+        self.assertEqual(sectors % install.ALIGN_SECTORS, 0)
+        self.assertGreater(sectors * 512, 1500 * MIB)
+        self.assertLess(sectors * 512, 2000 * MIB)
+        self.assertEqual(install.volume_size_gib(table), 2)
+
+    def test_write_sparse(self):
+        with open(self._path('src'), 'wb') as fp:
+            fp.write(b'a' * 1000)
+            fp.seek(10 * MIB)
+            fp.write(b'b' * MIB)
+            fp.truncate(20 * MIB)
+        with open(self._path('dst'), 'wb') as fp:
+            fp.truncate(20 * MIB)
+        ok, _ = install.write_sparse(self._path('src'), self._path('dst'),
+                                     block_size=MIB // 3)
+        self.assertTrue(ok)
+        with open(self._path('src'), 'rb') as src, \
+                open(self._path('dst'), 'rb') as dst:
+            self.assertEqual(src.read(), dst.read())
+        # The holes are not written
+        self.assertLess(os.stat(self._path('dst')).st_blocks * 512, 2 * MIB)
+
+    def test_build_fs_image(self):
+        rootfs = self._path('rootfs')
+        os.makedirs(os.path.join(rootfs, 'etc'))
+        with open(os.path.join(rootfs, 'hello'), 'w') as fp:
+            fp.write('hello\n')
+        image = self._path('fs.img')
+        ok, _ = install.build_fs_image(rootfs, image, 64 * MIB)
+        self.assertTrue(ok)
+        self.assertEqual(os.path.getsize(image), 64 * MIB)
+        ok, data = check_cmd('blkid -o value -s UUID {}'.format(image))
+        self.assertTrue(ok)
+        fstab = subprocess.check_output(['debugfs', '-R', 'cat /etc/fstab',
+                                         image], stderr=open(os.devnull, 'w'))
+        self.assertIn('UUID={} / ext4'.format(data['stdout'].strip()),
+                      fstab.decode('utf-8'))
+        # The rootfs is left untouched
+        self.assertFalse(os.path.exists(os.path.join(rootfs, 'etc/fstab')))
+        ok, data = check_cmd('debugfs -R ls {}'.format(image))
+        self.assertIn('hello', data['stdout'])
+
+    def test_ensure_fs_image(self):
+        rootfs = self._path('rootfs')
+        os.makedirs(os.path.join(rootfs, 'etc'))
+        image = self._path('fs.img')
+        built = []
+        saved = install.build_fs_image
+
+        def build_fs_image(rootfs, path, size):
+            built.append(size)
+            with open(path, 'wb') as fp:
+                fp.truncate(size)
+            return True, None
+        install.build_fs_image = build_fs_image
+        try:
+            for size in (MIB, MIB, 2 * MIB):
+                self.assertEqual(install.ensure_fs_image(rootfs, image, size),
+                                 (True, None))
+            # Another rootfs in the same place
+            with open(os.path.join(rootfs, 'hello'), 'w') as fp:
+                fp.write('hello\n')
+            install.ensure_fs_image(rootfs, image, 2 * MIB)
+            install.ensure_fs_image(rootfs, image, 2 * MIB)
+        finally:
+            install.build_fs_image = saved
+        self.assertEqual(built, [MIB, 2 * MIB, 2 * MIB])
+
+
+if __name__ == '__main__':
+    unittest.main()
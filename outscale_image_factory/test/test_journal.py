@@ -0,0 +1,52 @@
+"""
+Unit tests for journal.
+"""
+import os
+import shutil
+import tempfile
+import unittest
+from outscale_image_factory.journal import Journal
+
+
+class TestJournal(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp()
+        self.path = os.path.join(self.tmp_dir, 'journal.json')
+        self.runs = []
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp_dir)
+
+    def _step(self, name, ok=True):
+        def func():
+            self.runs.append(name)
+            return ok, dict(name=name)
+        return func
+
+    def test_resume(self):
+        journal = Journal(self.path)
+        journal.run('a', {'x': 1}, self._step('a'))
+        journal.run('b', {'x': 1}, self._step('b', ok=False))
+        # A new run skips a and retries b
+        journal = Journal(self.path)
+        self.assertEqual(journal.run('a', {'x': 1}, self._step('a')),
+                         (True, {'name': 'a'}))
+        journal.run('b', {'x': 1}, self._step('b'))
+        self.assertEqual(self.runs, ['a', 'b', 'b'])
+
+    def test_invalidate(self):
+        journal = Journal(self.path)
+        journal.run('a', {'x': 1}, self._step('a'))
+        journal.run('b', {'x': 1}, self._step('b'))
+        # Changed inputs rerun a and forget b, stale outputs rerun b
+        journal = Journal(self.path)
+        journal.run('a', {'x': 2}, self._step('a'))
+        self.assertIsNone(journal.outputs('b'))
+        journal.run('b', {'x': 1}, self._step('b'))
+        journal.run('b', {'x': 1}, self._step('b'), valid=lambda out: False)
+        self.assertEqual(self.runs, ['a', 'b', 'a', 'b', 'b'])
+
+
+if __name__ == '__main__':
+    unittest.main()
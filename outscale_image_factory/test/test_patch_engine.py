@@ -0,0 +1,97 @@
+"""
+Unit tests for patch_engine.
+"""
+import os
+import shutil
+import stat
+import tempfile
+import unittest
+from outscale_image_factory import patch_engine
+
+
+class TestPatchEngine(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp()
+        self.rootfs = self._path('rootfs')
+        os.makedirs(os.path.join(self.rootfs, 'etc'))
+        os.chmod(os.path.join(self.rootfs, 'etc'), 0o755)
+        self._write('rootfs/etc/motd', 'original')
+        self._write('first/overlay/etc/motd', 'first')
+        self._write('first/overlay/etc/first.conf', 'first', 0o600)
+        self._write('second/overlay/etc/motd', 'second')
+        self._write('second/overlay/usr/bin/tool', 'tool', 0o755)
+        os.symlink('tool', self._path('second/overlay/usr/bin/link'))
+        os.chmod(self._path('second/overlay/etc'), 0o700)
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp_dir)
+
+    def _path(self, name):
+        return os.path.join(self.tmp_dir, name)
+
+    def _write(self, name, content, mode=0o644):
+        path = self._path(name)
+        if not os.path.isdir(os.path.dirname(path)):
+            os.makedirs(os.path.dirname(path))
+        with open(path, 'w') as fp:
+            fp.write(content)
+        os.chmod(path, mode)
+
+    def _read(self, name):
+        with open(os.path.join(self.rootfs, name)) as fp:
+            return fp.read()
+
+    def test_apply_patches(self):
+        patches = [self._path('first'), self._path('second')]
+        plan = patch_engine.plan_overlays(patches)
+        self.assertEqual([rel for rel, _, _ in plan],
+                         ['etc', 'etc/first.conf', 'etc/motd', 'usr',
+                          'usr/bin', 'usr/bin/link', 'usr/bin/tool'])
+        ok, data = patch_engine.apply_patches(self.rootfs, patches, jobs=2)
+        self.assertTrue(ok)
+        self.assertEqual(data['second']['paths'], 6)
+        # The last patch wins
+        self.assertEqual(self._read('etc/motd'), 'second')
+        self.assertEqual(self._read('etc/first.conf'), 'first')
+        self.assertEqual(stat.S_IMODE(os.stat(
+            os.path.join(self.rootfs, 'etc/first.conf')).st_mode), 0o600)
+        self.assertEqual(stat.S_IMODE(os.stat(
+            os.path.join(self.rootfs, 'usr/bin/tool')).st_mode), 0o755)
+        self.assertEqual(os.readlink(os.path.join(self.rootfs,
+                                                  'usr/bin/link')), 'tool')
+        # Existing directories keep their mode
+        self.assertEqual(stat.S_IMODE(os.stat(
+            os.path.join(self.rootfs, 'etc')).st_mode), 0o755)
+
+    def test_debs_and_confs(self):
+        # The debs and conf scripts run in the chroot, checked while staged
+        self._write('first/conf', 'echo first')
+        self._write('second/debs/tool_1.0_all.deb', 'deb')
+        staged = {}
+
+        def check_cmd(cmd):
+            conf_dir = os.path.join(self.rootfs, patch_engine.CONF_DIR)
+            staged['files'] = sorted(
+                os.path.relpath(os.path.join(dir_path, name), conf_dir)
+                for dir_path, _, names in os.walk(conf_dir)
+                for name in names)
+            with open(os.path.join(conf_dir, 'run')) as fp:
+                staged['runner'] = fp.read()
+            return True, {}
+
+        saved = patch_engine.check_cmd
+        patch_engine.check_cmd = check_cmd
+        try:
+            ok, data = patch_engine.apply_patches(
+                self.rootfs, [self._path('first'), self._path('second')])
+        finally:
+            patch_engine.check_cmd = saved
+        self.assertTrue(ok)
+        self.assertEqual(staged['files'],
+                         ['first', 'run', 'second.debs/tool_1.0_all.deb'])
+        self.assertIn('for patch in first second;', staged['runner'])
+        self.assertIn('dpkg -i $patch.debs/*.deb', staged['runner'])
+        self.assertEqual(data['second']['debs'], 1)
+        self.assertFalse(os.path.exists(
+            os.path.join(self.rootfs, patch_engine.CONF_DIR)))
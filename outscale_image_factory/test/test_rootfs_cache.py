@@ -0,0 +1,88 @@
+"""
+Unit tests for rootfs_cache.
+"""
+import os
+import shutil
+import tempfile
+import unittest
+from outscale_image_factory import tkl_commands
+from outscale_image_factory.journal import Journal
+from outscale_image_factory.rootfs_cache import RootfsCache
+
+
+class TestRootfsCache(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp()
+        self.cache = RootfsCache(os.path.join(self.tmp_dir, 'cache'),
+                                 budget=32 * 1024)
+        self.iso = self._write('product.iso', 'iso')
+        self.patch = os.path.join(self.tmp_dir, 'outscale')
+        self._write('outscale/conf', 'echo hello')
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp_dir)
+
+    def _write(self, name, content):
+        path = os.path.join(self.tmp_dir, name)
+        if not os.path.isdir(os.path.dirname(path)):
+            os.makedirs(os.path.dirname(path))
+        with open(path, 'w') as fp:
+            fp.write(content)
+        return path
+
+    def _rootfs(self, name, size):
+        self._write(os.path.join(name, 'etc', 'data'), 'x' * size)
+        return os.path.join(self.tmp_dir, name)
+
+    def test_key(self):
+        key = self.cache.key(self.iso, [self.patch])
+        self.assertEqual(self.cache.key(self.iso, [self.patch]), key)
+        self._write('outscale/conf', 'echo bye')
+        self.assertNotEqual(self.cache.key(self.iso, [self.patch]), key)
+        self._write('product.iso', 'other iso')
+        self.assertNotEqual(self.cache.key(self.iso, [self.patch]), key)
+        self.assertNotEqual(self.cache.key(self.iso, []), key)
+
+    def test_add_and_evict(self):
+        with self.cache.use('a') as path:
+            self.assertIsNone(path)
+            ok, _ = self.cache.add('a', self._rootfs('a', 8 * 1024))
+            self.assertTrue(ok)
+        with self.cache.use('a') as path:
+            self.assertEqual(path, self.cache.entry_path('a'))
+            with open(os.path.join(path, 'etc', 'data')) as fp:
+                self.assertEqual(len(fp.read()), 8 * 1024)
+        self.cache.add('b', self._rootfs('b', 8 * 1024))
+        # a is used last, b is evicted first
+        with self.cache.use('a'):
+            pass
+        self.cache.add('c', self._rootfs('c', 8 * 1024))
+        self.assertFalse(os.path.exists(self.cache.entry_path('b')))
+        # Entries in use are not evicted
+        with self.cache.use('a'):
+            self.cache.add('d', self._rootfs('d', 8 * 1024))
+        self.assertTrue(os.path.exists(self.cache.entry_path('a')))
+        self.assertFalse(os.path.exists(self.cache.entry_path('c')))
+
+    def test_install_iso_cached(self):
+        # The fingerprint step of a journal reused with another ISO is run
+        # again, although the cache hit skips the extraction
+        journal_path = os.path.join(self.tmp_dir, 'journal.json')
+        other_iso = self._write('other.iso', 'other iso')
+        self.cache.add(self.cache.key(self.iso, []), self._rootfs('a', 16))
+        self.cache.add(self.cache.key(other_iso, []), self._rootfs('b', 32))
+        cwd = os.getcwd()
+        try:
+            fingerprints = []
+            for iso in (self.iso, other_iso):
+                ok, data = tkl_commands.tkl_install_iso(
+                    '/dev/null', iso, self.tmp_dir, [],
+                    journal=Journal(journal_path),
+                    find_image=lambda fp: 'ami-1', cache=self.cache)
+                self.assertTrue(ok, data)
+                self.assertEqual(data['image_id'], 'ami-1')
+                fingerprints.append(data['fingerprint'])
+        finally:
+            os.chdir(cwd)
+        self.assertNotEqual(fingerprints[0], fingerprints[1])
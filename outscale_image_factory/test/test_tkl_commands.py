@@ -0,0 +1,88 @@
+"""
+Unit tests for the resume logic of tkl_commands, with the commands mocked.
+"""
+import os
+import shutil
+import tempfile
+import unittest
+from outscale_image_factory import tkl_commands
+from outscale_image_factory.journal import Journal
+
+
+class TestTklCommands(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp()
+        self.work_dir = os.path.join(self.tmp_dir, 'work')
+        os.makedirs(self.work_dir)
+        self.iso = self._write('product.iso', 'iso')
+        self.patch = os.path.join(self.tmp_dir, 'outscale')
+        self._write('outscale/conf', 'echo hello')
+        self.cmds = []
+        self.saved = tkl_commands.check_cmd
+        tkl_commands.check_cmd = self._check_cmd
+
+    def tearDown(self):
+        tkl_commands.check_cmd = self.saved
+        shutil.rmtree(self.tmp_dir)
+
+    def _check_cmd(self, cmd, *args, **kwargs):
+        self.cmds.append(cmd)
+        if cmd.startswith('mount -t iso9660'):
+            # The squashfs of the mounted ISO
+            self._write('work/overlay.iso/live/10root.squashfs', '')
+        return True, dict(ret=0, stdout='')
+
+    def _write(self, name, content):
+        path = os.path.join(self.tmp_dir, name)
+        if not os.path.isdir(os.path.dirname(path)):
+            os.makedirs(os.path.dirname(path))
+        with open(path, 'w') as fp:
+            fp.write(content)
+        return path
+
+    def _upper_files(self):
+        return os.listdir(os.path.join(self.work_dir, 'overlay.upper'))
+
+    def _rebuild_iso(self):
+        # Another size, the mtime may not change within a second
+        with open(self.iso, 'a') as fp:
+            fp.write('new')
+
+    def test_overlay_resume(self):
+        ok, _ = tkl_commands._mount_iso(self.work_dir, self.iso, [])
+        self.assertTrue(ok)
+        self.assertEqual(self._upper_files(), [])
+        # Written by the patches of an interrupted build
+        self._write('work/overlay.upper/patched', '')
+        ok, _ = tkl_commands._mount_iso(self.work_dir, self.iso, [])
+        self.assertTrue(ok)
+        self.assertEqual(self._upper_files(), ['patched'])
+        self._rebuild_iso()
+        ok, _ = tkl_commands._mount_iso(self.work_dir, self.iso, [])
+        self.assertTrue(ok)
+        self.assertEqual(self._upper_files(), [])
+
+    def test_patches_keyed_on_iso(self):
+        journal = Journal(os.path.join(self.tmp_dir, 'journal.json'))
+        rootfs_dir = os.path.join(self.work_dir, 'overlay.rootfs')
+        saved = tkl_commands.apply_patches
+        tkl_commands.apply_patches = lambda *args: self._check_cmd('apply')
+        try:
+            for engine in (tkl_commands.PATCH_ENGINE_TKLPATCH,
+                           tkl_commands.PATCH_ENGINE_BUILTIN):
+                del self.cmds[:]
+                for rebuild in (False, False, True):
+                    if rebuild:
+                        self._rebuild_iso()
+                    ok, _ = tkl_commands._apply_patches(
+                        rootfs_dir, self.iso, [self.patch], journal, engine)
+                    self.assertTrue(ok)
+                # Applied again on the new ISO only
+                self.assertEqual(len(self.cmds), 2)
+        finally:
+            tkl_commands.apply_patches = saved
+
+
+if __name__ == '__main__':
+    unittest.main()
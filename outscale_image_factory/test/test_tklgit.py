@@ -0,0 +1,190 @@
+"""
+Unit tests for tklgit, against a stand-in of the GitHub API.
+"""
+import BaseHTTPServer
+import SocketServer
+import hashlib
+import json
+import os
+import shutil
+import tempfile
+import threading
+import unittest
+import urlparse
+from outscale_image_factory import github_api, tklgit
+
+
+class _Server(SocketServer.ThreadingMixIn, BaseHTTPServer.HTTPServer):
+
+    daemon_threads = True
+
+
+class _Handler(BaseHTTPServer.BaseHTTPRequestHandler):
+
+    protocol_version = 'HTTP/1.1'
+
+    def log_message(self, *args):
+        pass
+
+    def _reply(self, status, body=b'', headers=()):
+        self.send_response(status)
+        for name, value in headers:
+            self.send_header(name, value)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def _reply_cached(self, body, headers=()):
+        etag = '"{}"'.format(hashlib.sha1(body).hexdigest())
+        if self.headers.get('If-None-Match') == etag:
+            # Not counted against the rate limit
+            self._reply(304, headers=[('ETag', etag)])
+            return
+        self.server.remaining -= 1
+        self._reply(200, body, [
+            ('ETag', etag),
+            ('X-RateLimit-Remaining', str(self.server.remaining))] +
+            list(headers))
+
+    def do_GET(self):
+        server = self.server
+        parts = urlparse.urlsplit(self.path)
+        query = urlparse.parse_qs(parts.query)
+        account = parts.path.split('/')[2]
+        server.requests.append((self.path, self.headers.get('Authorization')))
+        if account not in server.accounts:
+            self._reply(404, json.dumps({'message': 'Not Found'}))
+            return
+        if '/branches/' in parts.path:
+            _, _, _, name, _, branch = parts.path.split('/', 5)
+            head = server.heads.get((name, branch))
+            if head is None:
+                self._reply(404, json.dumps({'message': 'Branch not found'}))
+            else:
+                self._reply_cached(json.dumps(
+                    {'name': branch, 'commit': {'sha': head}}))
+            return
+        page = int(query.get('page', ['1'])[0])
+        per_page = int(query['per_page'][0])
+        names = server.accounts[account]
+        repos = [{'name': name,
+                  'url': '{}/repos/{}/{}'.format(server.url, account, name)}
+                 for name in names[(page - 1) * per_page:page * per_page]]
+        headers = []
+        last = (len(names) + per_page - 1) // per_page
+        if page < last:
+            link = '{}/users/{}/repos?per_page={}&page={{}}'.format(
+                server.url, account, per_page)
+            headers.append(('Link', '<{}>; rel="next", <{}>; rel="last"'
+                            .format(link.format(page + 1), link.format(last))))
+        self._reply_cached(json.dumps(repos), headers)
+
+
+class TestTklgit(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp()
+        self.server = _Server(('127.0.0.1', 0), _Handler)
+        self.server.url = 'http://127.0.0.1:{}'.format(self.server.server_port)
+        self.server.accounts = {
+            'apps': ['core', 'lamp', 'wordpress', 'django', 'redmine'],
+            'other': ['factory-master', 'factory-slave', 'unrelated'],
+        }
+        self.server.heads = {}
+        self.server.requests = []
+        self.server.remaining = 60
+        thread = threading.Thread(target=self.server.serve_forever)
+        thread.daemon = True
+        thread.start()
+
+    def tearDown(self):
+        self.server.shutdown()
+        self.server.server_close()
+        shutil.rmtree(self.tmp_dir)
+
+    def _list(self, json_input, token=None):
+        client = github_api.GithubClient(self.server.url, token, self.tmp_dir,
+                                         per_page=2)
+        try:
+            return tklgit.list_repositories(json_input, client), client
+        finally:
+            client.close()
+
+    def test_list(self):
+        json_input = [['apps', {}],
+                      ['other', {'factory-master': 'master',
+                                 'factory-slave': 'stable'}]]
+        (ok, output), client = self._list(json_input, 'secret')
+        self.assertTrue(ok, output)
+        self.assertEqual([app for app, _, _ in output],
+                         ['core', 'lamp', 'wordpress', 'django', 'redmine',
+                          'factory-master', 'factory-slave'])
+        self.assertEqual(output[-1], (
+            'factory-slave',
+            '{}/repos/other/factory-slave'.format(self.server.url), 'stable'))
+        self.assertEqual(len(self.server.requests), 5)
+        self.assertEqual(set(auth for _, auth in self.server.requests),
+                         set(['token secret']))
+        self.assertEqual(client.rate_remaining, 55)
+        # Unchanged, answered from the cache
+        (ok, cached), client = self._list(json_input, 'secret')
+        self.assertEqual(cached, output)
+        self.assertEqual(client.stats['not_modified'], 5)
+        self.assertEqual(self.server.remaining, 55)
+        # A new repository changes the last page only, the page after a
+        # full last page is requested
+        self.server.accounts['apps'].append('zurmo')
+        (ok, output), client = self._list(json_input, 'secret')
+        self.assertEqual(output[5][0], 'zurmo')
+        self.assertEqual(client.stats['fetched'], 2)
+        self.server.accounts['apps'].append('zabbix')
+        (ok, output), client = self._list(json_input, 'secret')
+        self.assertEqual(output[6][0], 'zabbix')
+
+    def test_error(self):
+        (ok, error), _ = self._list([['apps', {}], ['missing', {}]])
+        self.assertFalse(ok)
+        self.assertIn('404', error)
+        self.assertIn('Not Found', error)
+
+    def test_changed(self):
+        json_input = [['other', {'factory-master': 'master',
+                                 'factory-slave': 'release/1.0'}]]
+        heads = self.server.heads
+        heads[('factory-master', 'master')] = 'a' * 40
+        heads[('factory-slave', 'release/1.0')] = 'b' * 40
+        state_path = os.path.join(self.tmp_dir, 'state.json')
+        client = github_api.GithubClient(self.server.url, None, self.tmp_dir)
+
+        def changed(commit=True):
+            _, repos = tklgit.list_repositories(json_input, client)
+            ok, resolved = tklgit.resolve_heads(repos, client)
+            self.assertTrue(ok, resolved)
+            state = tklgit.load_state(state_path)
+            tklgit.save_state(state_path + tklgit.PENDING_SUFFIX, resolved)
+            if commit:
+                self.assertEqual(tklgit.commit_state(state_path),
+                                 (True, None))
+            return [(app, sha, old) for app, _, _, sha, old
+                    in tklgit.changed_repos(resolved, state)]
+
+        self.assertEqual(changed(), [('factory-master', 'a' * 40, None),
+                                     ('factory-slave', 'b' * 40, None)])
+        self.assertEqual(changed(), [])
+        heads[('factory-slave', 'release/1.0')] = 'c' * 40
+        # The builds failed, listed again by the next run
+        self.assertEqual(changed(commit=False),
+                         [('factory-slave', 'c' * 40, 'b' * 40)])
+        self.assertEqual(changed(), [('factory-slave', 'c' * 40, 'b' * 40)])
+        self.assertEqual(changed(), [])
+        ok, error = tklgit.commit_state(state_path)
+        self.assertFalse(ok)
+        self.assertIn(tklgit.PENDING_SUFFIX, error)
+        # Unchanged branches are not counted against the rate limit
+        self.assertEqual(self.server.remaining, 60 - 4)
+        del heads[('factory-master', 'master')]
+        _, repos = tklgit.list_repositories(json_input, client)
+        ok, error = tklgit.resolve_heads(repos, client)
+        self.assertFalse(ok)
+        self.assertIn('Branch not found', error)
+        client.close()
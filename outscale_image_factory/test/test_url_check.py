@@ -0,0 +1,133 @@
+"""
+Unit tests for url_check.
+"""
+import BaseHTTPServer
+import SocketServer
+import collections
+import hashlib
+import os
+import shutil
+import tempfile
+import threading
+import unittest
+from outscale_image_factory import url_check
+
+
+class _Server(SocketServer.ThreadingMixIn, BaseHTTPServer.HTTPServer):
+
+    daemon_threads = True
+
+    def handle_error(self, request, client_address):
+        # Checks with GET close the connection without reading the body
+        pass
+
+
+class _Handler(BaseHTTPServer.BaseHTTPRequestHandler):
+
+    protocol_version = 'HTTP/1.1'
+
+    def log_message(self, *args):
+        pass
+
+    def _reply(self, status, body=b'', headers=()):
+        self.send_response(status)
+        for name, value in headers:
+            self.send_header(name, value)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        if self.command == 'GET':
+            self.wfile.write(body)
+
+    def do_HEAD(self):
+        self.server.requests[(self.command, self.path)] += 1
+        if self.path == '/no-head':
+            self._reply(405)
+        elif self.path == '/moved':
+            self._reply(301, headers=[('Location', '/file')])
+        elif self.path in ('/file', '/no-head'):
+            self._reply(200, b'file content', [('ETag', '"v1"')])
+        else:
+            self._reply(404)
+
+    def do_GET(self):
+        if self.path == '/no-head':
+            self.server.requests[(self.command, self.path)] += 1
+            self._reply(200, b'file content', [('ETag', '"v1"')])
+        else:
+            self.do_HEAD()
+
+
+class TestUrlCheck(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp()
+        self.server = _Server(('127.0.0.1', 0), _Handler)
+        self.server.requests = collections.Counter()
+        thread = threading.Thread(target=self.server.serve_forever)
+        thread.daemon = True
+        thread.start()
+        self.base = 'http://127.0.0.1:{}'.format(self.server.server_port)
+
+    def tearDown(self):
+        self.server.shutdown()
+        self.server.server_close()
+        shutil.rmtree(self.tmp_dir)
+
+    def _check(self, paths, store=None):
+        results = url_check.check_urls([self.base + path for path in paths],
+                                       4, store, 5)
+        return dict((result['url'].replace(self.base, ''), result)
+                    for result in results)
+
+    def test_check(self):
+        results = self._check(['/file', '/missing', '/no-head', '/moved',
+                               '/${VERSION}'])
+        self.assertTrue(results['/file']['ok'])
+        self.assertEqual(results['/file']['etag'], '"v1"')
+        self.assertEqual(results['/file']['size'], len(b'file content'))
+        self.assertFalse(results['/missing']['ok'])
+        self.assertEqual(results['/missing']['status'], 404)
+        # HEAD not allowed, checked with GET
+        self.assertTrue(results['/no-head']['ok'])
+        self.assertEqual(self.server.requests[('GET', '/no-head')], 1)
+        self.assertTrue(results['/moved']['ok'])
+        self.assertTrue(results['/${VERSION}']['skipped'])
+        self.assertEqual(url_check.clean_url('http://a/b.tar.gz").'),
+                         'http://a/b.tar.gz')
+
+    def test_malformed(self):
+        # A bad port or IPv6 host fails its check only
+        urls = ['http://localhost:8080</a>', 'http://[::1/x',
+                self.base + '/file']
+        results = dict((result['url'], result)
+                       for result in url_check.check_urls(urls, 2))
+        self.assertFalse(results[urls[0]]['ok'])
+        self.assertIn('ValueError', results[urls[0]]['error'])
+        self.assertFalse(results[urls[1]]['ok'])
+        self.assertIn('ValueError', results[urls[1]]['error'])
+        self.assertTrue(results[urls[2]]['ok'])
+
+    def test_pool(self):
+        pool = url_check.ConnectionPool(5)
+        for _ in range(5):
+            result = url_check.check_url(pool, self.base + '/file')
+            self.assertTrue(result['ok'])
+        pool.close()
+        # Kept alive
+        self.assertEqual(pool.created, 1)
+
+    def test_prefetch(self):
+        store = url_check.Store(os.path.join(self.tmp_dir, 'store'))
+        results = self._check(['/file', '/missing'], store)
+        digest = hashlib.sha256(b'file content').hexdigest()
+        self.assertEqual(results['/file']['sha256'], digest)
+        self.assertNotIn('sha256', results['/missing'])
+        with open(store.object_path(digest), 'rb') as fp:
+            self.assertEqual(fp.read(), b'file content')
+        self.assertEqual(self.server.requests[('GET', '/file')], 1)
+        # Same ETag, not downloaded again
+        store = url_check.Store(os.path.join(self.tmp_dir, 'store'))
+        results = self._check(['/file'], store)
+        self.assertEqual(results['/file']['sha256'], digest)
+        self.assertEqual(self.server.requests[('GET', '/file')], 1)
+        self.assertEqual(self.server.requests[('HEAD', '/file')], 1)
@@ -0,0 +1,131 @@
+"""
+Unit tests for waiter.
+"""
+import unittest
+from outscale_image_factory import waiter
+
+
+class FakeClock(object):
+
+    def __init__(self):
+        self.now = 0.0
+        self.sleeps = []
+
+    def time(self):
+        return self.now
+
+    def sleep(self, sec):
+        self.sleeps.append(sec)
+        self.now += sec
+
+
+class FakeSnapshot(object):
+
+    """Snapshot progressing at a constant rate of 1% per second."""
+
+    def __init__(self, clock, rate=1.0):
+        self.id = 'snap-00000001'
+        self.clock = clock
+        self.rate = rate
+        self.update_count = 0
+        self.update()
+        self.update_count = 0
+
+    def update(self):
+        self.update_count += 1
+        pct = min(100, int(self.clock.now * self.rate))
+        self.progress = '{}%'.format(pct)
+        self.status = 'completed' if pct == 100 else 'pending'
+
+
+class FakeVolume(object):
+
+    def __init__(self, states):
+        self.id = 'vol-00000001'
+        self.states = list(states)
+        self.status = self.states.pop(0)
+
+    def update(self):
+        if self.states:
+            self.status = self.states.pop(0)
+
+
+class FakeConnection(object):
+
+    """Describe volumes whose state changes after a given number of calls."""
+
+    def __init__(self, ready_after):
+        self.ready_after = ready_after
+        self.calls = 0
+
+    def get_all_volumes(self, volume_ids=None):
+        self.calls += 1
+        volumes = []
+        for volume_id in volume_ids:
+            vol = FakeVolume(['available' if self.calls >= self.ready_after[
+                volume_id] else 'in-use'])
+            vol.id = volume_id
+            volumes.append(vol)
+        return volumes
+
+
+class TestWaiter(unittest.TestCase):
+
+    def setUp(self):
+        self.clock = FakeClock()
+
+    def _wait(self, obj, target_state, wait_sec=600):
+        return waiter.wait_for(obj, target_state, wait_sec,
+                               sleep=self.clock.sleep, clock=self.clock.time)
+
+    def test_resource_type(self):
+        self.assertEqual(waiter.resource_type(FakeVolume(['x'])), 'volume')
+        self.assertEqual(waiter.resource_type(FakeSnapshot(self.clock)),
+                         'snapshot')
+
+    def test_fast_first_poll(self):
+        vol = FakeVolume(['creating', 'available'])
+        self.assertTrue(self._wait(vol, 'available'))
+        self.assertEqual(len(self.clock.sleeps), 1)
+        self.assertLess(self.clock.sleeps[0], 1.0)
+
+    def test_backoff_grows(self):
+        vol = FakeVolume(['creating'] * 10 + ['available'])
+        self.assertTrue(self._wait(vol, 'available'))
+        self.assertGreater(self.clock.sleeps[-1], self.clock.sleeps[0])
+
+    def test_snapshot_eta(self):
+        snap = FakeSnapshot(self.clock, rate=0.1)
+        self.assertTrue(self._wait(snap, 'completed', wait_sec=3600))
+        # A fixed 1.5 s poll would need ~670 polls for a 1000 s snapshot
+        self.assertLess(snap.update_count, 40)
+
+    def test_error_state(self):
+        vol = FakeVolume(['creating', 'error', 'available'])
+        self.assertFalse(self._wait(vol, 'available'))
+        self.assertEqual(vol.status, 'error')
+
+    def test_timeout(self):
+        vol = FakeVolume(['creating'])
+        self.assertFalse(self._wait(vol, 'available', wait_sec=30))
+        self.assertLessEqual(self.clock.now, 30)
+
+    def test_coordinator_batches(self):
+        ready_after = dict(('vol-{:08x}'.format(i), i % 5 + 1)
+                           for i in range(20))
+        conn = FakeConnection(ready_after)
+        volumes = []
+        for volume_id in sorted(ready_after):
+            vol = FakeVolume(['in-use'])
+            vol.id = volume_id
+            volumes.append(vol)
+        coord = waiter.WaitCoordinator(conn, sleep=self.clock.sleep,
+                                       clock=self.clock.time)
+        results = coord.wait_all(volumes, 'available')
+        self.assertEqual(results, [True] * len(volumes))
+        self.assertEqual(conn.calls, 5)
+        self.assertEqual(coord.describe_calls, 5)
+
+
+if __name__ == '__main__':
+    unittest.main()
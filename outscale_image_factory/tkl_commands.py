@@ -3,13 +3,30 @@ Build VM disk image from a Turnkey recipe.
 """
 from __future__ import division, absolute_import, print_function, unicode_literals
 
+import contextlib
+import glob
+import json
+import multiprocessing
 import os
 import logging
 import shutil
+import sys
 import tempfile
+import urlparse
 
-from outscale_image_factory.helper import check_cmd, cd
-from outscale_image_factory.install import install_rootfs
+from outscale_image_factory import apt_cache
+from outscale_image_factory import build_all
+from outscale_image_factory import config
+from outscale_image_factory import git_mirror
+from outscale_image_factory import tracing
+from outscale_image_factory.fingerprint import fingerprint
+from outscale_image_factory.helper import check_cmd, cd, positive_int
+from outscale_image_factory.install import install_rootfs, \
+    add_engine_arguments, add_target_arguments, ENGINE_RSYNC, JOBS
+from outscale_image_factory.journal import Journal, file_signature, \
+    tree_signature
+from outscale_image_factory.patch_engine import apply_patches
+from outscale_image_factory.rootfs_cache import RootfsCache, GIB
 
 # Defaults
 TURNKEY_APPS_GIT = 'https://github.com/turnkeylinux-apps'
@@ -18,6 +35,12 @@ FAB_PATH = '/turnkey/fab'
 FAB_APT_PROXY = 'http://127.0.0.1:8124'
 FAB_HTTP_PROXY = 'http://127.0.0.1:8124'
 PATCH_LIST = ['headless', 'outscale']
+# Patch engines: merge the patches and apply them in one pass, or run
+# tklpatch-apply for each patch
+PATCH_ENGINE_BUILTIN = 'builtin'
+PATCH_ENGINE_TKLPATCH = 'tklpatch'
+# Root squashfs of the TurnKey Linux ISO files, depending on the release
+SQUASHFS_PATHS = ['live/10root.squashfs', 'casper/10root.squashfs']
 UMASK = 0o022
 
 
@@ -29,41 +52,283 @@ def setup_environment(fab_dir):
     os.environ.setdefault('FAB_HTTP_PROXY', FAB_HTTP_PROXY)
 
 
-def _clone_or_update(repo, products_dir, app):
+def _clone_or_update(repo, products_dir, app, branch=None, mirror_dir=None,
+                     fetch=True):
     app_dir = '{}/{}'.format(products_dir, app)
+    if mirror_dir:
+        return git_mirror.clone_or_update(mirror_dir, repo, app_dir, branch,
+                                          fetch)
     if os.path.exists(app_dir):
         logging.info('Updating {}'.format(app))
         ok, err = cd(app_dir)
+        if ok and branch:
+            ok, err = check_cmd('git checkout {}'.format(branch))
         if ok:
             ok, err = check_cmd('git pull')
     else:
         logging.info('Cloning {}'.format(app))
         cd(products_dir)
-        ok, err = check_cmd('git clone {}'.format(repo))
+        if branch:
+            ok, err = check_cmd('git clone --branch {} {} {}'.format(
+                branch, repo, app))
+        else:
+            ok, err = check_cmd('git clone {}'.format(repo))
     return ok, err
 
 
-def tkl_install_iso(dev, product_iso, patch_dir, patch_list):
+def _extract_iso(work_dir, product_iso):
+    for name in os.listdir(work_dir):
+        if name.startswith('product.'):
+            # Leftovers of an interrupted extraction
+            shutil.rmtree(os.path.join(work_dir, name).encode('utf-8'))
+    logging.info('Extracting iso in {}'.format(work_dir))
+    with tracing.span('Extracting iso', 'install'):
+        return _cmd_step('tklpatch-extract-iso {}'.format(product_iso))
+
+
+def _reset_overlay(work_dir, product_iso):
+    """
+    Empty the upper and work directories of the overlayfs unless they were
+    made on the same ISO, recorded in work_dir/overlay.signature: the files
+    patched by an interrupted build only apply to that lower layer.
+    """
+    signature_path = '{}/overlay.signature'.format(work_dir)
+    signature = file_signature(product_iso)
+    if os.path.exists(signature_path):
+        with open(signature_path) as fp:
+            if json.load(fp) == signature:
+                return
+    for name in ('upper', 'work'):
+        path = '{}/overlay.{}'.format(work_dir, name)
+        if os.path.isdir(path):
+            logging.info('Removing {}, made on another iso'.format(path))
+            shutil.rmtree(path.encode('utf-8'))
+    with open(signature_path, 'w') as fp:
+        json.dump(signature, fp)
+
+
+def _mount_iso(work_dir, product_iso, mounts):
+    """
+    Mount product_iso and its root squashfs read-only, with an overlayfs
+    on top: the patches only write to the upper directory, kept in
+    work_dir to resume a build on the same ISO, see _reset_overlay(). The
+    merged view is work_dir/overlay.rootfs.
+
+    The mount points are appended to mounts, to be unmounted in reverse
+    order.
+
+    Return (ok, error) tuple.
+    """
+    iso_dir, lower_dir, upper_dir, ovl_work_dir, rootfs_dir = [
+        '{}/overlay.{}'.format(work_dir, name)
+        for name in ('iso', 'squashfs', 'upper', 'work', 'rootfs')]
+    for path in (rootfs_dir, lower_dir, iso_dir):
+        if os.path.ismount(path):
+            # Leftovers of an interrupted build
+            _umount([path])
+    _reset_overlay(work_dir, product_iso)
+    for path in (iso_dir, lower_dir, upper_dir, ovl_work_dir, rootfs_dir):
+        if not os.path.isdir(path):
+            os.makedirs(path)
+    logging.info('Mounting iso in {}'.format(work_dir))
+    ok, err = check_cmd('mount -t iso9660 -o loop,ro {} {}'.format(
+        product_iso, iso_dir))
+    if not ok:
+        return ok, err
+    mounts.append(iso_dir)
+    for squashfs in [os.path.join(iso_dir, name) for name in SQUASHFS_PATHS] + \
+            sorted(glob.glob(os.path.join(iso_dir, '*', '*.squashfs'))):
+        if os.path.exists(squashfs):
+            break
+    else:
+        return False, 'No root squashfs found in {}'.format(product_iso)
+    ok, err = check_cmd('mount -t squashfs -o loop,ro {} {}'.format(
+        squashfs, lower_dir))
+    if not ok:
+        return ok, err
+    mounts.append(lower_dir)
+    ok, err = check_cmd(
+        'mount -t overlay overlay -o lowerdir={},upperdir={},workdir={} {}'
+        .format(lower_dir, upper_dir, ovl_work_dir, rootfs_dir))
+    if ok:
+        mounts.append(rootfs_dir)
+    return ok, err
+
+
+def _umount(mounts):
+    """
+    Unmount mounts in reverse order, keep the ones still mounted.
+    """
+    for path in reversed(list(mounts)):
+        ok, _ = check_cmd('umount {}'.format(path))
+        if ok:
+            mounts.remove(path)
+
+
+def _cmd_step(cmd):
+    """
+    Run a journaled command: only the error data is worth returning, the
+    output of a successful command is not recorded in the journal.
+    """
+    ok, data = check_cmd(cmd)
+    return ok, ({} if ok else data)
+
+
+def _apply_patches(rootfs_dir, product_iso, patch_paths, journal,
+                   patch_engine=PATCH_ENGINE_TKLPATCH):
+    """
+    Apply the patches to rootfs_dir, made from product_iso, with the builtin
+    engine or one tklpatch-apply command per patch.
+    """
+    logging.info('Applying patches')
+    # In overlay mode no journaled step precedes the patches: the ISO is
+    # part of their inputs
+    iso = file_signature(product_iso)
+    if patch_engine == PATCH_ENGINE_BUILTIN:
+        inputs = dict(rootfs=rootfs_dir, iso=iso,
+                      patches=[[os.path.basename(patch_path),
+                                tree_signature(patch_path)]
+                               for patch_path in patch_paths])
+        return journal.run(
+            'apply-patches', inputs,
+            lambda: apply_patches(rootfs_dir, patch_paths))
+    ok, err = True, None
+    for patch_path in patch_paths:
+        patch = os.path.basename(patch_path)
+        inputs = dict(patch=patch, rootfs=rootfs_dir, iso=iso,
+                      signature=tree_signature(patch_path))
+        with tracing.span('Applying patch ' + patch, 'install'):
+            ok, err = journal.run(
+                'apply-patch:' + patch, inputs,
+                lambda: _cmd_step('tklpatch-apply {} {}'.format(
+                    rootfs_dir, patch_path)))
+        if not ok:
+            break
+    return ok, err
+
+
+@contextlib.contextmanager
+def _cache_entry(cache, key):
+    if cache is None:
+        yield None
+    else:
+        with cache.use(key) as path:
+            yield path
+
+
+def tkl_install_iso(dev, product_iso, patch_dir, patch_list,
+                    incremental=False, journal=None, jobs=JOBS,
+                    engine=ENGINE_RSYNC, fs_image=None, output_image=None,
+                    fit=False, find_image=None, cache=None, overlay=False,
+                    patch_engine=PATCH_ENGINE_TKLPATCH,
+                    want_fingerprint=False):
+    """
+    Extract product_iso, apply the patches and install the result to dev.
+
+    journal: Journal used to skip the steps completed by a previous run. The
+    work directory is then kept next to the journal file until the
+    installation succeeds.
+    jobs: maximum number of install steps run concurrently.
+    engine, fs_image, output_image, fit: see install_rootfs.
+    find_image: function returning the id of an existing image built from a
+    rootfs with the given fingerprint, or None. If it finds one, nothing is
+    installed.
+    cache: RootfsCache of the patched rootfs. The rootfs is only extracted
+    and patched if the cache has no entry for the ISO and patches.
+    overlay: mount the ISO with an overlayfs instead of extracting it, only
+    the patched files are written to disk. The cache is not used.
+    patch_engine: PATCH_ENGINE_TKLPATCH to run tklpatch-apply for each
+    patch, or PATCH_ENGINE_BUILTIN to apply all the patches in one pass.
+    want_fingerprint: fingerprint the patched rootfs even without
+    find_image. Reading the whole rootfs, it is skipped otherwise.
+
+    Return (ok, data) tuple. On success data is a dict holding the
+    fingerprint of the patched rootfs, or None if not computed, and the id
+    of the image found by find_image, or None. On failure data is the
+    error.
+    """
+    if journal is None:
+        journal = Journal()
     product_iso = os.path.abspath(product_iso)
-    work_dir = tempfile.mkdtemp(suffix='-outscale-work')
+    patch_paths = ['{}/{}'.format(patch_dir, patch) for patch in patch_list]
+    # The paths are used after changing to the work directory
+    if fs_image is not None:
+        fs_image = os.path.abspath(fs_image)
+    if output_image is not None:
+        output_image = os.path.abspath(output_image)
+    if journal.path:
+        work_dir = os.path.abspath(journal.path + '.work')
+        if not os.path.isdir(work_dir):
+            os.makedirs(work_dir)
+    else:
+        work_dir = tempfile.mkdtemp(suffix='-outscale-work')
+    if overlay:
+        cache = None
+        rootfs_dir = '{}/overlay.rootfs'.format(work_dir)
+    else:
+        rootfs_dir = '{}/product.rootfs'.format(work_dir)
+    key = None if cache is None else cache.key(product_iso, patch_paths)
     cd(work_dir)
+    ok = False
+    mounts = []
     try:
-        logging.info('Extracting iso in {}'.format(work_dir))
-        ok, err = check_cmd('tklpatch-extract-iso {}'.format(product_iso))
-        if ok:
-            logging.info('Applying patches')
-            rootfs_dir = '{}/product.rootfs'.format(work_dir)
-            for patch in patch_list:
-                ok, err = check_cmd(
-                    'tklpatch-apply {} {}/{}'.format(rootfs_dir, patch_dir, patch))
-                if not ok:
-                    break
-        if ok:
-            ok, err = install_rootfs(dev, rootfs_dir)
+        with _cache_entry(cache, key) as cached_dir:
+            if cached_dir is not None:
+                ok, rootfs_dir = True, cached_dir
+            else:
+                if overlay:
+                    ok, err = _mount_iso(work_dir, product_iso, mounts)
+                else:
+                    ok, err = journal.run(
+                        'extract-iso', dict(iso=file_signature(product_iso)),
+                        lambda: _extract_iso(work_dir, product_iso),
+                        valid=lambda _: os.path.isdir(rootfs_dir))
+                if ok:
+                    ok, err = _apply_patches(rootfs_dir, product_iso,
+                                             patch_paths, journal,
+                                             patch_engine)
+                if ok and cache is not None:
+                    ok, err = cache.add(key, rootfs_dir)
+                    rootfs_dir = cache.entry_path(key)
+            data = dict(fingerprint=None, image_id=None)
+            if ok and (want_fingerprint or find_image is not None):
+                # Keyed like the rootfs: the steps producing it may be
+                # skipped, by a cache hit or in overlay mode
+                inputs = dict(iso=file_signature(product_iso),
+                              patches=[[os.path.basename(patch_path),
+                                        tree_signature(patch_path)]
+                                       for patch_path in patch_paths])
+                ok, outputs = journal.run(
+                    'fingerprint', inputs,
+                    lambda: (True, dict(fingerprint=fingerprint(rootfs_dir))))
+                data['fingerprint'] = outputs['fingerprint']
+                logging.info('Rootfs fingerprint is {}'.format(
+                    data['fingerprint']))
+                if find_image is not None:
+                    data['image_id'] = find_image(data['fingerprint'])
+                if data['image_id'] is not None:
+                    logging.info('Image {} has the same fingerprint, skipping '
+                                 'the installation'.format(data['image_id']))
+                    return True, data
+            if ok:
+                with tracing.span('Installing rootfs', 'install'):
+                    ok, err = install_rootfs(dev, rootfs_dir,
+                                             incremental=incremental,
+                                             journal=journal, jobs=jobs,
+                                             engine=engine, fs_image=fs_image,
+                                             output_image=output_image,
+                                             fit=fit)
     finally:
-        logging.info('Deleting {}'.format(work_dir))
-        shutil.rmtree(work_dir.encode('utf-8'))
-    return ok, err
+        _umount(mounts)
+        if mounts:
+            logging.error('Keeping {}, {} still mounted'.format(
+                work_dir, ', '.join(mounts)))
+        elif ok or not journal.path:
+            logging.info('Deleting {}'.format(work_dir))
+            shutil.rmtree(work_dir.encode('utf-8'))
+        else:
+            logging.info('Keeping {} to resume the build'.format(work_dir))
+    return ok, (data if ok else err)
 
 
 def cmd_tkl_install_iso(args):
@@ -76,37 +341,107 @@ def cmd_tkl_install_iso(args):
     else:
         iso = os.path.join(args.fab_dir, 'products', args.appliance_or_iso,
                            'build/product.iso')
-    ok, _ = tkl_install_iso(args.device,
+    find_image = None
+    if args.reuse_image:
+        # Imported here, the EC2 commands are optional
+        from outscale_image_factory import create_ami
+        conn = create_ami._connect(args.region)
+        find_image = lambda fp: create_ami.find_fingerprint_image(conn, fp)
+    cache = None
+    if not (args.no_rootfs_cache or args.overlay):
+        cache = RootfsCache(args.rootfs_cache, args.rootfs_cache_gib * GIB)
+    ok, data = tkl_install_iso(args.device,
                             iso,
                             args.patch_dir,
-                            PATCH_LIST + args.add_tklpatch)
+                            PATCH_LIST + args.add_tklpatch,
+                            args.incremental,
+                            Journal(args.journal),
+                            args.jobs,
+                            args.engine,
+                            args.fs_image,
+                            args.output_image,
+                            args.fit,
+                            find_image,
+                            cache,
+                            args.overlay,
+                            args.patch_engine,
+                            args.fingerprint)
+    if ok and data['fingerprint'] is not None:
+        sys.stdout.write('FINGERPRINT={}\n'.format(data['fingerprint']))
+    if ok and data['image_id'] is not None:
+        sys.stdout.write('IMAGE_ID={}\n'.format(data['image_id']))
     return ok
 
 
 def parser_tkl_install_iso(parser):
     parser.description = 'Install a system from an ISO file to a device'
     parser.add_argument('appliance_or_iso', metavar='APPLIANCE_OR_ISO')
-    parser.add_argument('-d', '--device')
+    add_target_arguments(parser)
     parser.add_argument('-p', '--patch-dir', default=PATCH_DIR)
     parser.add_argument('-f', '--fab-dir', default=FAB_PATH)
     parser.add_argument('-t', '--add-tklpatch', action='append', default=[])
+    parser.add_argument('-i', '--incremental', action='store_true',
+                        help='Only copy the differences if the device '
+                        'already holds a root filesystem')
+    parser.add_argument('-j', '--journal', metavar='FILE',
+                        help='Record completed steps in FILE, skip them '
+                        'when run again')
+    parser.add_argument('--jobs', type=positive_int, default=JOBS,
+                        help='Maximum number of install steps run '
+                        'concurrently (default: %(default)s)')
+    add_engine_arguments(parser)
+    parser.add_argument('--fingerprint', action='store_true',
+                        help='Fingerprint the patched rootfs, print its '
+                        'FINGERPRINT')
+    parser.add_argument('--reuse-image', action='store_true',
+                        help='Skip the installation if an image was built '
+                        'from an identical rootfs, print its IMAGE_ID')
+    parser.add_argument('--region', default=config.load()['region'])
+    parser.add_argument('--rootfs-cache', metavar='DIR',
+                        default=config.load()['rootfs-cache-dir'],
+                        help='Cache of the patched rootfs '
+                        '(default: %(default)s)')
+    parser.add_argument('--rootfs-cache-gib', metavar='GIB', type=int,
+                        default=int(config.load()['rootfs-cache-gib']),
+                        help='Size budget of the rootfs cache '
+                        '(default: %(default)s)')
+    parser.add_argument('--no-rootfs-cache', action='store_true',
+                        help='Always extract and patch the ISO')
+    parser.add_argument('--patch-engine', default=PATCH_ENGINE_TKLPATCH,
+                        choices=[PATCH_ENGINE_TKLPATCH, PATCH_ENGINE_BUILTIN],
+                        help='Apply the patches with one tklpatch-apply per '
+                        'patch, or in one pass (default: %(default)s)')
+    parser.add_argument('--overlay', action='store_true',
+                        help='Mount the ISO read-only with an overlayfs '
+                        'instead of extracting it, without rootfs cache')
 
 
-def tkl_build(app, git, fab_dir):
+def tkl_build(app, git, fab_dir, repo=None, branch=None, update_core=True,
+              mirror_dir=None, fetch=True):
     """Build the TKL appliance.
 
     app: turnkey app to build
     git: git repository containing turnkey apps
     fab_dir: turnkey build directory
+    repo: repository of the app, defaults to git/app
+    branch: branch to build, defaults to the default branch of the repository
+    update_core: clone or update the core appliance first
+    mirror_dir: clone through the git mirrors of this directory
+    fetch: update the mirrors before cloning
     """
     core_repo = '{}/core.git'.format(TURNKEY_APPS_GIT)
-    repo = '{}/{}'.format(git, app)
+    if repo is None:
+        repo = '{}/{}'.format(git, app)
     products_dir = '{}/products'.format(fab_dir)
     app_dir = '{}/{}'.format(products_dir, app)
 
-    ok, err = _clone_or_update(core_repo, products_dir, 'core')
+    ok, err = True, None
+    if update_core:
+        ok, err = _clone_or_update(core_repo, products_dir, 'core',
+                                   mirror_dir=mirror_dir, fetch=fetch)
     if ok:
-        ok, err = _clone_or_update(repo, products_dir, app)
+        ok, err = _clone_or_update(repo, products_dir, app, branch,
+                                   mirror_dir, fetch)
     if ok:
         logging.info('Building product {}'.format(app))
         ok, err = cd(app_dir)
@@ -115,19 +450,197 @@ def tkl_build(app, git, fab_dir):
     return ok, err
 
 
+def _start_apt_cache(args):
+    """
+    Start the apt-cache service at the address of FAB_APT_PROXY, if it is a
+    local address and nothing listens there.
+    """
+    url = urlparse.urlparse(os.environ['FAB_APT_PROXY'])
+    if args.no_apt_cache or url.hostname not in ('127.0.0.1', 'localhost'):
+        return True
+    ok, _ = apt_cache.start('{}:{}'.format(url.hostname, url.port or 80),
+                            args.apt_cache_dir, args.apt_cache_gib)
+    return ok
+
+
+def add_apt_cache_arguments(parser):
+    parser.add_argument('--no-apt-cache', action='store_true',
+                        help='Do not start apt-cache when nothing listens '
+                        'at FAB_APT_PROXY')
+    parser.add_argument('--apt-cache-dir', metavar='DIR',
+                        default=config.load()['apt-cache-dir'],
+                        help='Directory of the apt-cache files '
+                        '(default: %(default)s)')
+    parser.add_argument('--apt-cache-gib', metavar='GIB', type=int,
+                        default=int(config.load()['apt-cache-gib']),
+                        help='Size budget of apt-cache (default: %(default)s)')
+
+
+def cmd_apt_cache(args):
+    apt_cache.serve(args.listen, args.cache_dir, args.cache_gib)
+    return True
+
+
+def parser_apt_cache(parser):
+    parser.description = 'Run a caching proxy for the fab downloads'
+    parser.add_argument('--listen', metavar='HOST:PORT',
+                        default=apt_cache.LISTEN,
+                        help='Address to listen on (default: %(default)s)')
+    parser.add_argument('--cache-dir', metavar='DIR',
+                        default=config.load()['apt-cache-dir'],
+                        help='Directory of the cached files '
+                        '(default: %(default)s)')
+    parser.add_argument('--cache-gib', metavar='GIB', type=int,
+                        default=int(config.load()['apt-cache-gib']),
+                        help='Size budget of the cache (default: %(default)s)')
+
+
 def cmd_tkl_build(args):
     setup_environment(args.fab_dir)
+    if not _start_apt_cache(args):
+        return False
     ok, _ = tkl_build(args.app,
                       args.turnkey_apps_git,
-                      args.fab_dir)
+                      args.fab_dir,
+                      args.repo,
+                      args.branch,
+                      not args.no_core_update,
+                      _mirror_dir(args),
+                      not args.no_fetch)
     return ok
 
 
+def _mirror_dir(args):
+    return None if args.no_mirror else args.mirror_dir
+
+
+def add_mirror_arguments(parser):
+    parser.add_argument('--mirror-dir', metavar='DIR',
+                        default=config.load()['git-mirror-dir'],
+                        help='Directory of the git mirrors '
+                        '(default: %(default)s)')
+    parser.add_argument('--no-mirror', action='store_true',
+                        help='Clone the repositories directly')
+
+
 def parser_tkl_build(parser):
     parser.description = 'Build a TKL appliance'
     parser.add_argument('app')
     parser.add_argument('-f', '--fab-dir', default=FAB_PATH)
     parser.add_argument('-g', '--turnkey-apps-git', default=TURNKEY_APPS_GIT)
+    parser.add_argument('--repo', metavar='URL',
+                        help='Repository of the app (default: '
+                        'TURNKEY_APPS_GIT/APP)')
+    parser.add_argument('--branch', help='Branch to build')
+    parser.add_argument('--no-core-update', action='store_true',
+                        help='Do not clone or update the core appliance')
+    add_mirror_arguments(parser)
+    parser.add_argument('--no-fetch', action='store_true',
+                        help='Do not update the mirrors, they are refreshed '
+                        'by refresh-mirrors')
+    add_apt_cache_arguments(parser)
+
+
+def _load_apps(path):
+    """
+    Return the (appliance, repository, branch) tuples of the tklgit output
+    in path. The head commits listed by tklgit --resolve are dropped.
+    """
+    with open(path) as fp:
+        return [tuple(entry[:3]) for entry in json.load(fp)]
+
+
+def cmd_tkl_build_all(args):
+    setup_environment(args.fab_dir)
+    # Started once here, the builds find it listening
+    if not _start_apt_cache(args):
+        return False
+    apps = _load_apps(args.tklgit_json)
+    core_repo = '{}/core.git'.format(args.turnkey_apps_git)
+    mirror_dir = _mirror_dir(args)
+    if mirror_dir:
+        # One concurrent pass fetches all the repositories, the builds
+        # clone from the mirrors without fetching again
+        git_mirror.refresh_mirrors(
+            mirror_dir,
+            [core_repo] + [build_all.clone_url(url) for _, url, _ in apps],
+            args.fetch_jobs)
+        build_args = ['--mirror-dir', mirror_dir, '--no-fetch']
+    else:
+        build_args = ['--no-mirror']
+    if not any(app == build_all.CORE for app, _, _ in apps):
+        # Update the core appliance once, before the concurrent builds
+        ok, _ = _clone_or_update(core_repo,
+                                 '{}/products'.format(args.fab_dir),
+                                 build_all.CORE, mirror_dir=mirror_dir,
+                                 fetch=False)
+        if not ok:
+            return False
+    limits = {build_all.CPU: args.build_jobs,
+              build_all.IO: args.install_jobs,
+              build_all.DEVICE: args.device_slots}
+    ok, _ = build_all.build_all(apps, args.fab_dir, args.log_dir,
+                                args.output_dir, limits,
+                                args.turnkey_apps_git, build_args)
+    return ok
+
+
+def parser_tkl_build_all(parser):
+    parser.description = 'Build TKL appliances listed by tklgit in parallel'
+    parser.add_argument('tklgit_json', metavar='TKLGIT_JSON',
+                        help='JSON list of (appliance, repository, branch) '
+                        'printed by tklgit')
+    parser.add_argument('-f', '--fab-dir', default=FAB_PATH)
+    parser.add_argument('-g', '--turnkey-apps-git', default=TURNKEY_APPS_GIT)
+    parser.add_argument('-o', '--output-dir', metavar='DIR',
+                        help='Install each appliance to the disk image '
+                        'DIR/APP.img')
+    parser.add_argument('-l', '--log-dir', metavar='DIR', default='.',
+                        help='Directory of the build logs (default: '
+                        'current directory)')
+    parser.add_argument('--build-jobs', type=positive_int,
+                        default=multiprocessing.cpu_count(),
+                        help='Concurrent builds (default: number of CPUs)')
+    parser.add_argument('--install-jobs', type=positive_int, default=2,
+                        help='Concurrent installs (default: %(default)s)')
+    parser.add_argument('--device-slots', type=positive_int, default=8,
+                        help='Devices available to installs '
+                        '(default: %(default)s)')
+    add_mirror_arguments(parser)
+    parser.add_argument('--fetch-jobs', type=positive_int,
+                        default=git_mirror.JOBS,
+                        help='Concurrent mirror fetches '
+                        '(default: %(default)s)')
+    add_apt_cache_arguments(parser)
+
+
+def cmd_refresh_mirrors(args):
+    if args.tklgit_json:
+        apps = _load_apps(args.tklgit_json)
+        urls = ['{}/core.git'.format(args.turnkey_apps_git)] + \
+            [build_all.clone_url(url) for _, url, _ in apps]
+    else:
+        urls = git_mirror.list_mirrors(args.mirror_dir)
+    ok, failed = git_mirror.refresh_mirrors(args.mirror_dir, urls, args.jobs)
+    print('{} mirrors updated, {} failed'.format(len(set(urls)) - len(failed),
+                                                 len(failed)))
+    return ok
+
+
+def parser_refresh_mirrors(parser):
+    parser.description = 'Update the git mirrors of TKL appliances'
+    parser.add_argument('tklgit_json', metavar='TKLGIT_JSON', nargs='?',
+                        help='JSON list of (appliance, repository, branch) '
+                        'printed by tklgit (default: update the existing '
+                        'mirrors)')
+    parser.add_argument('-g', '--turnkey-apps-git', default=TURNKEY_APPS_GIT)
+    parser.add_argument('--mirror-dir', metavar='DIR',
+                        default=config.load()['git-mirror-dir'],
+                        help='Directory of the git mirrors '
+                        '(default: %(default)s)')
+    parser.add_argument('-j', '--jobs', type=positive_int,
+                        default=git_mirror.JOBS,
+                        help='Concurrent fetches (default: %(default)s)')
 
 
 def tkl_clean(app, fab_dir):
@@ -2,17 +2,50 @@
 """
 Generate a list of Turnkey Linux repositories.
 
-Dependencies:
- http://jacquev6.github.io/PyGithub/v1/
+The accounts are listed concurrently with github_api, from the responses
+cached by the previous runs when unchanged.
+
+With --state, the head commit of the branch of each repository is resolved
+and compared to the state of the last successful builds: --changed-only
+lists the repositories whose branch moved since. The heads are kept aside
+until the builds succeed, then saved as the new state by --commit-state.
 """
 from __future__ import division, absolute_import, print_function, unicode_literals
 
-import sys
+import argparse
 import json
-import github
+import logging
+import os
+import sys
+import urllib
+
+from outscale_image_factory import config, github_api
+from outscale_image_factory.helper import positive_int
 
 
-def parse_entry(json_input_record):
+# Suffix of the state file of the heads listed for the builds in progress
+PENDING_SUFFIX = '.pending'
+
+
+def select_repos(json_input_record, repos):
+    '''
+    Return the list of (appliance_name, repository_url, branch) triplets of
+    repos, the repositories listed by the API for the account of the
+    record, selected by its repo_map.
+    '''
+    _, repo_map = json_input_record
+    repo_list = []
+    for repo in repos:
+        repo_branch = 'master'
+        if repo_map:
+            repo_branch = repo_map.get(repo['name'])
+            if repo_branch is None:
+                continue
+        repo_list.append((repo['name'], repo['url'], repo_branch))
+    return repo_list
+
+
+def parse_entry(json_input_record, client=None):
     '''
     Take a record from the json input file and return a list of
     repositories.
@@ -26,36 +59,169 @@ def parse_entry(json_input_record):
     The output is a list of triplets:
     [(appliance_name, repository_url, branch), ...].
     '''
-    account, repo_map = json_input_record
-    gh = github.Github()
-    user = gh.get_user(account)
-    repo_list = []
-    for repo in user.get_repos():
-        repo_branch = 'master'
-        if repo_map:
-            repo_branch = repo_map.get(repo.name)
-            if repo_branch is None:
-                continue
-        repo_list.append((repo.name, repo.url, repo_branch))
+    ok, repo_list = list_repositories([json_input_record], client)
+    if not ok:
+        raise Exception(repo_list)
     return repo_list
 
 
+def list_repositories(json_input, client=None):
+    '''
+    Return (ok, data) tuple, data being the list of the repositories of all
+    the records of json_input, as returned by parse_entry, or the errors.
+    '''
+    if client is None:
+        client = github_api.GithubClient()
+    listings = client.get_listings(['/users/{}/repos'.format(account)
+                                    for account, _ in json_input])
+    errors = [data for ok, data in listings if not ok]
+    if errors:
+        return False, '\n'.join(errors)
+    output = []
+    for record, (_, repos) in zip(json_input, listings):
+        output.extend(select_repos(record, repos))
+    return True, output
+
+
+def resolve_heads(repo_list, client):
+    '''
+    Return (ok, data) tuple, data being the list of the repositories of
+    repo_list with the SHA of the head commit of their branch appended,
+    or the errors.
+
+    The branches are requested concurrently, an unchanged branch is
+    answered from the cache.
+    '''
+    results = client.get_many([
+        '{}/branches/{}'.format(url, urllib.quote(branch.encode('utf-8')))
+        for _, url, branch in repo_list])
+    errors = [data for ok, data in results if not ok]
+    if errors:
+        return False, '\n'.join(errors)
+    return True, [(app, url, branch, data['body']['commit']['sha'])
+                  for (app, url, branch), (_, data) in zip(repo_list, results)]
+
+
+def load_state(path):
+    '''
+    Return the state saved by save_state, a dict of the repository, branch
+    and head commit of each appliance, empty if path does not exist.
+    '''
+    if not os.path.exists(path):
+        return {}
+    with open(path) as fp:
+        return json.load(fp)
+
+
+def save_state(path, resolved):
+    tmp = path + '.tmp'
+    with open(tmp, 'w') as fp:
+        json.dump(dict((app, dict(url=url, branch=branch, sha=sha))
+                       for app, url, branch, sha in resolved),
+                  fp, sort_keys=True, indent=4, separators=(',', ': '))
+    os.rename(tmp, path)
+
+
+def commit_state(path):
+    '''
+    Replace the state at path with the heads listed by the last run with
+    the same state file, once their builds succeeded.
+
+    Return (ok, error) tuple.
+    '''
+    try:
+        os.rename(path + PENDING_SUFFIX, path)
+    except OSError as error:
+        return False, 'Cannot commit {}: {}'.format(path + PENDING_SUFFIX,
+                                                    error.strerror)
+    return True, None
+
+
+def changed_repos(resolved, state):
+    '''
+    Return the repositories of resolved whose repository, branch or head
+    commit changed since state, with the previous head commit appended,
+    None for a new appliance.
+    '''
+    changed = []
+    for app, url, branch, sha in resolved:
+        previous = state.get(app)
+        if previous != dict(url=url, branch=branch, sha=sha):
+            changed.append((app, url, branch, sha,
+                            previous['sha'] if previous else None))
+    return changed
+
+
 def main():
     """
     Main function.
     """
-    if not sys.argv[1:]:
-        sys.stderr.write('Usage: {} tklgit_input.json\n'.format(sys.argv[0]))
-        sys.exit(1)
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('json_input', metavar='tklgit_input.json', nargs='?',
+                        help='JSON list of (account, repo_map), - for stdin')
+    parser.add_argument('--token', default=os.environ.get('GITHUB_TOKEN'),
+                        help='GitHub API token (default: $GITHUB_TOKEN)')
+    parser.add_argument('--api-url', default=github_api.API_URL,
+                        help='GitHub API URL (default: %(default)s)')
+    parser.add_argument('--cache-dir', metavar='DIR',
+                        default=config.load()['github-cache-dir'],
+                        help='Directory of the cached API responses '
+                        '(default: %(default)s)')
+    parser.add_argument('--no-cache', action='store_true',
+                        help='Do not use the cached API responses')
+    parser.add_argument('-j', '--jobs', type=positive_int,
+                        default=github_api.JOBS,
+                        help='Concurrent API requests (default: %(default)s)')
+    parser.add_argument('--resolve', action='store_true',
+                        help='Append the SHA of the head commit of the '
+                        'branch to each repository')
+    parser.add_argument('--state', metavar='FILE',
+                        help='Resolve the head commits, compare them to '
+                        'FILE and keep them aside in FILE{} for '
+                        '--commit-state'.format(PENDING_SUFFIX))
+    parser.add_argument('--changed-only', action='store_true',
+                        help='Only list the repositories changed since the '
+                        'committed state, with the previous head commit')
+    parser.add_argument('--commit-state', action='store_true',
+                        help='Save the head commits kept aside by the last '
+                        'run as the new state, once their builds succeeded')
+    args = parser.parse_args()
+    if (args.changed_only or args.commit_state) and not args.state:
+        parser.error('--changed-only and --commit-state require --state')
+    if args.commit_state:
+        ok, error = commit_state(args.state)
+        if not ok:
+            sys.stderr.write('{}\n'.format(error))
+            sys.exit(1)
+        return
+    if args.json_input is None:
+        parser.error('tklgit_input.json is required')
+    logging.basicConfig(format='%(levelname)s: %(message)s')
+
     sys.stderr.write('Parsing input file\n')
-    if sys.argv[1] == '-':
+    if args.json_input == '-':
         json_input = json.load(sys.stdin)
     else:
-        with open(sys.argv[1]) as input_file:
+        with open(args.json_input) as input_file:
             json_input = json.load(input_file)
-    output = []
-    for record in json_input:
-        output.extend(parse_entry(record))
+    client = github_api.GithubClient(
+        args.api_url, args.token, None if args.no_cache else args.cache_dir,
+        args.jobs)
+    try:
+        ok, output = list_repositories(json_input, client)
+        if ok and (args.resolve or args.state):
+            ok, output = resolve_heads(output, client)
+    finally:
+        client.close()
+    sys.stderr.write('{}\n'.format(client.report()))
+    if not ok:
+        sys.stderr.write('Cannot list repositories:\n{}\n'.format(output))
+        sys.exit(1)
+    if args.state:
+        state = load_state(args.state)
+        save_state(args.state + PENDING_SUFFIX, output)
+        if args.changed_only:
+            output = changed_repos(output, state)
     sys.stderr.write('Dumping {} repositories to stdout\n'.format(len(output)))
     json.dump(output, sys.stdout, sort_keys=True, indent=4, separators=(',', ': '))
 
@@ -0,0 +1,118 @@
+"""
+Timing spans for API calls, wait loops and subprocesses.
+
+Tracing is off by default and spans cost next to nothing. Once enabled with
+enable(), each span records its duration and its attributes (exit code,
+bytes, ...). The spans of the commands run by helper.check_cmd also record
+the CPU time and peak RSS of their own process, measured when it is reaped.
+write() dumps the spans in the Chrome trace event format, which can be
+loaded in chrome://tracing, Perfetto or speedscope.
+"""
+from __future__ import division, absolute_import, print_function, unicode_literals
+
+import contextlib
+import json
+import os
+import threading
+import time
+
+
+_tracer = None
+
+
+class Tracer(object):
+
+    """
+    Collect finished spans.
+    """
+
+    def __init__(self):
+        self.events = []
+        self.started = time.time()
+        self._lock = threading.Lock()
+        self._local = threading.local()
+
+    def stack(self):
+        if not hasattr(self._local, 'stack'):
+            self._local.stack = []
+        return self._local.stack
+
+    def record(self, name, category, start, duration, args):
+        event = dict(name=name, cat=category, ph='X', pid=os.getpid(),
+                     tid=threading.current_thread().ident,
+                     ts=int((start - self.started) * 1e6),
+                     dur=int(duration * 1e6), args=args)
+        with self._lock:
+            self.events.append(event)
+
+    def write(self, path):
+        with self._lock:
+            events = sorted(self.events, key=lambda event: event['ts'])
+        with open(path, 'w') as fp:
+            json.dump(dict(traceEvents=events, displayTimeUnit='ms'), fp,
+                      indent=1, sort_keys=True)
+
+
+def enable():
+    """
+    Start recording spans.
+    """
+    global _tracer
+    _tracer = Tracer()
+
+
+def enabled():
+    return _tracer is not None
+
+
+def write(path):
+    """
+    Write the recorded spans to a JSON trace file.
+    """
+    if _tracer is not None:
+        _tracer.write(path)
+
+
+@contextlib.contextmanager
+def span(name, category='', **args):
+    """
+    Time the enclosed block.
+
+    Yield a dict of span attributes, which the block can update.
+    """
+    if _tracer is None:
+        yield args
+        return
+    tracer = _tracer
+    stack = tracer.stack()
+    if stack:
+        args['parent'] = stack[-1]
+    stack.append(name)
+    start = time.time()
+    try:
+        yield args
+    finally:
+        duration = time.time() - start
+        stack.pop()
+        tracer.record(name, category, start, duration, args)
+
+
+def trace_connection(conn):
+    """
+    Record a span for every API request sent through a boto connection.
+
+    Objects returned by the connection keep a reference to it, so their own
+    requests (volume.attach(), snapshot.update(), ...) are traced as well.
+    """
+    if _tracer is None:
+        return conn
+    make_request = conn.make_request
+
+    def traced_make_request(action, params=None, *args, **kwargs):
+        with span(action, 'api') as attrs:
+            response = make_request(action, params, *args, **kwargs)
+            attrs['status'] = response.status
+            return response
+
+    conn.make_request = traced_make_request
+    return conn
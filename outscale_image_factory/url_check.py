@@ -0,0 +1,298 @@
+"""
+Check that the URLs referenced by an appliance are reachable, optionally
+download them to a local store.
+
+HTTP(S) URLs are checked with HEAD requests (GET when prefetching, or when
+HEAD is not allowed), over kept-alive connections shared by the checking
+threads. FTP URLs are checked with SIZE, git URLs with git ls-remote.
+
+The store holds the downloaded files by the sha256 of their content, and
+index.json maps the URLs to their digest, size and ETag. Git repositories
+are mirrored in its git directory, see git_mirror.
+"""
+from __future__ import division, absolute_import, print_function, unicode_literals
+
+import collections
+import ftplib
+import hashlib
+import httplib
+import json
+import os
+import socket
+import tempfile
+import threading
+import urlparse
+from multiprocessing.pool import ThreadPool
+
+from outscale_image_factory import git_mirror
+from outscale_image_factory.helper import check_cmd
+
+
+JOBS = 16
+TIMEOUT = 30
+MAX_REDIRECTS = 5
+_CHUNK_SIZE = 64 * 1024
+_REDIRECTS = (301, 302, 303, 307, 308)
+# Characters of the surrounding text often caught at the end of a reference
+_TRAILING = '\'"`),;.>]}'
+
+
+def clean_url(url):
+    return url.rstrip(_TRAILING)
+
+
+def is_templated(url):
+    """
+    Return True if url holds shell or template variables, it cannot be
+    checked as it is.
+    """
+    return '$' in url or '{' in url or '%(' in url
+
+
+class ConnectionPool(object):
+
+    """
+    Kept-alive HTTP(S) connections, by scheme, host and port.
+    """
+
+    def __init__(self, timeout=TIMEOUT):
+        self.timeout = timeout
+        self.created = 0
+        self._idle = collections.defaultdict(list)
+        self._lock = threading.Lock()
+
+    def _connect(self, key):
+        scheme, host, port = key
+        with self._lock:
+            self.created += 1
+        if scheme == 'https':
+            return httplib.HTTPSConnection(host, port, timeout=self.timeout)
+        return httplib.HTTPConnection(host, port, timeout=self.timeout)
+
+    def request(self, method, url, headers=None):
+        """
+        Send a request, return (key, connection, response) tuple. Give the
+        connection back with release() once the response is read.
+        """
+        headers = headers or {}
+        parts = urlparse.urlsplit(url)
+        key = (parts.scheme, parts.hostname, parts.port)
+        path = parts.path or '/'
+        if parts.query:
+            path += '?' + parts.query
+        with self._lock:
+            conn = self._idle[key].pop() if self._idle[key] else None
+        if conn is not None:
+            try:
+                conn.request(method, path, headers=headers)
+                return key, conn, conn.getresponse()
+            except (httplib.HTTPException, socket.error):
+                # Closed by the server while idle
+                conn.close()
+        conn = self._connect(key)
+        try:
+            conn.request(method, path, headers=headers)
+            return key, conn, conn.getresponse()
+        except:
+            conn.close()
+            raise
+
+    def release(self, key, conn, response):
+        if response.will_close or not response.isclosed():
+            conn.close()
+        else:
+            with self._lock:
+                self._idle[key].append(conn)
+
+    def close(self):
+        with self._lock:
+            for conns in self._idle.values():
+                for conn in conns:
+                    conn.close()
+            self._idle.clear()
+
+
+class Store(object):
+
+    """
+    Content addressed files downloaded from URLs.
+    """
+
+    def __init__(self, path):
+        self.path = os.path.abspath(path)
+        self.index_path = os.path.join(self.path, 'index.json')
+        self.urls = {}
+        self._lock = threading.Lock()
+        if os.path.exists(self.index_path):
+            with open(self.index_path) as fp:
+                self.urls = json.load(fp)
+        if not os.path.isdir(self.path):
+            os.makedirs(self.path)
+
+    def object_path(self, digest):
+        return os.path.join(self.path, digest[:2], digest)
+
+    def add(self, url, fp, etag=None):
+        """
+        Store the content read from fp. Return the index entry of url.
+        """
+        digest = hashlib.sha256()
+        size = 0
+        with tempfile.NamedTemporaryFile(dir=self.path, delete=False) as tmp:
+            for chunk in iter(lambda: fp.read(_CHUNK_SIZE), b''):
+                digest.update(chunk)
+                size += len(chunk)
+                tmp.write(chunk)
+        path = self.object_path(digest.hexdigest())
+        with self._lock:
+            if not os.path.isdir(os.path.dirname(path)):
+                os.makedirs(os.path.dirname(path))
+            os.rename(tmp.name, path)
+            entry = dict(sha256=digest.hexdigest(), size=size, etag=etag)
+            self.urls[url] = entry
+        return entry
+
+    def get(self, url):
+        """
+        Return the index entry of url if its file is stored, else None.
+        """
+        with self._lock:
+            entry = self.urls.get(url)
+        if entry is not None and \
+                os.path.exists(self.object_path(entry['sha256'])):
+            return entry
+        return None
+
+    def save(self):
+        with self._lock:
+            tmp = self.index_path + '.tmp'
+            with open(tmp, 'w') as fp:
+                json.dump(self.urls, fp, indent=1, sort_keys=True)
+            os.rename(tmp, self.index_path)
+
+
+def _check_http(pool, url, store):
+    original_url = url
+    cached = None if store is None else store.get(url)
+    # Stored files are downloaded again only if their ETag changed
+    method = 'GET' if store is not None and cached is None else 'HEAD'
+    for _ in range(MAX_REDIRECTS + 1):
+        key, conn, response = pool.request(method, url)
+        try:
+            status = response.status
+            if status in _REDIRECTS and response.getheader('Location'):
+                response.read()
+                url = urlparse.urljoin(url, response.getheader('Location'))
+                continue
+            if method == 'HEAD' and status in (405, 501):
+                response.read()
+                method = 'GET'
+                continue
+            result = dict(ok=200 <= status < 300, status=status,
+                          size=response.getheader('Content-Length'),
+                          etag=response.getheader('ETag'))
+            if result['size'] is not None:
+                result['size'] = int(result['size'])
+            if result['ok'] and cached is not None:
+                if result['etag'] is not None and \
+                        result['etag'] == cached['etag']:
+                    response.read()
+                    result.update(cached)
+                    return result
+                cached = None
+                method = 'GET'
+                response.read()
+                continue
+            if result['ok'] and store is not None:
+                result.update(store.add(original_url, response,
+                                        result['etag']))
+            elif method == 'HEAD' or status >= 300:
+                response.read()
+            # A body left unread closes the connection, see release()
+            return result
+        finally:
+            pool.release(key, conn, response)
+    return dict(ok=False, status=None, error='Too many redirects')
+
+
+def _check_ftp(url, store, timeout):
+    parts = urlparse.urlsplit(url)
+    ftp = ftplib.FTP(timeout=timeout)
+    try:
+        ftp.connect(parts.hostname, parts.port or 21)
+        ftp.login(parts.username or 'anonymous', parts.password or '')
+        ftp.voidcmd('TYPE I')
+        result = dict(ok=True, status=None, size=ftp.size(parts.path))
+        if store is not None:
+            conn = ftp.transfercmd('RETR ' + parts.path)
+            fp = conn.makefile('rb')
+            try:
+                result.update(store.add(url, fp))
+            finally:
+                fp.close()
+                conn.close()
+            ftp.voidresp()
+        return result
+    finally:
+        ftp.close()
+
+
+def _check_git(url, store, timeout):
+    if store is not None:
+        ok, err = git_mirror.update_mirror(os.path.join(store.path, 'git'),
+                                           url)
+    else:
+        ok, err = check_cmd('git ls-remote {} HEAD'.format(url),
+                            timeout=timeout)
+    return dict(ok=ok, status=None, error=None if ok else err['stdout'])
+
+
+def check_url(pool, url, store=None, timeout=TIMEOUT):
+    """
+    Check that url is reachable, download it to store if given.
+
+    Return a dict with ok, status (the HTTP status), size, etag and error,
+    and the sha256 of the downloaded files. A malformed url fails the
+    check.
+    """
+    try:
+        scheme = urlparse.urlsplit(url).scheme
+        if scheme == 'git' or url.endswith('.git'):
+            result = _check_git(url, store, timeout)
+        elif scheme in ('http', 'https'):
+            result = _check_http(pool, url, store)
+        elif scheme == 'ftp':
+            result = _check_ftp(url, store, timeout)
+        else:
+            result = dict(ok=False, error='Unsupported scheme')
+    except ((OSError, ValueError, httplib.HTTPException) +
+            ftplib.all_errors) as error:
+        result = dict(ok=False, error='{}: {}'.format(type(error).__name__,
+                                                      error))
+    result['url'] = url
+    return result
+
+
+def check_urls(urls, jobs=JOBS, store=None, timeout=TIMEOUT):
+    """
+    Check the distinct urls, jobs at a time. Templated URLs are skipped.
+
+    Yield the results of check_url, as the checks complete.
+    """
+    urls = sorted(set(urls))
+    for url in urls:
+        if is_templated(url):
+            yield dict(url=url, ok=True, skipped=True)
+    pool = ConnectionPool(timeout)
+    threads = ThreadPool(jobs)
+    try:
+        for result in threads.imap_unordered(
+                lambda url: check_url(pool, url, store, timeout),
+                [url for url in urls if not is_templated(url)]):
+            yield result
+    finally:
+        threads.close()
+        threads.join()
+        pool.close()
+        if store is not None:
+            store.save()
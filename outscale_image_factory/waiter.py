@@ -0,0 +1,368 @@
+"""
+Adaptive waiters for EC2 objects.
+
+Each resource type gets a polling policy: volumes are polled quickly at first
+and then back off exponentially, snapshots are polled at a fraction of the
+estimated time to completion computed from their `progress` field.
+
+A WaitCoordinator shares one poller thread between all the objects waited for
+on a connection, and issues a single batched describe call per resource type
+and poll tick.
+"""
+from __future__ import division, absolute_import, print_function, unicode_literals
+
+import logging
+import random
+import threading
+import time
+
+
+# States after which waiting is pointless
+ERROR_STATES = frozenset(['error', 'failed'])
+
+
+def state(obj):
+    """Return the state of a boto object (volumes use `status`)."""
+    return obj.state if hasattr(obj, 'state') else obj.status
+
+
+def progress(obj):
+    """Return the progress of an object as a float percentage, or None."""
+    value = getattr(obj, 'progress', None)
+    if not value:
+        return None
+    try:
+        return float(str(value).rstrip('%'))
+    except ValueError:
+        return None
+
+
+def resource_type(obj):
+    """Guess the resource type of an object from its id."""
+    prefix = obj.id.split('-', 1)[0]
+    return {
+        'vol': 'volume',
+        'snap': 'snapshot',
+        'ami': 'image',
+        'i': 'instance',
+    }.get(prefix, 'unknown')
+
+
+class Tracker(object):
+
+    """
+    Polling history of one waited-for object.
+    """
+
+    def __init__(self, obj, target_state, clock=time.time):
+        self.obj = obj
+        self.target_state = target_state
+        self.clock = clock
+        self.started = clock()
+        self.attempt = 0
+        self.samples = []
+
+    def elapsed(self):
+        return self.clock() - self.started
+
+    def observe(self):
+        """Record the current state of the object, log progress."""
+        pct = progress(self.obj)
+        if pct is not None:
+            self.samples.append((self.clock(), pct))
+            rate = self.rate()
+            if rate:
+                logging.info('{} {}: {:.0f}% ({:.2f}%/s, eta {:.0f}s)'.format(
+                    self.obj.id, state(self.obj), pct, rate, self.eta()))
+            else:
+                logging.info('{} {}: {:.0f}%'.format(
+                    self.obj.id, state(self.obj), pct))
+        else:
+            logging.debug('{} state={}'.format(self.obj.id,
+                                               repr(state(self.obj))))
+
+    def rate(self):
+        """Return the progress rate in percent per second, or None."""
+        if len(self.samples) < 2:
+            return None
+        (t0, p0), (t1, p1) = self.samples[0], self.samples[-1]
+        if t1 <= t0 or p1 <= p0:
+            return None
+        return (p1 - p0) / (t1 - t0)
+
+    def eta(self):
+        """Return the estimated seconds to completion, or None."""
+        rate = self.rate()
+        if not rate:
+            return None
+        return max(0.0, (100.0 - self.samples[-1][1]) / rate)
+
+    def done(self):
+        return state(self.obj) == self.target_state
+
+    def failed(self):
+        return state(self.obj) in ERROR_STATES and not self.done()
+
+
+class Backoff(object):
+
+    """
+    Exponential backoff with jitter.
+
+    The first poll happens after `first` seconds, each following interval is
+    multiplied by `factor` up to `maximum`. Intervals are randomized by
+    +/- `jitter` (a fraction) so that concurrent waiters do not synchronize.
+    """
+
+    def __init__(self, first=0.5, factor=1.5, maximum=10.0, jitter=0.2):
+        self.first = first
+        self.factor = factor
+        self.maximum = maximum
+        self.jitter = jitter
+
+    def _jitter(self, interval):
+        return interval * random.uniform(1 - self.jitter, 1 + self.jitter)
+
+    def interval(self, tracker):
+        base = min(self.maximum, self.first * self.factor ** tracker.attempt)
+        return self._jitter(base)
+
+
+class ProgressBackoff(Backoff):
+
+    """
+    Poll at a fraction of the estimated time to completion.
+
+    Falls back to exponential backoff until two progress samples give a rate.
+    """
+
+    def __init__(self, first=1.0, factor=1.5, maximum=60.0, jitter=0.2,
+                 minimum=1.0, eta_fraction=0.5):
+        super(ProgressBackoff, self).__init__(first, factor, maximum, jitter)
+        self.minimum = minimum
+        self.eta_fraction = eta_fraction
+
+    def interval(self, tracker):
+        eta = tracker.eta()
+        if eta is None:
+            return super(ProgressBackoff, self).interval(tracker)
+        base = max(self.minimum, min(self.maximum, eta * self.eta_fraction))
+        return self._jitter(base)
+
+
+POLICIES = {
+    'volume': Backoff(first=0.3, factor=1.6, maximum=10.0),
+    'snapshot': ProgressBackoff(),
+    'image': Backoff(first=1.0, factor=1.5, maximum=15.0),
+    'instance': Backoff(first=2.0, factor=1.5, maximum=15.0),
+    'unknown': Backoff(first=1.5, factor=1.0, maximum=1.5),
+}
+
+
+def policy_for(obj):
+    return POLICIES[resource_type(obj)]
+
+
+def wait_for(obj, target_state, wait_sec=600, policy=None,
+             sleep=time.sleep, clock=time.time):
+    """
+    Wait for object to reach target_state, calling obj.update() according to
+    the polling policy of its resource type.
+
+    Stop early if the object enters one of ERROR_STATES.
+
+    Return True if the target state was reached.
+    """
+    if policy is None:
+        policy = policy_for(obj)
+    tracker = Tracker(obj, target_state, clock)
+    logging.info('Waiting for ' + obj.id)
+    tracker.observe()
+    while not tracker.done() and not tracker.failed():
+        remaining = wait_sec - tracker.elapsed()
+        if remaining <= 0:
+            break
+        sleep(min(remaining, policy.interval(tracker)))
+        tracker.attempt += 1
+        obj.update()
+        tracker.observe()
+    logging.debug('{} reached {} after {} polls in {:.1f}s'.format(
+        obj.id, repr(state(obj)), tracker.attempt, tracker.elapsed()))
+    return tracker.done()
+
+
+# Batched describe calls, by resource type
+DESCRIBE = {
+    'volume': lambda conn, ids: conn.get_all_volumes(volume_ids=ids),
+    'snapshot': lambda conn, ids: conn.get_all_snapshots(snapshot_ids=ids),
+    'image': lambda conn, ids: conn.get_all_images(image_ids=ids),
+    'instance': lambda conn, ids: [
+        i for r in conn.get_all_instances(instance_ids=ids)
+        for i in r.instances],
+}
+
+
+class _Entry(object):
+
+    """
+    An object registered with a WaitCoordinator.
+    """
+
+    def __init__(self, obj, target_state, wait_sec, clock):
+        self.tracker = Tracker(obj, target_state, clock)
+        self.policy = policy_for(obj)
+        self.deadline = self.tracker.started + wait_sec
+        self.next_poll = self.tracker.started + \
+            self.policy.interval(self.tracker)
+        self.event = threading.Event()
+        self.error = None
+
+
+class WaitCoordinator(object):
+
+    """
+    Wait for many objects at once.
+
+    Pending objects are grouped by resource type; on each poll tick, every
+    type with at least one object due for polling is refreshed with a single
+    describe call listing all pending ids of that type. The number of API
+    calls thus grows with the number of ticks, not the number of objects.
+    """
+
+    # Upper bound of a poller sleep, so that new registrations are picked up
+    max_sleep = 1.0
+
+    def __init__(self, conn, sleep=time.sleep, clock=time.time):
+        self.conn = conn
+        self.sleep = sleep
+        self.clock = clock
+        self.describe_calls = 0
+        self._lock = threading.Lock()
+        self._pending = []
+        self._thread = None
+
+    def wait(self, obj, target_state, wait_sec=600):
+        """
+        Wait for one object, see wait_all().
+        """
+        return self.wait_all([obj], target_state, wait_sec)[0]
+
+    def wait_all(self, objs, target_state, wait_sec=600):
+        """
+        Wait for all objects to reach target_state.
+
+        Re-raise the first error raised while refreshing the objects.
+
+        Return a list of booleans, True for objects that reached the state.
+        """
+        entries = []
+        with self._lock:
+            for obj in objs:
+                logging.info('Waiting for ' + obj.id)
+                entry = _Entry(obj, target_state, wait_sec, self.clock)
+                entry.tracker.observe()
+                if entry.tracker.done() or entry.tracker.failed():
+                    entry.event.set()
+                else:
+                    self._pending.append(entry)
+                entries.append(entry)
+            if self._pending and self._thread is None:
+                self._thread = threading.Thread(target=self._run,
+                                                name='wait-coordinator')
+                self._thread.daemon = True
+                self._thread.start()
+        for entry in entries:
+            # Waiting with a timeout keeps the main thread interruptible
+            while not entry.event.wait(1.0):
+                pass
+        for entry in entries:
+            if entry.error is not None:
+                raise entry.error
+        return [entry.tracker.done() for entry in entries]
+
+    def _run(self):
+        while True:
+            with self._lock:
+                if not self._pending:
+                    self._thread = None
+                    return
+                due = min(entry.next_poll for entry in self._pending)
+            delay = due - self.clock()
+            if delay > 0:
+                self.sleep(min(delay, self.max_sleep))
+                continue
+            try:
+                self.tick()
+            except Exception as error:
+                # Never leave waiters hanging
+                with self._lock:
+                    for entry in self._pending:
+                        entry.error = error
+                        entry.event.set()
+                    self._pending = []
+
+    def tick(self):
+        """
+        Refresh all pending objects of every type with an object due.
+        """
+        now = self.clock()
+        with self._lock:
+            groups = {}
+            for entry in self._pending:
+                rtype = resource_type(entry.tracker.obj)
+                groups.setdefault(rtype, []).append(entry)
+            groups = dict((rtype, entries)
+                          for rtype, entries in groups.items()
+                          if any(e.next_poll <= now for e in entries))
+        for rtype, entries in groups.items():
+            self._refresh(rtype, entries)
+        now = self.clock()
+        with self._lock:
+            for entry in [e for lst in groups.values() for e in lst]:
+                tracker = entry.tracker
+                tracker.attempt += 1
+                if entry.error is None:
+                    tracker.observe()
+                if entry.error is not None or tracker.done() or \
+                        tracker.failed() or now >= entry.deadline:
+                    self._pending.remove(entry)
+                    entry.event.set()
+                else:
+                    entry.next_poll = now + min(entry.policy.interval(tracker),
+                                                entry.deadline - now)
+
+    def _refresh(self, rtype, entries):
+        ids = sorted(set(e.tracker.obj.id for e in entries))
+        describe = DESCRIBE.get(rtype)
+        fresh = None
+        if describe is not None:
+            try:
+                self.describe_calls += 1
+                fresh = dict((o.id, o) for o in describe(self.conn, ids))
+            except Exception as error:
+                # One bad id fails the whole batch, retry one by one
+                logging.debug('Batched describe of {} failed: {}'.format(
+                    ids, repr(error)))
+        for entry in entries:
+            obj = entry.tracker.obj
+            try:
+                if fresh is not None and obj.id in fresh:
+                    obj.__dict__.update(fresh[obj.id].__dict__)
+                else:
+                    obj.update()
+            except Exception as error:
+                entry.error = error
+
+
+_coordinators = {}
+_coordinators_lock = threading.Lock()
+
+
+def coordinator(conn):
+    """
+    Return the WaitCoordinator shared by all users of a connection.
+    """
+    with _coordinators_lock:
+        if conn not in _coordinators:
+            _coordinators[conn] = WaitCoordinator(conn)
+        return _coordinators[conn]
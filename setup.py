@@ -7,7 +7,6 @@ if sys.version_info[0] != 2 or sys.version_info[1] < 7:
 
 req = [
     'boto',
-    'PyGithub>=1.25',
     ]
 
 scripts = [